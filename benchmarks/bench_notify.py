@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+"""Micro-benchmark of IBBQ._cb_realtime_temp_notify as the history grows
+
+Run from the repository root:
+
+    python3 -m benchmarks.bench_notify
+"""
+
+import argparse
+import struct
+import time
+
+from lib.ibbq import IBBQ
+
+NPROBES = 4
+
+
+def frame(i, changing):
+    if changing:
+        # Every reading differs from the last; worst case, a new run each time
+        temps = [200 + (i + probe) % 50 for probe in range(NPROBES)]
+    else:
+        temps = [200 + probe for probe in range(NPROBES)]
+    return struct.pack(f"<{NPROBES}H", *temps)
+
+
+def bench(ibbq, fill, iterations, changing):
+    """Fill the history to ``fill`` readings, then time ``iterations`` more"""
+    for i in range(len(ibbq.history), fill):
+        ibbq._cb_realtime_temp_notify(None, frame(i, True)) # pylint: disable=protected-access
+
+    frames = [frame(fill + i, changing) for i in range(iterations)]
+    start = time.perf_counter_ns()
+    for data in frames:
+        ibbq._cb_realtime_temp_notify(None, data) # pylint: disable=protected-access
+    return (time.perf_counter_ns() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--iterations', type=int, default=10000,
+                        help="Notifications timed per history size")
+    parser.add_argument('--maxhistory', type=int, default=60*60*8,
+                        help="History capacity (default: 8h at 1Hz)")
+    args = parser.parse_args()
+
+    sizes = [0, 1000, 10000, args.maxhistory]
+    print(f"{'history':>10} {'new run (ns)':>14} {'extend (ns)':>14}")
+    for size in sizes:
+        ibbq = IBBQ(maxhistory=args.maxhistory)
+        new_run = bench(ibbq, size, args.iterations, True)
+        ibbq = IBBQ(maxhistory=args.maxhistory)
+        extend = bench(ibbq, size, args.iterations, False)
+        print(f"{size:>10} {new_run:>14.0f} {extend:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
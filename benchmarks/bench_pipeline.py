@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+"""End-to-end benchmark of the notification to browser pipeline
+
+Drives IBBQ._cb_realtime_temp_notify with synthetic frames, serves the
+devices with a WebServer on localhost and attaches simulated websocket
+clients. Reports, as JSON:
+
+- notify: time to handle one temperature notification
+- fanout: latency from a notification to each client receiving it, and the
+  (uncompressed) bytes each client was sent
+- history_memory: memory used by a full history, per hour at 1Hz
+- full_sync: time for a new client to receive the full history
+
+The clients run in the same process (and event loop) as the server, so
+latencies include their share of the work; compare results from the same
+machine.
+
+Run from the repository root:
+
+    python3 -m benchmarks.bench_pipeline -o results.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import socket
+import statistics
+import struct
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+
+import lib.config
+from lib.devices import DeviceRegistry
+from lib.ibbq import IBBQ
+from lib.webserver import WebServer
+
+NPROBES = 4
+SYNC_HOURS = (1, 8, 24)
+
+FANOUT_DEVICE = "00:00:00:00:00:01"
+SYNC_DEVICES = {hours: f"00:00:00:00:01:{hours:02X}" for hours in SYNC_HOURS}
+
+
+def frame(i):
+    """Notification ``i``; probe 1 is unique per frame so clients can match it"""
+    temps = [200 + i % 30000] + [250 + (i // 7 + probe) % 40 for probe in range(NPROBES - 1)]
+    return struct.pack(f"<{NPROBES}h", *temps)
+
+
+def fill(history, hours):
+    """Fill ``history`` with ``hours`` of 1Hz readings, ending now"""
+    end_ms = int(datetime.datetime.now().timestamp() * 1000)
+    count = hours * 60 * 60
+    for i in range(count):
+        temps = [1100 + i % 17] + [50 + (i // (probe + 5)) % 900 for probe in range(NPROBES - 1)]
+        history.append(end_ms - (count - i) * 1000, temps)
+
+
+def percentiles(samples, scale=1.0):
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {
+        "p50": cuts[49] * scale,
+        "p90": cuts[89] * scale,
+        "p99": cuts[98] * scale,
+        "max": max(samples) * scale,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def bench_notify(iterations, maxhistory):
+    """Per notification handling time, with a full history"""
+    ibbq = IBBQ(maxhistory=maxhistory)
+    fill(ibbq.history, maxhistory // (60 * 60))
+    frames = [frame(i) for i in range(iterations)]
+
+    samples = []
+    start = time.perf_counter_ns()
+    for data in frames:
+        call_start = time.perf_counter_ns()
+        ibbq._cb_realtime_temp_notify(None, data) # pylint: disable=protected-access
+        samples.append(time.perf_counter_ns() - call_start)
+    elapsed = time.perf_counter_ns() - start
+
+    return {
+        "notifications": iterations,
+        "history": len(ibbq.history),
+        "latency_us": percentiles(samples, 1e-3),
+        "per_second": iterations / (elapsed * 1e-9),
+    }
+
+
+def bench_history_memory():
+    """Memory of a full history (worst case: every reading differs)"""
+    results = {}
+    for hours in SYNC_HOURS:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        ibbq = IBBQ(maxhistory=hours * 60 * 60)
+        fill(ibbq.history, hours)
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        results[f"{hours}h"] = {
+            "bytes": used,
+            "bytes_per_hour": used / hours,
+        }
+    return results
+
+
+async def fanout_client(session, url, sent, results, done):
+    """Record the latency of every update, until probe 1 reads ``done``"""
+    received = {"bytes": 0, "messages": 0, "latencies": []}
+    results.append(received)
+    async with session.ws_connect(url) as wsock:
+        async for msg in wsock:
+            now = time.perf_counter()
+            received["bytes"] += len(msg.data)
+            received["messages"] += 1
+            payload = json.loads(msg.data)
+            if "readings" not in payload or not payload["readings"]["ts"]:
+                continue
+            # Columnar deltas start from 0, so a column sums to its last value
+            raw = sum(payload["readings"]["probes"][0])
+            if raw in sent:
+                received["latencies"].append(now - sent[raw])
+            if raw == done:
+                return
+
+
+async def send_frames(ibbq, notifications, rate, sent):
+    """Send ``notifications`` frames at ``rate``, recording when in ``sent``"""
+    period = 1 / rate
+    deadline = time.perf_counter()
+    for i in range(notifications):
+        data = frame(i)
+        sent[200 + i % 30000] = time.perf_counter()
+        ibbq._cb_realtime_temp_notify(None, data) # pylint: disable=protected-access
+        deadline += period
+        await asyncio.sleep(max(0, deadline - time.perf_counter()))
+
+
+async def bench_fanout(port, ibbq, clients, notifications, rate):
+    url = f"http://localhost:{port}/ws?enc=columnar&device={FANOUT_DEVICE}"
+    sent = {}
+    results = []
+    done = 200 + (notifications - 1) % 30000
+
+    async with aiohttp.ClientSession() as session:
+        tasks = [
+            asyncio.create_task(fanout_client(session, url, sent, results, done))
+            for _ in range(clients)
+        ]
+        # Let every client connect and receive its initial sync
+        while len(results) < clients or any(r["messages"] == 0 for r in results):
+            await asyncio.sleep(0.05)
+        for received in results:
+            received["bytes"] = 0
+            received["messages"] = 0
+
+        await send_frames(ibbq, notifications, rate, sent)
+        await asyncio.wait_for(asyncio.gather(*tasks), 30)
+
+    latencies = [latency for received in results for latency in received["latencies"]]
+    return {
+        "clients": clients,
+        "notifications": notifications,
+        "rate_hz": rate,
+        "latency_ms": percentiles(latencies, 1e3),
+        "updates_per_client": statistics.mean(r["messages"] for r in results),
+        "bytes_per_client": statistics.mean(r["bytes"] for r in results),
+    }
+
+
+async def full_sync(session, url):
+    """Seconds and bytes until the full history has been received"""
+    start = time.perf_counter()
+    nbytes = 0
+    async with session.ws_connect(url) as wsock:
+        async for msg in wsock:
+            nbytes += len(msg.data)
+            if "full_history" in json.loads(msg.data):
+                return (time.perf_counter() - start, nbytes)
+    raise ConnectionError("Websocket closed before the full history was sent")
+
+
+async def bench_full_sync(port, repeat, points):
+    results = {}
+    async with aiohttp.ClientSession() as session:
+        for (hours, device) in SYNC_DEVICES.items():
+            url = f"http://localhost:{port}/ws?enc=columnar&device={device}"
+            results[f"{hours}h"] = {}
+            for (name, query) in (("full", ""), ("downsampled", f"&points={points}")):
+                runs = [await full_sync(session, url + query) for _ in range(repeat)]
+                results[f"{hours}h"][name] = {
+                    "ms": statistics.median(run[0] for run in runs) * 1e3,
+                    "bytes": runs[-1][1],
+                }
+    return results
+
+
+async def bench_server(args):
+    cfg = lib.config.IbbqWebConfig(None)
+    cfg.http_port = free_port()
+    devices = DeviceRegistry([FANOUT_DEVICE, *SYNC_DEVICES.values()],
+                             maxhistory=max(SYNC_HOURS) * 60 * 60,
+                             coalesce_window=args.coalesce_ms / 1000)
+    for (hours, device) in SYNC_DEVICES.items():
+        fill(devices.get(device).history, hours)
+
+    async with WebServer(cfg, devices) as webserver:
+        await webserver.start()
+        return {
+            "fanout": await bench_fanout(cfg.http_port, devices.get(FANOUT_DEVICE),
+                                         args.clients, args.notifications, args.rate),
+            "full_sync": await bench_full_sync(cfg.http_port, args.repeat, args.points),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="Write the results to FILE instead of STDOUT")
+    parser.add_argument('-n', '--iterations', type=int, default=20000,
+                        help="Notifications timed by the notify benchmark")
+    parser.add_argument('-c', '--clients', type=int, default=50,
+                        help="Websocket clients in the fan-out benchmark")
+    parser.add_argument('--notifications', type=int, default=500,
+                        help="Notifications sent in the fan-out benchmark")
+    parser.add_argument('--rate', type=float, default=50,
+                        help="Notifications per second in the fan-out benchmark")
+    parser.add_argument('--coalesce-ms', type=float, default=0,
+                        help="Notification coalescing window in the fan-out benchmark")
+    parser.add_argument('--points', type=int, default=2000,
+                        help="Points requested by downsampled full syncs")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Full syncs timed per history size")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "notify": bench_notify(args.iterations, 60 * 60 * 8),
+        "history_memory": bench_history_memory(),
+    }
+    results.update(asyncio.run(bench_server(args)))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f_obj:
+            json.dump(results, f_obj, indent=2)
+            f_obj.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,33 @@ import asyncio
 import logging
 import logging.handlers
 import sys
+import time
 
 import lib.config
-from lib.ibbq import IBBQ
-from lib.webserver import WebServer
 
 log = logging.getLogger('ibbqweb')
 
+
+class StartupProfile:
+    """Time taken by each step of startup, for --profile-startup"""
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._last = self._start
+        self._steps = []
+
+    def mark(self, step):
+        """Record the time since the previous mark as ``step``"""
+        now = time.perf_counter()
+        self._steps.append((step, now - self._last, now - self._start))
+        self._last = now
+
+    def report(self, file=sys.stderr):
+        print("Startup profile (ms):", file=file)
+        print(f"  {'step':<32} {'took':>8} {'total':>8}", file=file)
+        for (step, took, total) in self._steps:
+            print(f"  {step:<32} {took * 1000:8.1f} {total * 1000:8.1f}", file=file)
+
 def init_logging(level, syslog=False):
     log.setLevel(level)
     if syslog:
@@ -25,39 +45,7 @@ def init_logging(level, syslog=False):
     handler.setFormatter(logging.Formatter(log_fmt))
     log.addHandler(handler)
 
-async def device_manager(_ibbq):
-    log.info("Connecting to iBBQ...")
-    while True:
-        try:
-            async with _ibbq as ibbq:
-                await ibbq.connect(ibbq.address)
-                log.info("iBBQ Connected")
-
-                await ibbq.subscribe()
-
-                while True:
-                    if not ibbq.connected:
-                        raise ConnectionError("Disconnected from iBBQ %s" %
-                                              ibbq.address)
-
-                    reading = ibbq.probe_reading
-                    if reading is not None:
-                        log.debug("Battery: %s%%", str(ibbq.battery_level))
-                        temp_strs = [
-                            "%s%s" % (temp, "" if temp is None else "C")
-                            for temp in reading["probes"]
-                        ]
-                        log.debug("Probe temps: " + ', '.join(["%s" for _ in range(len(temp_strs))]),
-                                  *temp_strs)
-
-                    await asyncio.sleep(5)
-        except asyncio.CancelledError:
-            return
-        except (ConnectionError, asyncio.TimeoutError):
-            log.warning("Reconnecting...")
-            await asyncio.sleep(1)
-
-async def main():
+def parse_args():
     desc = 'iBBQ bluetooth thermometer web interface'
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('-c', '--config', metavar='FILE',
@@ -69,7 +57,32 @@ async def main():
     parser.add_argument('-v', '--verbose', action="count", default=0,
                         help="Enable verbose logging (can be passed multiple "
                              "times for even more verbose output)")
-    args = parser.parse_args()
+    parser.add_argument('--profile-startup', action="store_true", default=False,
+                        help="Print how long each step of startup takes")
+    parser.add_argument('-t', '--transport', choices=['bleak', 'sim'], default='bleak',
+                        help="Talk to real devices over Bluetooth ('bleak'), or "
+                             "to simulated devices ('sim'). Default: bleak")
+    sim_args = parser.add_argument_group('simulated devices (--transport sim)')
+    sim_args.add_argument('--sim-devices', type=int, default=1, metavar='N',
+                          help="Number of devices. Default: 1")
+    sim_args.add_argument('--sim-probes', type=int, default=4, metavar='N',
+                          help="Probes per device. Default: 4")
+    sim_args.add_argument('--sim-rate', type=float, default=1.0, metavar='HZ',
+                          help="Temperature notifications per second. Default: 1")
+    sim_args.add_argument('--sim-speedup', type=float, default=1.0, metavar='X',
+                          help="Run the simulated cook X times faster. Default: 1")
+    sim_args.add_argument('--sim-disconnect', type=float, default=None, metavar='SECONDS',
+                          help="Mean time between disconnects. Default: never")
+    sim_args.add_argument('--sim-unplug', type=float, default=None, metavar='SECONDS',
+                          help="Mean time between probes being (un)plugged. Default: never")
+    sim_args.add_argument('--sim-seed', default=None,
+                          help="Random seed, for reproducible runs")
+    return parser.parse_args()
+
+
+async def main():
+    profile = StartupProfile()
+    args = parse_args()
 
     log_level = logging.WARNING
     if args.verbose >= 2:
@@ -77,21 +90,60 @@ async def main():
     elif args.verbose == 1:
         log_level = logging.INFO
     init_logging(log_level, args.syslog)
+    profile.mark("parse arguments")
+
+    # Imported here rather than at the top, so their cost shows up in the
+    # startup profile (and --help stays quick)
+    # pylint: disable=import-outside-toplevel
+    from lib.devices import DeviceRegistry
+    from lib.transport import BleakTransport, SimulatedTransport
+    profile.mark("import devices")
+    from lib.webserver import WebServer
+    profile.mark("import webserver (aiohttp)")
+    # pylint: enable=import-outside-toplevel
 
     cfg = lib.config.IbbqWebConfig(args.config)
     cfg.load()
+    profile.mark("load config")
 
-    ibbq = IBBQ()
-    if cfg.unit == 'C':
-        await ibbq.set_unit_celcius()
+    addresses = cfg.devices
+    if args.transport == 'sim':
+        transport = SimulatedTransport(args.sim_devices, args.sim_probes, args.sim_rate,
+                                       speedup=args.sim_speedup,
+                                       disconnect_interval=args.sim_disconnect,
+                                       unplug_interval=args.sim_unplug,
+                                       seed=args.sim_seed)
+        if not addresses and args.sim_devices > 1:
+            addresses = transport.addresses
     else:
-        await ibbq.set_unit_farenheit()
+        transport = BleakTransport()
+    profile.mark(f"init {args.transport} transport")
 
-    async with WebServer(cfg, ibbq) as webserver:
-        await asyncio.gather(
-            device_manager(ibbq),
-            webserver.start(),
-        )
+    devices = DeviceRegistry(addresses, cfg.history_dir,
+                             cfg.history_retention_hours * 60 * 60 * 1000,
+                             transport,
+                             coalesce_window=cfg.notify_coalesce_ms / 1000,
+                             alert_hysteresis_c=cfg.alert_hysteresis_c)
+    devices.restore_history()
+    profile.mark("restore history")
+
+    for ibbq in devices:
+        ibbq.restore_target_temps(cfg.target_temps(ibbq.device_id))
+        ibbq.restore_unit(cfg.unit)
+
+    # Start scanning for devices straight away, while the web server is set up
+    devices_task = asyncio.create_task(devices.run())
+    try:
+        async with WebServer(cfg, devices) as webserver:
+            profile.mark("set up web server")
+            await webserver.start()
+            profile.mark("start listening")
+            if args.profile_startup:
+                profile.report()
+            await devices_task
+    finally:
+        devices_task.cancel()
+        await cfg.flush()
 
 if __name__ == "__main__":
     try:
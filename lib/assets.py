@@ -0,0 +1,164 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import os.path
+import posixpath
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger('ibbqweb')
+
+
+# Files under assets/ given content hashed URLs; not the thousands of icons,
+# nor fonts only older browsers load
+HASHED_EXTENSIONS = ('.js', '.css', '.woff2', '.ttf')
+HASH_LENGTH = 16
+COMPRESS_EXTENSIONS = ('.js', '.css', '.ttf')
+COMPRESS_MIN_SIZE = 1024
+
+INDEX_PATH = "/index.html"
+SERVICE_WORKER_PATH = "/service_worker.js"
+
+CSS_URL_RE = re.compile(r'url\(\s*(["\']?)([^"\')]+)\1\s*\)')
+HTML_URL_RE = re.compile(r'\b(src|href)="(/?assets/[^"?#]+)"')
+IMPORTMAP_RE = re.compile(r'(<script type="importmap">)(.*?)(</script>)', re.DOTALL)
+
+
+class Asset: # pylint: disable=too-few-public-methods
+    """A static file held in memory, with its compressed variants"""
+
+    def __init__(self, path, data, content_type):
+        self.path = path
+        self.data = data
+        self.content_type = content_type
+        self.hash = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        # Content-Encoding: data
+        self.encodings = {}
+
+    @property
+    def url(self):
+        return f"{self.path}?v={self.hash}"
+
+
+class AssetManifest:
+    """Content hashed URLs for the static files the web interface loads
+
+    Built once at startup from ``root``, without a build step: every file
+    under assets/ with a HASHED_EXTENSIONS extension is read into memory and
+    hashed. CSS url()s are rewritten to the hashed URLs of what they load,
+    and index.html's src/href attributes and import map to the hashed URLs
+    of its scripts, styles and JS modules (so relative imports between
+    modules are versioned too). The service worker is given the list of
+    hashed URLs to precache.
+
+    A request for an asset with its current hash can be cached forever;
+    anything else (ex. index.html) has to be revalidated.
+    """
+
+    def __init__(self, root, compress=False):
+        self._root = root
+        self._compress = compress
+        self._assets = {}
+
+    def __contains__(self, path):
+        return path in self._assets
+
+    def get(self, path):
+        return self._assets.get(path)
+
+    @property
+    def version(self):
+        """Hash of the whole manifest, which changes when any asset does"""
+        return self._assets[SERVICE_WORKER_PATH].hash
+
+    def url(self, path):
+        """Hashed URL of ``path``, or ``path`` if it isn't in the manifest"""
+        asset = self._assets.get(path)
+        return path if asset is None else asset.url
+
+    def build(self):
+        paths = []
+        for (dirpath, _, filenames) in os.walk(os.path.join(self._root, "assets")):
+            for filename in filenames:
+                if filename.endswith(HASHED_EXTENSIONS):
+                    paths.append("/" + os.path.relpath(os.path.join(dirpath, filename),
+                                                       self._root).replace(os.sep, "/"))
+
+        # Stylesheets last, their url()s need the hashes of what they load
+        for path in sorted(paths, key=lambda path: path.endswith(".css")):
+            if path.endswith(".css"):
+                self._add(path, self._rewrite_css(path, self._read(path)))
+            else:
+                self._add(path, self._read(path))
+
+        self._add(INDEX_PATH, self._rewrite_index(self._read(INDEX_PATH)))
+        self._add(SERVICE_WORKER_PATH, self._service_worker(self._read(SERVICE_WORKER_PATH)))
+        log.info("Static asset manifest: %d files, %d bytes, version %s",
+                 len(self._assets), sum(len(a.data) for a in self._assets.values()),
+                 self.version)
+
+    def _read(self, path):
+        with open(os.path.join(self._root, path.lstrip("/")), 'rb') as f_obj:
+            return f_obj.read()
+
+    def _add(self, path, data):
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if path.endswith(".js"):
+            content_type = "text/javascript"
+        asset = Asset(path, data, content_type)
+        if self._compress and path.endswith(COMPRESS_EXTENSIONS + (".html",)) and \
+           len(data) >= COMPRESS_MIN_SIZE:
+            asset.encodings["gzip"] = gzip.compress(data, mtime=0)
+            if brotli is not None:
+                asset.encodings["br"] = brotli.compress(data)
+        self._assets[path] = asset
+
+    def _rewrite_css(self, path, data):
+        def hashed(match):
+            (quote, url) = match.groups()
+            if url.startswith(("data:", "http:", "https:", "/")):
+                return match.group(0)
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(path),
+                                                       url.split("?")[0]))
+            if target not in self._assets:
+                return match.group(0)
+            return f"url({quote}{self._assets[target].url}{quote})"
+
+        return CSS_URL_RE.sub(hashed, data.decode()).encode()
+
+    def _rewrite_index(self, data):
+        html = HTML_URL_RE.sub(
+            lambda match: f'{match.group(1)}="{self.url("/" + match.group(2).lstrip("/"))}"',
+            data.decode())
+
+        def importmap(match):
+            imports = json.loads(match.group(2))
+            imports["imports"] = {
+                name: self.url(url) for (name, url) in imports["imports"].items()
+            }
+            # Modules import each other by relative URLs, which the import
+            # map resolves to the hashed URLs too
+            for path in sorted(self._assets):
+                if path.endswith(".js"):
+                    imports["imports"].setdefault(path, self.url(path))
+            return match.group(1) + json.dumps(imports, indent=3) + match.group(3)
+
+        return IMPORTMAP_RE.sub(importmap, html).encode()
+
+    def _service_worker(self, data):
+        precache = {
+            "version": hashlib.sha256("".join(
+                asset.url for asset in self._assets.values()
+            ).encode()).hexdigest()[:HASH_LENGTH],
+            "urls": ["/"] + [
+                self._assets[path].url for path in sorted(self._assets) if path != INDEX_PATH
+            ],
+        }
+        return f"self.PRECACHE = {json.dumps(precache)};\n".encode() + data
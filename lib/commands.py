@@ -0,0 +1,97 @@
+import asyncio
+import logging
+
+from lib.metrics import METRICS
+
+log = logging.getLogger('ibbqweb')
+
+
+COMMAND_TIMEOUT = 10    # seconds
+
+COMMANDS = METRICS.counter(
+    "ibbq_commands_total",
+    "Device commands, by result (ok, error, timeout, or coalesced into a later one)",
+    ("device", "result"))
+
+
+class CommandQueue:
+    """Commands for a device, run one at a time in the order queued
+
+    Each command is keyed by what it changes, ex. ("target", <probe>). A
+    command queued while one with the same key is still waiting replaces it,
+    so a burst of edits only sends the latest to the device; everyone who
+    queued one of them gets its result. Commands taking longer than
+    ``timeout`` seconds fail with a TimeoutError.
+    """
+
+    def __init__(self, timeout=COMMAND_TIMEOUT, device_id=""):
+        self._timeout = timeout
+        # key: (coroutine function, [futures]), in the order first queued
+        self._pending = {}
+        self._worker = None
+        self._results = {
+            result: COMMANDS.labels(device_id, result)
+            for result in ("ok", "error", "timeout", "coalesced")
+        }
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, key, func):
+        """Queue ``func()`` (a coroutine function) as ``key``
+
+        Returns a future for its result, or the result of the command that
+        replaced it.
+        """
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._retrieve)
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = (func, [future])
+        else:
+            self._results["coalesced"].inc()
+            self._pending[key] = (func, pending[1] + [future])
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self):
+        while self._pending:
+            key = next(iter(self._pending))
+            (func, futures) = self._pending.pop(key)
+            try:
+                result = await asyncio.wait_for(func(), self._timeout)
+            except asyncio.CancelledError:
+                for future in futures:
+                    future.cancel()
+                raise
+            except asyncio.TimeoutError:
+                log.warning("Command %s timed out", key)
+                self._results["timeout"].inc()
+                self._resolve(futures, exception=TimeoutError(
+                    f"No response from the device within {self._timeout}s"))
+            except Exception as ex: # pylint: disable=broad-exception-caught
+                # Passed on to whoever queued the command
+                self._results["error"].inc()
+                self._resolve(futures, exception=ex)
+            else:
+                self._results["ok"].inc()
+                self._resolve(futures, result=result)
+
+    @staticmethod
+    def _retrieve(future):
+        # Whoever queued the command may be gone (ex. its websocket closed,
+        # or a gather() already failed), so nobody else may retrieve it
+        if not future.cancelled() and future.exception() is not None:
+            log.debug("Command failed: %s", future.exception())
+
+    @staticmethod
+    def _resolve(futures, result=None, exception=None):
+        for future in futures:
+            if future.done():
+                continue
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
@@ -1,8 +1,26 @@
+import asyncio
 import json
+import logging
+import os
+import os.path
+import tempfile
+
+log = logging.getLogger('ibbqweb')
 
 DEFAULT_FILE = "/etc/ibbqweb/ibbqweb.json"
 
-class IbbqWebConfig: # pylint: disable=too-many-instance-attributes
+# Changes made within this long of each other are saved in one write
+WRITE_DELAY = 1.0   # seconds
+
+class IbbqWebConfig: # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    """Settings from the config file, plus state saved across restarts
+
+    Changes are written back to the file. While the event loop is running,
+    writes are delayed by up to WRITE_DELAY, so bursts of changes only
+    write once, and are done in a worker thread; call flush() to write any
+    pending change before exiting.
+    """
+
     def __init__(self, cfg_file=DEFAULT_FILE):
         self._cfg_file = cfg_file
         self._http_port = 8080
@@ -10,7 +28,18 @@ class IbbqWebConfig: # pylint: disable=too-many-instance-attributes
         self._tls_key = None
         self._unit = 'F'
         self._allow_poweroff = False
+        self._ws_compression = True
+        self._static_compression = False
+        self._history_dir = None
+        self._history_retention_hours = 8
+        self._devices = []
+        self._notify_coalesce_ms = 50
+        self._alert_hysteresis_c = 1.0
+        # Per device id, per probe (as a str, for JSON) target temps
+        self._target_temps = {}
         self._loaded = False
+        self._write_timer = None
+        self._writing = None
 
 
     def load(self):
@@ -23,25 +52,128 @@ class IbbqWebConfig: # pylint: disable=too-many-instance-attributes
         self._tls_key = tls.get('key', self._tls_key)
         self.unit = cfg.get('unit', self._unit)
         self._allow_poweroff = cfg.get('allow_poweroff', self._allow_poweroff)
+        compression = cfg.get('compression', {})
+        self._ws_compression = compression.get('websocket', self._ws_compression)
+        self._static_compression = compression.get('static', self._static_compression)
+        history = cfg.get('history', {})
+        self._history_dir = history.get('dir', self._history_dir)
+        self._history_retention_hours = history.get('retention_hours',
+                                                    self._history_retention_hours)
+        self._devices = cfg.get('devices', self._devices)
+        self._notify_coalesce_ms = cfg.get('notify_coalesce_ms', self._notify_coalesce_ms)
+        self._alert_hysteresis_c = cfg.get('alert_hysteresis_c', self._alert_hysteresis_c)
+        self._target_temps = cfg.get('target_temps', self._target_temps)
 
         self._loaded = True
-        self.write()
+        # Only write back if settings were missing (or invalid and changed)
+        if cfg != self._as_dict():
+            self.write()
+
+
+    def _as_dict(self):
+        return {
+            'http_port': self.http_port,
+            'tls': {
+                'cert': self.tls_cert,
+                'key': self.tls_key,
+            },
+            'unit': self.unit,
+            'allow_poweroff': self.allow_poweroff,
+            'compression': {
+                'websocket': self.ws_compression,
+                'static': self.static_compression,
+            },
+            'history': {
+                'dir': self.history_dir,
+                'retention_hours': self.history_retention_hours,
+            },
+            'devices': self.devices,
+            'notify_coalesce_ms': self.notify_coalesce_ms,
+            'alert_hysteresis_c': self.alert_hysteresis_c,
+            'target_temps': self._target_temps,
+        }
 
 
     def write(self):
+        """Write the config file now"""
+        if not self._loaded:
+            return
+
+        self._write_file(self._as_dict())
+
+
+    def _write_file(self, cfg):
+        # Write to a temporary file that replaces the config, so it is never
+        # left partly written
+        cfg_dir = os.path.dirname(os.path.abspath(self._cfg_file))
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=cfg_dir, prefix=".ibbqweb-", suffix=".tmp")
+        except PermissionError:
+            log.warning("No write access to %s, overwriting %s in place",
+                        cfg_dir, self._cfg_file)
+            with open(self._cfg_file, 'w', encoding='utf-8') as f_obj:
+                json.dump(cfg, f_obj, sort_keys=True, indent=4)
+            return
+
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f_obj:
+                json.dump(cfg, f_obj, sort_keys=True, indent=4)
+                f_obj.flush()
+                os.fsync(f_obj.fileno())
+            try:
+                os.chmod(tmp_path, os.stat(self._cfg_file).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, self._cfg_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+    def _schedule_write(self):
         if not self._loaded:
             return
 
-        with open(self._cfg_file, 'w', encoding='utf-8') as f_obj:
-            json.dump({
-                'http_port': self.http_port,
-                'tls': {
-                    'cert': self.tls_cert,
-                    'key': self.tls_key,
-                },
-                'unit': self.unit,
-                'allow_poweroff': self.allow_poweroff,
-            }, f_obj, sort_keys=True, indent=4)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write()
+            return
+
+        if self._write_timer is None:
+            self._write_timer = loop.call_later(WRITE_DELAY, self._start_write)
+
+
+    def _start_write(self):
+        self._write_timer = None
+        loop = asyncio.get_running_loop()
+        if self._writing is not None and not self._writing.done():
+            # Writes are done one at a time, so the newest is written last
+            self._write_timer = loop.call_later(WRITE_DELAY, self._start_write)
+            return
+
+        self._writing = loop.run_in_executor(None, self._write_file, self._as_dict())
+        self._writing.add_done_callback(self._write_done)
+
+
+    def _write_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Failed to write %s: %s", self._cfg_file, future.exception())
+
+
+    async def flush(self):
+        """Write any pending change now"""
+        pending = self._write_timer is not None
+        if pending:
+            self._write_timer.cancel()
+            self._write_timer = None
+        if self._writing is not None:
+            await asyncio.wait([self._writing])
+        if pending:
+            self._writing = asyncio.get_running_loop().run_in_executor(
+                None, self._write_file, self._as_dict())
+            self._writing.add_done_callback(self._write_done)
+            await asyncio.wait([self._writing])
 
 
     @property
@@ -56,7 +188,7 @@ class IbbqWebConfig: # pylint: disable=too-many-instance-attributes
 
         if http_port != self._http_port:
             self._http_port = http_port
-            self.write()
+            self._schedule_write()
 
 
     @property
@@ -81,9 +213,66 @@ class IbbqWebConfig: # pylint: disable=too-many-instance-attributes
 
         if unit != self._unit:
             self._unit = unit
-            self.write()
+            self._schedule_write()
 
 
     @property
     def allow_poweroff(self):
         return self._allow_poweroff
+
+
+    @property
+    def ws_compression(self):
+        return self._ws_compression
+
+
+    @property
+    def static_compression(self):
+        return self._static_compression
+
+
+    @property
+    def history_dir(self):
+        return self._history_dir
+
+
+    @property
+    def history_retention_hours(self):
+        return self._history_retention_hours
+
+
+    @property
+    def devices(self):
+        return self._devices
+
+
+    @property
+    def notify_coalesce_ms(self):
+        return self._notify_coalesce_ms
+
+
+    @property
+    def alert_hysteresis_c(self):
+        return self._alert_hysteresis_c
+
+
+    def target_temps(self, device_id):
+        """Saved target temps of ``device_id``, ex:
+        {<probe>: {"preset": ..., "min_temp_c": ..., "max_temp_c": ...}}"""
+        return {
+            int(probe): target_temp
+            for (probe, target_temp) in self._target_temps.get(device_id, {}).items()
+        }
+
+
+    def set_target_temps(self, device_id, target_temps):
+        saved = {str(probe): dict(target_temp) for (probe, target_temp) in target_temps.items()}
+        if saved == self._target_temps.get(device_id, {}):
+            return
+
+        self._target_temps = dict(self._target_temps)
+        if saved:
+            self._target_temps[device_id] = saved
+        else:
+            self._target_temps.pop(device_id, None)
+        self._schedule_write()
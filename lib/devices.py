@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import os.path
+import random
+import time
+
+from lib.history import HistoryLog
+from lib.ibbq import ALERT_HYSTERESIS_C, IBBQ
+from lib.metrics import METRICS
+from lib.transport import BleakTransport
+
+log = logging.getLogger('ibbqweb')
+
+
+DEFAULT_DEVICE_NAME = "iBBQ"
+SCAN_TIMEOUT = 5    # seconds
+STATUS_INTERVAL = 5 # seconds
+
+# Delay before reconnect attempt n (from 0) is a random fraction (down to
+# RECONNECT_JITTER) of RECONNECT_BACKOFF * 2^(n-1), up to RECONNECT_BACKOFF_MAX.
+# The first attempt is immediate, and reuses the device found last time;
+# after RESCAN_AFTER failed attempts the device is scanned for again.
+RECONNECT_BACKOFF = 0.5     # seconds
+RECONNECT_BACKOFF_MAX = 30  # seconds
+RECONNECT_JITTER = 0.5
+RESCAN_AFTER = 2
+
+RECONNECT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+RECONNECTS = METRICS.counter(
+    "ibbq_reconnects_total",
+    "Times the connection to a device was lost and retried",
+    ("device",))
+CONNECTED = METRICS.gauge(
+    "ibbq_connected",
+    "Whether the device is connected",
+    ("device",))
+RECONNECT_SECONDS = METRICS.histogram(
+    "ibbq_reconnect_seconds",
+    "Time from losing the connection to a device to receiving its data again",
+    ("device",),
+    buckets=RECONNECT_BUCKETS)
+
+
+def reconnect_delay(attempt, rand=random):
+    """Seconds to wait before reconnect ``attempt`` (0 for the first)"""
+    if attempt == 0:
+        return 0
+    delay = min(RECONNECT_BACKOFF * 2 ** (attempt - 1), RECONNECT_BACKOFF_MAX)
+    return delay * rand.uniform(RECONNECT_JITTER, 1)
+
+
+def device_key(device_id):
+    """``device_id`` as devices are looked up by, ex. from a query param"""
+    return device_id.casefold()
+
+
+class DeviceRegistry:
+    """The iBBQ devices served by this process
+
+    Devices are identified by their configured BLE address; with no
+    addresses configured, a single device is found by name (its id is then
+    DEFAULT_DEVICE_NAME). Ids are matched case insensitively. All devices
+    share BLE scans, so looking for several devices at once costs a single
+    scan, and each is connected and monitored concurrently with its own
+    history.
+    """
+
+    def __init__(self, addresses=None, history_dir=None, retention_ms=None, transport=None, *, # pylint: disable=too-many-arguments
+                 maxhistory=60*60*8, coalesce_window=0, alert_hysteresis_c=ALERT_HYSTERESIS_C):
+        self._transport = transport if transport is not None else BleakTransport()
+        self._devices = {}
+        # device_key(id): IBBQ
+        self._by_key = {}
+        self._history_logs = {}
+        self._scan_task = None
+
+        for address in addresses or [None]:
+            device_id = DEFAULT_DEVICE_NAME if address is None else address.upper()
+            history_log = None
+            if history_dir:
+                filename = "ibbq.hist" if address is None else \
+                           f"ibbq-{device_id.replace(':', '')}.hist"
+                history_log = HistoryLog(os.path.join(history_dir, filename), retention_ms)
+                self._history_logs[device_id] = history_log
+            ibbq = IBBQ(maxhistory, history_log, self._transport,
+                        device_id=device_id,
+                        coalesce_window=coalesce_window,
+                        alert_hysteresis_c=alert_hysteresis_c)
+            CONNECTED.labels(device_id).set_function(
+                lambda ibbq=ibbq: int(ibbq.connected))
+            self._devices[device_id] = ibbq
+            self._by_key[device_key(device_id)] = ibbq
+
+    def __iter__(self):
+        return iter(self._devices.values())
+
+    def __len__(self):
+        return len(self._devices)
+
+    def items(self):
+        return self._devices.items()
+
+    def get(self, device_id=None):
+        """Device by id, or the first device if ``device_id`` is None"""
+        if device_id is None:
+            return next(iter(self._devices.values()))
+        return self._by_key.get(device_key(device_id))
+
+    def restore_history(self):
+        for (device_id, history_log) in self._history_logs.items():
+            count = history_log.replay(self._devices[device_id].history)
+            log.info("Restored %d readings from %s", count, history_log.path)
+
+    async def _scan(self):
+        return await self._transport.discover(SCAN_TIMEOUT)
+
+    async def find_device(self, device_id):
+        """Wait for the BLE device for ``device_id`` to be seen in a scan
+
+        Concurrent callers share the same scan.
+        """
+        claimed = {
+            ibbq.address for (other_id, ibbq) in self._devices.items()
+            if other_id != device_id
+        }
+        while True:
+            if self._scan_task is None or self._scan_task.done():
+                self._scan_task = asyncio.create_task(self._scan())
+            try:
+                found = await asyncio.shield(self._scan_task)
+            except self._transport.errors as ex:
+                log.warning("BLE scan failed: %s", ex)
+                found = []
+
+            for device in found:
+                if device_id == DEFAULT_DEVICE_NAME:
+                    if device.name == DEFAULT_DEVICE_NAME and device.address not in claimed:
+                        return device
+                elif device.address.upper() == device_id:
+                    return device
+            await asyncio.sleep(1)
+
+    async def _connect(self, device_id, ibbq, attempt):
+        if ibbq.address is None or attempt >= RESCAN_AFTER:
+            # Not found yet, or maybe no longer at the cached address
+            ibbq.forget_device()
+            device = await self.find_device(device_id)
+            log.info("Found iBBQ: %s", device.address)
+            await ibbq.connect(device=device)
+        else:
+            await ibbq.connect()
+        log.info("iBBQ %s Connected", ibbq.address)
+        await ibbq.subscribe()
+
+    async def _device_manager(self, device_id, _ibbq):
+        log.info("Connecting to iBBQ %s...", device_id)
+        reconnects = RECONNECTS.labels(device_id)
+        reconnect_seconds = RECONNECT_SECONDS.labels(device_id)
+        attempt = 0
+        lost_at = None
+        while True:
+            subscribed = False
+            try:
+                await asyncio.sleep(reconnect_delay(attempt))
+                async with _ibbq as ibbq:
+                    await self._connect(device_id, ibbq, attempt)
+                    subscribed = True
+                    attempt = 0
+                    if lost_at is not None:
+                        elapsed = time.monotonic() - lost_at
+                        reconnect_seconds.observe(elapsed)
+                        log.info("Reconnected to iBBQ %s in %.2fs", device_id, elapsed)
+                        lost_at = None
+
+                    while not await ibbq.wait_disconnect(STATUS_INTERVAL):
+                        reading = ibbq.probe_reading
+                        if reading is not None:
+                            log.debug("%s Battery: %s%%", ibbq.address, str(ibbq.battery_level))
+                            log.debug("%s Probe temps: %s", ibbq.address, ", ".join(
+                                f"{temp}{'' if temp is None else 'C'}"
+                                for temp in reading["probes"]
+                            ))
+                    raise ConnectionError(f"Disconnected from iBBQ {ibbq.address}")
+            except asyncio.CancelledError:
+                return
+            except (ConnectionError, asyncio.TimeoutError) as ex:
+                reconnects.inc()
+                if subscribed:
+                    lost_at = time.monotonic()
+                else:
+                    attempt += 1
+                log.warning("Reconnecting to iBBQ %s (%s)...", device_id, ex)
+
+    async def run(self):
+        tasks = [
+            self._device_manager(device_id, ibbq)
+            for (device_id, ibbq) in self._devices.items()
+        ]
+        tasks += [
+            history_log.run(self._devices[device_id].history)
+            for (device_id, history_log) in self._history_logs.items()
+        ]
+        await asyncio.gather(*tasks)
@@ -0,0 +1,518 @@
+import array
+import asyncio
+import datetime
+import logging
+import os
+import secrets
+import struct
+import time
+
+log = logging.getLogger('ibbqweb')
+
+
+# Raw probe temperatures are stored as int16 in 10^-1 Celcius, the same
+# encoding the device uses over BLE. NO_PROBE marks a disconnected probe.
+NO_PROBE = -0x8000
+
+HISTORY_LOG_MAGIC = b"IBBQHST1"
+HISTORY_LOG_HEADER = struct.Struct("<8sB")     # magic, nprobes
+FLUSH_INTERVAL = 5      # seconds
+FSYNC_INTERVAL = 60     # seconds
+
+# (bucket width, fraction of the history capacity) for each aggregate level
+AGGREGATE_LEVELS = (
+    (10 * 1000, 4),
+    (60 * 1000, 16),
+)
+
+
+def raw_to_tempc(raw_temp):
+    return None if raw_temp == NO_PROBE else raw_temp / 10
+
+
+def ms_to_datetime(ts_ms):
+    return datetime.datetime.fromtimestamp(ts_ms / 1000)
+
+
+class HistoryAggregate: # pylint: disable=too-many-instance-attributes
+    """Ring buffer of fixed-width time buckets of probe readings
+
+    Each bucket holds the per-probe min, max and last temperature of the
+    readings that fell into it, along with the timestamp of the last one.
+    Buckets are updated incrementally as readings arrive.
+    """
+
+    def __init__(self, bucket_ms, maxlen):
+        self._bucket_ms = bucket_ms
+        self._maxlen = maxlen
+        self._nprobes = 0
+        self._bucket = array.array('q', bytes(8 * maxlen))     # ts // bucket_ms
+        self._last_ts = array.array('q', bytes(8 * maxlen))
+        self._min = array.array('h')
+        self._max = array.array('h')
+        self._last = array.array('h')
+        self._head = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def bucket_ms(self):
+        return self._bucket_ms
+
+    @property
+    def nbytes(self):
+        """Memory used by the (preallocated) buckets"""
+        return sum(
+            len(column) * column.itemsize
+            for column in (self._bucket, self._last_ts, self._min, self._max, self._last)
+        )
+
+    def reset(self, nprobes):
+        self._nprobes = nprobes
+        self._min = array.array('h', bytes(2 * self._maxlen * nprobes))
+        self._max = array.array('h', bytes(2 * self._maxlen * nprobes))
+        self._last = array.array('h', bytes(2 * self._maxlen * nprobes))
+        self._head = 0
+        self._len = 0
+
+    def add(self, ts_ms, raw_temps):
+        bucket = ts_ms // self._bucket_ms
+        if self._len and self._bucket[(self._head + self._len - 1) % self._maxlen] == bucket:
+            slot = (self._head + self._len - 1) % self._maxlen
+            offset = slot * self._nprobes
+            for (i, raw_temp) in enumerate(raw_temps, offset):
+                if raw_temp != NO_PROBE:
+                    if self._min[i] == NO_PROBE or raw_temp < self._min[i]:
+                        self._min[i] = raw_temp
+                    if self._max[i] == NO_PROBE or raw_temp > self._max[i]:
+                        self._max[i] = raw_temp
+            self._last_ts[slot] = ts_ms
+            self._last[offset:offset + self._nprobes] = raw_temps
+            return
+
+        if self._len < self._maxlen:
+            slot = (self._head + self._len) % self._maxlen
+            self._len += 1
+        else:
+            slot = self._head
+            self._head = (self._head + 1) % self._maxlen
+
+        offset = slot * self._nprobes
+        self._bucket[slot] = bucket
+        self._last_ts[slot] = ts_ms
+        self._min[offset:offset + self._nprobes] = raw_temps
+        self._max[offset:offset + self._nprobes] = raw_temps
+        self._last[offset:offset + self._nprobes] = raw_temps
+
+    def buckets(self, from_ms=None, to_ms=None):
+        """Iterate over (last_ts_ms, raw_min, raw_max, raw_last) for each bucket
+
+        Only buckets whose last reading is within [from_ms, to_ms) are
+        included.
+        """
+        n = self._nprobes
+        for i in range(self._len):
+            slot = (self._head + i) % self._maxlen
+            last_ts_ms = self._last_ts[slot]
+            if from_ms is not None and last_ts_ms < from_ms:
+                continue
+            if to_ms is not None and last_ts_ms >= to_ms:
+                break
+            offset = slot * n
+            yield (last_ts_ms,
+                   self._min[offset:offset + n],
+                   self._max[offset:offset + n],
+                   self._last[offset:offset + n])
+
+
+class ProbeHistory: # pylint: disable=too-many-instance-attributes
+    """Fixed-capacity, run-length encoded ring buffer of probe readings
+
+    Consecutive readings with identical temperatures collapse into a single
+    run holding the timestamps of the first and last reading, which is all
+    that is needed to draw a straight line. Timestamps are kept as int64
+    epoch milliseconds and temperatures as a flat int16 column (``nprobes``
+    values per run), so appending or extending a run is O(1) and a full
+    history is a handful of preallocated arrays.
+
+    Coarser HistoryAggregate levels (see AGGREGATE_LEVELS) are maintained
+    alongside the runs, for serving long histories at a lower resolution.
+
+    Every run is assigned a monotonically increasing id, which lets clients
+    track how much of the history they have already seen. Ids are only
+    meaningful within the same ``epoch``, which changes whenever the history
+    is cleared.
+    """
+
+    def __init__(self, maxlen):
+        self._maxlen = maxlen
+        self._nprobes = 0
+        self._start = array.array('q', bytes(8 * maxlen))
+        self._end = array.array('q', bytes(8 * maxlen))
+        self._temps = array.array('h')
+        self._last = array.array('h')   # temps of the newest run
+        self._head = 0      # slot of the oldest run
+        self._len = 0
+        self._epoch = secrets.token_hex(4)
+        self._next_id = 1
+        self._aggregates = [
+            HistoryAggregate(bucket_ms, max(1, maxlen // fraction))
+            for (bucket_ms, fraction) in AGGREGATE_LEVELS
+        ]
+
+    def __len__(self):
+        """Number of runs (not readings) in the history"""
+        return self._len
+
+    def __iter__(self):
+        """Iterate over readings, expanding each run to its first/last reading"""
+        for (_, start_ms, end_ms, raw_temps) in self.runs():
+            probes = [raw_to_tempc(t) for t in raw_temps]
+            yield {
+                'timestamp': ms_to_datetime(start_ms),
+                'probes': probes,
+            }
+            if end_ms != start_ms:
+                yield {
+                    'timestamp': ms_to_datetime(end_ms),
+                    'probes': list(probes),
+                }
+
+    @property
+    def maxlen(self):
+        return self._maxlen
+
+    @property
+    def nprobes(self):
+        return self._nprobes
+
+    @property
+    def aggregates(self):
+        """HistoryAggregate levels, finest first"""
+        return self._aggregates
+
+    @property
+    def nbytes(self):
+        """Memory used by the (preallocated) runs and aggregates"""
+        return sum(
+            len(column) * column.itemsize
+            for column in (self._start, self._end, self._temps)
+        ) + sum(aggregate.nbytes for aggregate in self._aggregates)
+
+    @property
+    def epoch(self):
+        return self._epoch
+
+    @property
+    def first_id(self):
+        """Id of the oldest run (or of the next run, if empty)"""
+        return self._next_id - self._len
+
+    @property
+    def last_id(self):
+        """Id of the newest run (or of the last run before it was emptied)"""
+        return self._next_id - 1
+
+    @property
+    def start_ms(self):
+        """Timestamp of the oldest reading"""
+        return self._start[self._head] if self._len else None
+
+    @property
+    def end_ms(self):
+        """Timestamp of the newest reading"""
+        return self._end[self._slot(self._len - 1)] if self._len else None
+
+    def _slot(self, idx):
+        return (self._head + idx) % self._maxlen
+
+    def _raw_temps(self, slot):
+        offset = slot * self._nprobes
+        return self._temps[offset:offset + self._nprobes]
+
+    def _reset(self, nprobes):
+        if self._len:
+            log.info("Probe count changed from %d to %d, clearing history",
+                     self._nprobes, nprobes)
+        self._nprobes = nprobes
+        self._temps = array.array('h', bytes(2 * self._maxlen * nprobes))
+        self._last = array.array('h')
+        self._head = 0
+        self._len = 0
+        self._epoch = secrets.token_hex(4)
+        for aggregate in self._aggregates:
+            aggregate.reset(nprobes)
+
+    def find_id(self, ts_ms):
+        """Id of the oldest run ending at or after ``ts_ms``"""
+        (low, high) = (0, self._len)
+        while low < high:
+            mid = (low + high) // 2
+            if self._end[self._slot(mid)] < ts_ms:
+                low = mid + 1
+            else:
+                high = mid
+        return self.first_id + low
+
+    def run_end_ms(self, run_id):
+        return self._end[self._slot(run_id - self.first_id)]
+
+    def runs(self, since_id=None):
+        """Iterate over (run_id, start_ms, end_ms, raw_temps) for each run
+
+        If ``since_id`` is given, only runs with an id >= ``since_id`` are
+        included.
+        """
+        first_id = self.first_id
+        start = 0 if since_id is None else max(0, since_id - first_id)
+        for i in range(start, self._len):
+            slot = self._slot(i)
+            yield (first_id + i, self._start[slot], self._end[slot], self._raw_temps(slot))
+
+    def snapshot(self):
+        """Copy of the runs, oldest first, as (nprobes, start_ms, end_ms, raw_temps)
+
+        ``start_ms`` and ``end_ms`` are int64 arrays with a value per run,
+        and ``raw_temps`` an int16 array with ``nprobes`` values per run.
+        Only array copies, so it is cheap enough to take on the event loop.
+        """
+        def ordered(column, width):
+            head = self._head * width
+            end = head + self._len * width
+            if end <= len(column):
+                return column[head:end]
+            return column[head:] + column[:end - len(column)]
+
+        return (self._nprobes,
+                ordered(self._start, 1),
+                ordered(self._end, 1),
+                ordered(self._temps, self._nprobes))
+
+    @property
+    def last_raw_temps(self):
+        """Raw temps of the newest run (empty if there is none)"""
+        return self._last if self._len else array.array('h')
+
+    def last_reading(self):
+        if not self._len:
+            return None
+        return {
+            'timestamp': ms_to_datetime(self.end_ms),
+            'probes': [raw_to_tempc(t) for t in self._last],
+        }
+
+    def append(self, ts_ms, raw_temps):
+        """Add a reading, extending the newest run if the temps are unchanged
+
+        Returns True if a new run was started. Once at capacity, starting a
+        new run drops the oldest.
+        """
+        raw_temps = array.array('h', raw_temps)
+        if self._len and raw_temps == self._last:
+            self._end[self._slot(self._len - 1)] = ts_ms
+            for aggregate in self._aggregates:
+                aggregate.add(ts_ms, raw_temps)
+            return False
+
+        if len(raw_temps) != self._nprobes:
+            self._reset(len(raw_temps))
+
+        if self._len < self._maxlen:
+            slot = self._slot(self._len)
+            self._len += 1
+        else:
+            slot = self._head
+            self._head = (self._head + 1) % self._maxlen
+
+        self._start[slot] = ts_ms
+        self._end[slot] = ts_ms
+        offset = slot * self._nprobes
+        self._temps[offset:offset + self._nprobes] = raw_temps
+        self._last = raw_temps
+        self._next_id += 1
+        for aggregate in self._aggregates:
+            aggregate.add(ts_ms, raw_temps)
+        return True
+
+    def clear(self):
+        self._last = array.array('h')
+        self._head = 0
+        self._len = 0
+        self._epoch = secrets.token_hex(4)
+        for aggregate in self._aggregates:
+            aggregate.reset(self._nprobes)
+
+
+class HistoryLog: # pylint: disable=too-many-instance-attributes
+    """Append-only on-disk log of probe readings
+
+    The file is a header followed by fixed size records of an int64 epoch ms
+    timestamp and one int16 per probe, so it can be replayed with a single
+    read. Readings are buffered in memory and appended every FLUSH_INTERVAL
+    seconds, with an fsync at most every FSYNC_INTERVAL seconds; a torn
+    record at the end of the file after a crash is ignored.
+
+    Since every reading is logged, the file is periodically compacted by
+    atomically rewriting it from the run-length encoded ProbeHistory. Only
+    a snapshot of the history is taken on the event loop; it is encoded and
+    written in a worker thread. Buffered readings are kept until the write
+    that saves them completes.
+    """
+
+    def __init__(self, path, retention_ms):
+        self._path = path
+        self._retention_ms = retention_ms
+        self._record = None
+        self._buf = bytearray()
+        self._rewrite = True    # rewrite the file from history on next flush
+        self._records = 0       # records appended since the last rewrite
+        self._file = None
+        self._last_fsync = 0
+        self._writing = None    # worker thread write in progress
+        self._generation = 0    # bumped by clear(), so a write in progress doesn't undo it
+
+    @property
+    def path(self):
+        return self._path
+
+    def _min_ts_ms(self):
+        return int(time.time() * 1000) - self._retention_ms
+
+    def replay(self, history):
+        """Load readings newer than the retention period into ``history``"""
+        try:
+            with open(self._path, 'rb') as f_obj:
+                data = f_obj.read()
+        except FileNotFoundError:
+            return 0
+
+        if len(data) < HISTORY_LOG_HEADER.size:
+            return 0
+        (magic, nprobes) = HISTORY_LOG_HEADER.unpack_from(data)
+        if magic != HISTORY_LOG_MAGIC:
+            log.warning("Ignoring history log with unknown format: %s", self._path)
+            return 0
+
+        record = struct.Struct(f"<q{nprobes}h")
+        end = len(data) - (len(data) - HISTORY_LOG_HEADER.size) % record.size
+        min_ts_ms = self._min_ts_ms()
+        count = 0
+        for (ts_ms, *raw_temps) in record.iter_unpack(
+                memoryview(data)[HISTORY_LOG_HEADER.size:end]):
+            if ts_ms >= min_ts_ms:
+                history.append(ts_ms, raw_temps)
+                count += 1
+        return count
+
+    def append(self, ts_ms, raw_temps):
+        if self._record is None or len(raw_temps) != (self._record.size - 8) // 2:
+            # New probe count, so the history restarts as well
+            self._record = struct.Struct(f"<q{len(raw_temps)}h")
+            self.clear()
+        self._buf += self._record.pack(ts_ms, *raw_temps)
+
+    def clear(self):
+        self._buf.clear()
+        self._rewrite = True
+        self._generation += 1
+
+    async def run(self, history):
+        try:
+            while True:
+                await asyncio.sleep(FLUSH_INTERVAL)
+                await self.flush(history)
+        except asyncio.CancelledError:
+            await self.flush(history)
+            await asyncio.to_thread(self._close)
+
+    async def flush(self, history):
+        if self._writing is not None:
+            # A write whose flush() was cancelled may still be running
+            await asyncio.wait([self._writing])
+
+        generation = self._generation
+        if self._rewrite or self._records > history.maxlen:
+            buffered = len(self._buf)
+
+            def rewritten():
+                if generation == self._generation:
+                    self._rewrite = False
+                    self._records = 0
+                    del self._buf[:buffered]
+
+            await self._write(rewritten, self._write_compacted,
+                              history.snapshot(), self._min_ts_ms())
+        elif self._buf:
+            data = bytes(self._buf)
+
+            def appended():
+                if generation == self._generation:
+                    del self._buf[:len(data)]
+                    self._records += len(data) // self._record.size
+
+            await self._write(appended, self._append_file, data)
+
+    async def _write(self, done, func, *args):
+        """Run ``func(*args)`` in a worker thread, then ``done()`` if it succeeded
+
+        The write carries on if the caller is cancelled, and ``done()`` is
+        still called once it completes.
+        """
+        def write_done(task):
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                log.warning("Failed to write history log %s: %s", self._path, task.exception())
+                return
+            done()
+
+        self._writing = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        self._writing.add_done_callback(write_done)
+        try:
+            await asyncio.shield(self._writing)
+        except OSError:
+            pass    # Logged by write_done()
+
+    def _write_compacted(self, snapshot, min_ts_ms):
+        self._write_file(self._compact(snapshot, min_ts_ms))
+
+    @staticmethod
+    def _compact(snapshot, min_ts_ms):
+        (nprobes, starts, ends, temps) = snapshot
+        record = struct.Struct(f"<q{nprobes}h")
+        data = bytearray(HISTORY_LOG_HEADER.pack(HISTORY_LOG_MAGIC, nprobes))
+        for (i, (start_ms, end_ms)) in enumerate(zip(starts, ends)):
+            if end_ms < min_ts_ms:
+                continue
+            raw_temps = temps[i * nprobes:(i + 1) * nprobes]
+            data += record.pack(start_ms, *raw_temps)
+            if end_ms != start_ms:
+                data += record.pack(end_ms, *raw_temps)
+        return data
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _append_file(self, data):
+        if self._file is None:
+            self._file = open(self._path, 'ab') # pylint: disable=consider-using-with
+        self._file.write(data)
+        self._file.flush()
+        if time.monotonic() - self._last_fsync >= FSYNC_INTERVAL:
+            os.fsync(self._file.fileno())
+            self._last_fsync = time.monotonic()
+
+    def _write_file(self, data):
+        self._close()
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, 'wb') as f_obj:
+            f_obj.write(data)
+            f_obj.flush()
+            os.fsync(f_obj.fileno())
+        os.replace(tmp_path, self._path)
+        self._last_fsync = time.monotonic()
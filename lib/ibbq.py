@@ -1,18 +1,29 @@
 import asyncio
-import collections
 import datetime
 import enum
 import logging
 import struct
+import time
 from uuid import UUID
 
-import bleak
+from lib.commands import CommandQueue
+from lib.history import NO_PROBE, ProbeHistory, raw_to_tempc
+from lib.metrics import METRICS
+from lib.predict import CookPredictor
+from lib.transport import BleakTransport
 
 log = logging.getLogger('ibbqweb')
 
 
 ALARM_SILENCE_TIMEOUT = 5 * 60  # seconds. device uses 5 min so we will too
 
+# An alert only clears once the temp is back inside the target by this much
+ALERT_HYSTERESIS_C = 1.0
+
+# Target temps the device accepts, in Celcius; its unset min/max are the ends
+TARGET_TEMP_MIN_C = -300.0
+TARGET_TEMP_MAX_C = 302.0
+
 class Characteristics(enum.IntEnum):
     SETTINGS_NOTIFY         = 0xfff1    # Subscribe
     PAIR                    = 0xfff2    # Write
@@ -37,29 +48,147 @@ class SettingsData(enum.Enum):
     UNKNOWN2            = b"\xff\x01\x00\x00\x00\x00" # Unused in app
 
 
+# Decoders of REALTIME_TEMP_NOTIFY data, by length
+TEMPS_STRUCTS = {}
+
+SERVICE_UUID = "0000fff0-0000-1000-8000-00805f9b34fb"
+
 PAIR_KEY = b"\x21\x07\x06\x05\x04\x03\x02\x01\xb8\x22\x00\x00\x00\x00\x00"
 
+NOTIFICATIONS = METRICS.counter(
+    "ibbq_notifications_total",
+    "Temperature notifications received",
+    ("device",))
+NOTIFICATIONS_DEDUPLICATED = METRICS.counter(
+    "ibbq_notifications_deduplicated_total",
+    "Temperature notifications that only extended the current history run",
+    ("device",))
+NOTIFY_SECONDS = METRICS.histogram(
+    "ibbq_notify_seconds",
+    "Time spent handling a temperature notification",
+    ("device",))
+HISTORY_RUNS = METRICS.gauge(
+    "ibbq_history_runs",
+    "Runs of identical readings in the history",
+    ("device",))
+HISTORY_BYTES = METRICS.gauge(
+    "ibbq_history_bytes",
+    "Estimated memory used by the history",
+    ("device",))
+PROBE_TEMPS = METRICS.gauge(
+    "ibbq_probe_temperature_celsius",
+    "Latest probe temperature, left out while the probe is unplugged",
+    ("device", "probe"))
+
+
+class ChangeNotifier:
+    """Versioned change broadcast
+
+    Every notify() bumps a version counter and wakes all waiters. Waiters
+    ask for anything newer than the version they last handled, so changes
+    made while they were busy are never missed.
+
+    Frequent changes (ex. readings) can be coalesced: they are published
+    together, at most ``coalesce_window`` seconds after the first of them.
+    """
+
+    def __init__(self, coalesce_window=0):
+        self._version = 0
+        self._waiters = set()
+        self._coalesce_window = coalesce_window
+        self._pending = None
+
+    @property
+    def version(self):
+        return self._version
+
+    def notify(self, coalesce=False):
+        if coalesce and self._coalesce_window > 0:
+            if self._pending is None:
+                self._pending = asyncio.get_running_loop().call_later(
+                    self._coalesce_window, self._publish)
+            return
+        self._publish()
+
+    def _publish(self):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+        self._version += 1
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def wait(self, version):
+        """Wait for a version newer than ``version``, and return it"""
+        while self._version <= version:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.add(waiter)
+            try:
+                await waiter
+            finally:
+                self._waiters.discard(waiter)
+        return self._version
+
 
-class IBBQ: # pylint: disable=too-many-instance-attributes
-    def __init__(self, maxhistory=60*60*8):
+class IBBQ: # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    def __init__(self, maxhistory=60*60*8, history_log=None, transport=None, *, # pylint: disable=too-many-arguments
+                 device_id="", coalesce_window=0, alert_hysteresis_c=ALERT_HYSTERESIS_C):
+        self._device_id = device_id
+        self._transport = transport if transport is not None else BleakTransport()
         self._celcius = False
         self._device = None
         self._characteristics = {}
-        self._readings = collections.deque(maxlen=maxhistory) # temps stored in celcius
+        self._readings = ProbeHistory(maxhistory) # temps stored in celcius
+        self._history_log = history_log
         self._target_temps = {}
+        # Per probe (raw min or None, raw max or None) of the target temps
+        self._alert_limits = {}
+        # Per probe ("high" or "low", since ts_ms) of probes outside their target
+        self._probe_alerts = {}
+        self._alert_hysteresis = round(alert_hysteresis_c * 10)
+        self._predictor = CookPredictor()
         self._silence_temp_alert_until = datetime.datetime.now()
         self._cur_battery_level = None
         self._client = None
-        self._change_event = asyncio.Event()
+        self._disconnected = asyncio.Event()
+        self._disconnected.set()
+        self._changes = ChangeNotifier(coalesce_window)
+        self._commands = CommandQueue(device_id=device_id)
+
+        self._notifications = NOTIFICATIONS.labels(device_id)
+        self._notifications_deduplicated = NOTIFICATIONS_DEDUPLICATED.labels(device_id)
+        self._notify_seconds = NOTIFY_SECONDS.labels(device_id)
+        HISTORY_RUNS.labels(device_id).set_function(lambda: len(self._readings))
+        HISTORY_BYTES.labels(device_id).set_function(lambda: self._readings.nbytes)
+        # Probes with a temperature gauge, added as the device reports them
+        self._probe_gauges = 0
 
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, *excinfo):
+        # The BLE device is kept, so reconnecting doesn't need another scan
         if self._client is not None:
             await self._client.disconnect()
             self._client = None
-            self._device = None
+            self._disconnected.set()
+
+    def forget_device(self):
+        """Drop the cached BLE device, ex. if it can no longer be connected to"""
+        self._device = None
+        self._characteristics = {}
+
+    @property
+    def device_id(self):
+        """Name of this device in metrics, and in the DeviceRegistry"""
+        return self._device_id
+
+    @property
+    def commands(self):
+        """Queue for commands from web clients, see CommandQueue"""
+        return self._commands
 
     @property
     def address(self):
@@ -73,11 +202,18 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
     def connected(self):
         return self._client is not None and bool(self._client.is_connected)
 
+    @property
+    def num_probes(self):
+        """Probes in the device's readings (0 before the first reading)"""
+        return len(self._readings.last_raw_temps)
+
     @property
     def probe_reading(self):
-        if len(self._readings):
-            return self._readings[-1]
-        return None
+        return self._readings.last_reading()
+
+    @property
+    def history(self):
+        return self._readings
 
     @property
     def probe_readings_all(self):
@@ -86,7 +222,7 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
     @property
     def probe_readings_since(self):
         if len(self._readings):
-            return self._readings[0]['timestamp'].timestamp()
+            return self._readings.start_ms / 1000
         return 0.0
 
     @property
@@ -95,39 +231,74 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
 
     @property
     def target_temp_alert(self):
-        if (
-            datetime.datetime.now() < self._silence_temp_alert_until or
-            self.probe_reading is None
-        ):
-            return False
+        return (
+            bool(self._probe_alerts) and
+            datetime.datetime.now() >= self._silence_temp_alert_until
+        )
 
-        probe_readings = list(self.probe_reading['probes'])
-        for (probe, target_temp) in self._target_temps.items():
-            if probe_readings[probe] is None:
-                # Probe disconnected
-                continue
+    @property
+    def probe_alerts(self):
+        """Probes outside their target temps, ex: {0: {"state": "high", "since": <ms>}}
 
-            if probe_readings[probe] >= target_temp['max_temp_c']:
-                return True
+        The dict is replaced (never modified) when an alert starts or ends.
+        """
+        return self._probe_alerts
 
-            if (
-                target_temp['min_temp_c'] is not None and
-                probe_readings[probe] <= target_temp['min_temp_c']
-            ):
-                return True
+    @property
+    def predictions(self):
+        """Per probe rate of change and time to target, see CookPredictor"""
+        return self._predictor.predictions(self._alert_limits)
+
+    def _alert_state(self, state, raw_temp, limits):
+        """New alert state of a probe, given its current ``state``"""
+        (raw_min, raw_max) = limits
+        if raw_temp == NO_PROBE:
+            return None
+        if raw_max is not None and (
+                raw_temp >= raw_max or
+                (state == "high" and raw_temp > raw_max - self._alert_hysteresis)):
+            return "high"
+        if raw_min is not None and (
+                raw_temp <= raw_min or
+                (state == "low" and raw_temp < raw_min + self._alert_hysteresis)):
+            return "low"
+        return None
 
-        return False
+    def _update_alerts(self, ts_ms, raw_temps):
+        """Update the probe alerts from a reading, returning True if any changed"""
+        alerts = None
+        for (probe, limits) in self._alert_limits.items():
+            alert = self._probe_alerts.get(probe)
+            state = alert["state"] if alert is not None else None
+            raw_temp = raw_temps[probe] if probe < len(raw_temps) else NO_PROBE
+            new_state = self._alert_state(state, raw_temp, limits)
+            if new_state != state:
+                if alerts is None:
+                    alerts = dict(self._probe_alerts)
+                if new_state is None:
+                    del alerts[probe]
+                else:
+                    alerts[probe] = {"state": new_state, "since": ts_ms}
+
+        if alerts is None:
+            return False
+        self._probe_alerts = alerts
+        return True
 
     @property
     def battery_level(self):
         return self._cur_battery_level
 
-    def _notify_change(self):
-        self._change_event.set()
-        self._change_event.clear()
+    @property
+    def change_version(self):
+        return self._changes.version
+
+    def _notify_change(self, coalesce=False):
+        self._changes.notify(coalesce)
 
-    async def await_change(self):
-        await self._change_event.wait()
+    async def await_change(self, version):
+        """Wait for a change newer than ``version``, and return its version"""
+        return await self._changes.wait(version)
 
     async def _write_gatt_char(self, char, data, response=False):
         try:
@@ -136,40 +307,62 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
                 data,
                 response=response,
             )
-        except bleak.exc.BleakDBusError as ex:
+        except self._transport.errors as ex:
             raise ConnectionError("Failed to write gatt char") from ex
 
     def _cb_disconnect(self, client):
+        self._disconnected.set()
         self._notify_change()
 
-    async def connect(self, address=None):
+    async def wait_disconnect(self, timeout=None):
+        """Wait up to ``timeout`` seconds for a disconnect, returning True if so"""
+        try:
+            await asyncio.wait_for(self._disconnected.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return not self.connected
+
+    async def connect(self, address=None, device=None):
+        """Connect to ``device`` (a BLEDevice from a scan), or the device
+        connected to last time, or else scan for ``address``, or the first
+        iBBQ found if that is None too"""
+        if device is not None:
+            if self._device is not None and self._device.address != device.address:
+                self._characteristics = {}
+            self._device = device
         if self._device is None:
             if address is None:
                 while self._device is None:
-                    self._device = await bleak.BleakScanner.find_device_by_name("iBBQ")
+                    self._device = await self._transport.find_device_by_name("iBBQ")
                     if self._device is None:
                         await asyncio.sleep(1)
                 log.info("Found iBBQ: %s", self._device.address)
             else:
-                self._device = await bleak.BleakScanner.find_device_by_address(address)
+                self._device = await self._transport.find_device_by_address(address)
                 if self._device is None:
                     raise ValueError(f"Device with address {address} not found")
         elif address is not None and self._device.address != address:
             raise NotImplementedError("Changing BLE address not supported")
 
-        self._client = bleak.BleakClient(self._device, disconnected_callback=self._cb_disconnect)
+        # Only the iBBQ service needs discovering
+        self._client = self._transport.client(self._device, self._cb_disconnect,
+                                              services=[SERVICE_UUID])
+        self._disconnected.clear()
         try:
             await self._client.connect()
-        except bleak.exc.BleakError as ex:
+        except self._transport.errors as ex:
+            self._disconnected.set()
             raise ConnectionError("Failure to connect to device") from ex
 
         await self._init_client()
 
     async def _init_client(self):
-        log.debug("Discovered characteristics:")
+        if not self._characteristics:
+            log.debug("Discovered characteristics:")
         for characteristic in self._client.services.characteristics.values():
             # Time portion of UUID is characteristic key
-            log.debug(characteristic)
+            if not self._characteristics:
+                log.debug(characteristic)
             char_uuid = UUID(characteristic.uuid)
             self._characteristics[char_uuid.time] = characteristic
 
@@ -179,17 +372,20 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
             response=True,
         )
 
-        # Sync settings to device
-        if self._celcius:
-            await self._set_unit(SettingsData.SET_UNIT_CELCIUS.value)
-        else:
-            await self._set_unit(SettingsData.SET_UNIT_FARENHEIT.value)
-
-        for (probe, target_temp) in self._target_temps.items():
-            await self.set_probe_target_temp(probe,
-                                             target_temp['preset'],
-                                             target_temp['min_temp_c'],
-                                             target_temp['max_temp_c'])
+        # Sync settings to device. These writes don't depend on each other, so
+        # they're sent without waiting for each in turn
+        settings = [
+            SettingsData.SET_UNIT_CELCIUS.value if self._celcius else
+            SettingsData.SET_UNIT_FARENHEIT.value
+        ]
+        settings += [
+            self._target_temp_data(probe, target_temp['min_temp_c'], target_temp['max_temp_c'])
+            for (probe, target_temp) in self._target_temps.items()
+        ]
+        await asyncio.gather(*(
+            self._write_gatt_char(Characteristics.SETTINGS_UPDATE, data)
+            for data in settings
+        ))
 
         self._notify_change()
 
@@ -197,28 +393,24 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
         if not self.connected:
             raise ConnectionError("Device not connected")
 
-        await self._client.start_notify(
-            self._characteristics[Characteristics.REALTIME_TEMP_NOTIFY.value],
-            self._cb_realtime_temp_notify
-        )
-        await self._write_gatt_char(
-            Characteristics.SETTINGS_UPDATE,
-            SettingsData.ENABLE_REALTIME_DATA.value,
-        )
-
-        await self._client.start_notify(
-            self._characteristics[Characteristics.SETTINGS_NOTIFY.value],
-            self._cb_settings_notify
-        )
-        await self._write_gatt_char(
-            Characteristics.SETTINGS_UPDATE,
-            SettingsData.ENABLE_BATTERY_DATA.value,
-        )
-
-        await self._write_gatt_char(
-            Characteristics.SETTINGS_UPDATE,
-            SettingsData.UNKNOWN1.value,
+        await asyncio.gather(
+            self._client.start_notify(
+                self._characteristics[Characteristics.REALTIME_TEMP_NOTIFY.value],
+                self._cb_realtime_temp_notify
+            ),
+            self._client.start_notify(
+                self._characteristics[Characteristics.SETTINGS_NOTIFY.value],
+                self._cb_settings_notify
+            ),
         )
+        await asyncio.gather(*(
+            self._write_gatt_char(Characteristics.SETTINGS_UPDATE, data)
+            for data in (
+                SettingsData.ENABLE_REALTIME_DATA.value,
+                SettingsData.ENABLE_BATTERY_DATA.value,
+                SettingsData.UNKNOWN1.value,
+            )
+        ))
 
 
     async def _set_unit(self, data):
@@ -233,49 +425,75 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
 
     async def set_unit_celcius(self):
         self._celcius = True
-        try:
-            await self._set_unit(SettingsData.SET_UNIT_CELCIUS.value)
-        except ConnectionError:
-            pass
+        await self._set_unit(SettingsData.SET_UNIT_CELCIUS.value)
 
     async def set_unit_farenheit(self):
         self._celcius = False
-        try:
-            await self._set_unit(SettingsData.SET_UNIT_FARENHEIT.value)
-        except ConnectionError:
-            pass
-
-    async def set_probe_target_temp(self, probe, preset, min_temp_c, max_temp_c):
-        if not self.connected:
-            raise ConnectionError("Device not connected")
+        await self._set_unit(SettingsData.SET_UNIT_FARENHEIT.value)
 
+    @staticmethod
+    def _target_temp_data(probe, min_temp_c, max_temp_c):
         # device uses temp * 10, with extreems if not set
-        dev_min_temp_c = int(min_temp_c * 10) if min_temp_c else  -3000
-        dev_max_temp_c = int(max_temp_c * 10) if max_temp_c else 3020
+        dev_min_temp_c = int((min_temp_c or TARGET_TEMP_MIN_C) * 10)
+        dev_max_temp_c = int((max_temp_c or TARGET_TEMP_MAX_C) * 10)
 
         # See SettingsData.SET_TARGET_TEMP
-        data = b"\x01" + struct.pack("<Bhh", probe, dev_min_temp_c,
-                                     dev_max_temp_c)
+        return b"\x01" + struct.pack("<Bhh", probe, dev_min_temp_c, dev_max_temp_c)
+
+    async def set_probe_target_temp(self, probe, preset, min_temp_c, max_temp_c):
+        if not self.connected:
+            raise ConnectionError("Device not connected")
 
         await self._write_gatt_char(
             Characteristics.SETTINGS_UPDATE,
-            data,
+            self._target_temp_data(probe, min_temp_c, max_temp_c),
         )
+        self._store_target_temp(probe, preset, min_temp_c, max_temp_c)
+        self._notify_change()
+
+    def restore_unit(self, unit):
+        """Set the unit ('C' or 'F') saved by a previous run
+
+        It is sent to the device when it connects.
+        """
+        self._celcius = unit == 'C'
+        self._notify_change()
 
+    def restore_target_temps(self, target_temps):
+        """Set target temps saved by a previous run, ex:
+        {0: {"preset": None, "min_temp_c": None, "max_temp_c": 63.0}}
+
+        They are sent to the device when it connects.
+        """
+        for (probe, target_temp) in target_temps.items():
+            self._store_target_temp(probe,
+                                    target_temp.get('preset'),
+                                    target_temp.get('min_temp_c'),
+                                    target_temp.get('max_temp_c'))
+        self._notify_change()
+
+    def _store_target_temp(self, probe, preset, min_temp_c, max_temp_c):
         if preset is None and min_temp_c is None and max_temp_c is None:
-            try:
-                del self._target_temps[probe]
-            except KeyError:
-                pass
+            self._target_temps.pop(probe, None)
+            self._alert_limits.pop(probe, None)
         else:
             self._target_temps[probe] = {
                 "preset": preset,
                 "min_temp_c": min_temp_c,
                 "max_temp_c": max_temp_c,
             }
+            self._alert_limits[probe] = (
+                None if min_temp_c is None else round(min_temp_c * 10),
+                None if max_temp_c is None else round(max_temp_c * 10),
+            )
         self._silence_temp_alert_until = datetime.datetime.now()
 
-        self._notify_change()
+        # Re-evaluate the probe against its new target from scratch
+        if probe in self._probe_alerts:
+            self._probe_alerts = {
+                p: alert for (p, alert) in self._probe_alerts.items() if p != probe
+            }
+        self._update_alerts(int(time.time() * 1000), self._readings.last_raw_temps)
 
     def _silence_client_alarm(self):
         self._silence_temp_alert_until = datetime.datetime.now() + \
@@ -298,14 +516,21 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
 
     def clear_history(self):
         self._readings.clear()
+        if self._history_log is not None:
+            self._history_log.clear()
+        self._notify_change()
 
     @staticmethod
-    def _tempc_bin_to_float(probe_data):
-        """Temperature (Celcius) binary to float"""
-        raw_temp = struct.unpack('<H', probe_data)[0]
-        if raw_temp == 0xfff6:
-            return None
-        return float(raw_temp) / 10
+    def _tempc_bin_to_raw(data):
+        """Temperatures (Celcius) binary to int16s in 10^-1 Celcius"""
+        unpacker = TEMPS_STRUCTS.get(len(data))
+        if unpacker is None:
+            unpacker = struct.Struct(f"<{len(data) // 2}h")
+            TEMPS_STRUCTS[len(data)] = unpacker
+        return [
+            NO_PROBE if raw_temp == -10 else raw_temp   # 0xfff6
+            for raw_temp in unpacker.unpack_from(data)
+        ]
 
     @staticmethod
     def _tempc_float_to_bin(temp):
@@ -318,27 +543,39 @@ class IBBQ: # pylint: disable=too-many-instance-attributes
 
     def _cb_realtime_temp_notify(self, handle, data):
         # int16 temperature per probe, always celcius
-        reading = {
-            'timestamp': datetime.datetime.now(),
-            'probes': [
-                self._tempc_bin_to_float(probe_data)
-                for probe_data in [data[i:i+2] for i in range(0, len(data), 2)]
-            ],
-        }
-
-        log.debug("Temperature notification: %s",
-                  ", ".join(str(temp) for temp in reading['probes']))
-
-        # When the temps all remain the same, we just need the first/last
-        # timestamp of those values to draw a straight line
-        last_readings = self.probe_readings_all[-2:]
-        if len(last_readings) == 2 and \
-           reading['probes'] == last_readings[1]['probes'] and \
-           reading['probes'] == last_readings[0]['probes']:
-            last_readings[1]['timestamp'] = reading['timestamp']
-        else:
-            self._readings.append(reading)
-        self._notify_change()
+        start_ns = time.perf_counter_ns()
+        ts_ms = int(time.time() * 1000)
+        raw_temps = self._tempc_bin_to_raw(data)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Temperature notification: %s",
+                      ", ".join(str(raw_to_tempc(temp)) for temp in raw_temps))
+
+        # When the temps all remain the same, the history just extends the
+        # end timestamp of the current run
+        if not self._readings.append(ts_ms, raw_temps):
+            self._notifications_deduplicated.inc()
+        if len(raw_temps) > self._probe_gauges:
+            self._add_probe_gauges(len(raw_temps))
+        self._predictor.add(ts_ms, raw_temps)
+        if self._history_log is not None:
+            self._history_log.append(ts_ms, raw_temps)
+        # Alerts are published right away, readings may wait to be coalesced
+        self._notify_change(coalesce=not self._update_alerts(ts_ms, raw_temps))
+
+        self._notifications.inc()
+        self._notify_seconds.observe((time.perf_counter_ns() - start_ns) * 1e-9)
+
+    def _probe_temp(self, probe):
+        """Latest temperature (Celcius) of ``probe``, or None if unplugged"""
+        raw_temps = self._readings.last_raw_temps
+        return raw_to_tempc(raw_temps[probe]) if probe < len(raw_temps) else None
+
+    def _add_probe_gauges(self, nprobes):
+        for probe in range(self._probe_gauges, nprobes):
+            PROBE_TEMPS.labels(self._device_id, probe).set_function(
+                lambda probe=probe: self._probe_temp(probe))
+        self._probe_gauges = nprobes
 
     def _cb_settings_notify(self, handle, data):
         def notify_alarm(data):
@@ -0,0 +1,175 @@
+import array
+import bisect
+
+# Histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0,
+)
+
+
+def _format_labels(names, values, extra=""):
+    labels = [f'{name}="{_escape(str(value))}"' for (name, value) in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Counter:
+    """Monotonically increasing count, ex: notifications received"""
+
+    __slots__ = ("_value",)
+
+    def __init__(self):
+        self._value = array.array('d', [0.0])
+
+    def inc(self, amount=1):
+        self._value[0] += amount
+
+    @property
+    def value(self):
+        return self._value[0]
+
+    def samples(self):
+        yield ("", "", self._value[0])
+
+
+class Gauge:
+    """Value read when the metrics are collected, ex: history length
+
+    The function returns None when there is no value, ex. for an unplugged
+    probe, and the gauge is then left out.
+    """
+
+    __slots__ = ("_function",)
+
+    def __init__(self):
+        self._function = lambda: 0
+
+    def set_function(self, function):
+        self._function = function
+
+    @property
+    def value(self):
+        return self._function()
+
+    def samples(self):
+        value = self._function()
+        if value is not None:
+            yield ("", "", value)
+
+
+class Histogram:
+    """Distribution of observations over fixed buckets, ex: latencies"""
+
+    __slots__ = ("_bounds", "_counts", "_sum")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._bounds = tuple(buckets)
+        self._counts = array.array('Q', bytes(8 * (len(self._bounds) + 1)))
+        self._sum = array.array('d', [0.0])
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum[0] += value
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    def samples(self):
+        cumulative = 0
+        for (bound, count) in zip(self._bounds + (float("inf"),), self._counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield ("_bucket", f'le="{le}"', cumulative)
+        yield ("_sum", "", self._sum[0])
+        yield ("_count", "", cumulative)
+
+
+class MetricFamily:
+    """A named metric, with one child per combination of label values
+
+    Children are created by labels(), normally once up front; the hot path
+    then only touches the preallocated child.
+    """
+
+    TYPES = {
+        Counter: "counter",
+        Gauge: "gauge",
+        Histogram: "histogram",
+    }
+
+    def __init__(self, name, help_text, kind, labelnames=(), **kwargs):
+        self.name = name
+        self.help = help_text
+        self._kind = kind
+        self._labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._children = {}
+
+    def labels(self, *values):
+        """The child for ``values``, created on first use"""
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self._labelnames):
+            raise ValueError(f"{self.name} expects labels {self._labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            child = self._kind(**self._kwargs)
+            self._children[values] = child
+        return child
+
+    def remove(self, *values):
+        self._children.pop(tuple(str(value) for value in values), None)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.TYPES[self._kind]}",
+        ]
+        for (values, child) in self._children.items():
+            for (suffix, extra, value) in child.samples():
+                labels = _format_labels(self._labelnames, values, extra)
+                lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """Collection of metrics, rendered in the Prometheus text format"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._families = {}
+
+    def _family(self, name, help_text, kind, labelnames, **kwargs):
+        family = self._families.get(name)
+        if family is None:
+            family = MetricFamily(name, help_text, kind, labelnames, **kwargs)
+            self._families[name] = family
+        return family
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._family(name, help_text, Counter, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._family(name, help_text, Gauge, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._family(name, help_text, Histogram, labelnames, buckets=buckets)
+
+    def render(self):
+        return "\n".join(family.render() for family in self._families.values()) + "\n"
+
+
+# Metrics for the whole process
+METRICS = MetricsRegistry()
@@ -0,0 +1,129 @@
+import collections
+
+from lib.history import NO_PROBE
+
+PREDICT_WINDOW_MS = 10 * 60 * 1000      # fit the trend over the last 10 minutes
+PREDICT_MIN_SPAN_MS = 2 * 60 * 1000     # of which at least 2 minutes are needed
+PREDICT_MAX_ETA_MS = 24 * 60 * 60 * 1000
+ETA_RESOLUTION_MS = 10 * 1000
+
+
+class TrendEstimator: # pylint: disable=too-many-instance-attributes
+    """Least squares line through the readings of a sliding time window
+
+    The sums the fit needs are kept up to date as readings enter and leave
+    the window, so adding a reading is O(1) (amortised) however long the
+    window. Timestamps (relative to the first reading) and values are ints,
+    so the sums are exact and don't drift.
+    """
+
+    __slots__ = ("_window_ms", "_samples", "_origin", "_n", "_st", "_sx", "_stt", "_stx")
+
+    def __init__(self, window_ms=PREDICT_WINDOW_MS):
+        self._window_ms = window_ms
+        self._samples = collections.deque()
+        self.reset()
+
+    def reset(self):
+        self._samples.clear()
+        self._origin = None
+        self._n = 0
+        self._st = 0
+        self._sx = 0
+        self._stt = 0
+        self._stx = 0
+
+    @property
+    def span_ms(self):
+        if not self._samples:
+            return 0
+        return self._samples[-1][0] - self._samples[0][0]
+
+    @property
+    def last_ms(self):
+        return self._samples[-1][0] + self._origin if self._samples else None
+
+    def add(self, ts_ms, value):
+        if self._origin is None:
+            self._origin = ts_ms
+        t = ts_ms - self._origin
+        self._samples.append((t, value))
+        self._n += 1
+        self._st += t
+        self._sx += value
+        self._stt += t * t
+        self._stx += t * value
+
+        while self._samples[0][0] < t - self._window_ms:
+            (old_t, old_value) = self._samples.popleft()
+            self._n -= 1
+            self._st -= old_t
+            self._sx -= old_value
+            self._stt -= old_t * old_t
+            self._stx -= old_t * old_value
+
+    def slope(self):
+        """Change in value per ms, or None without enough readings"""
+        denominator = self._n * self._stt - self._st * self._st
+        if self._n < 2 or denominator == 0:
+            return None
+        return (self._n * self._stx - self._st * self._sx) / denominator
+
+    def value_at(self, ts_ms):
+        """Fitted value at ``ts_ms``, or None without enough readings"""
+        slope = self.slope()
+        if slope is None:
+            return None
+        t = ts_ms - self._origin
+        return (self._sx + slope * (self._n * t - self._st)) / self._n
+
+
+class CookPredictor:
+    """Per probe temperature trends, and when each probe will reach its target"""
+
+    def __init__(self, window_ms=PREDICT_WINDOW_MS, min_span_ms=PREDICT_MIN_SPAN_MS):
+        self._window_ms = window_ms
+        self._min_span_ms = min_span_ms
+        self._trends = []
+
+    def add(self, ts_ms, raw_temps):
+        if len(raw_temps) != len(self._trends):
+            self._trends = [TrendEstimator(self._window_ms) for _ in raw_temps]
+
+        for (trend, raw_temp) in zip(self._trends, raw_temps):
+            if raw_temp == NO_PROBE:
+                # Probe unplugged; start over when it's back
+                trend.reset()
+            else:
+                trend.add(ts_ms, raw_temp)
+
+    def predictions(self, limits):
+        """Rate of change and ETA per probe, ex: {0: {"rate": <C/min>, "eta": <ms>}}
+
+        ``limits`` are the per probe (raw min, raw max) targets; "eta" is
+        when the probe is expected to reach its max, or None if it has no
+        target, is already there or isn't heading there. Values are rounded,
+        so they only change when the prediction meaningfully does.
+        """
+        predictions = {}
+        for (probe, trend) in enumerate(self._trends):
+            if trend.span_ms < self._min_span_ms:
+                continue
+            slope = trend.slope()
+            if slope is None:
+                continue
+
+            eta = None
+            raw_max = limits.get(probe, (None, None))[1]
+            if raw_max is not None and slope > 0:
+                now_ms = trend.last_ms
+                remaining_ms = (raw_max - trend.value_at(now_ms)) / slope
+                if 0 < remaining_ms < PREDICT_MAX_ETA_MS:
+                    eta = round((now_ms + remaining_ms) / ETA_RESOLUTION_MS) * ETA_RESOLUTION_MS
+
+            predictions[probe] = {
+                # raw (10^-1 C) per ms to C per minute
+                "rate": round(slope * 60 * 1000 / 10, 1) + 0.0,  # no -0.0
+                "eta": eta,
+            }
+        return predictions
@@ -0,0 +1,261 @@
+import abc
+import asyncio
+import logging
+import random
+import struct
+import time
+
+log = logging.getLogger('ibbqweb')
+
+
+CONNECT_TIMEOUT = 10    # seconds
+
+
+class Transport(abc.ABC):
+    """How an IBBQ finds and talks to devices
+
+    Devices are objects with ``address`` and ``name`` attributes, and clients
+    implement the subset of bleak.BleakClient that IBBQ uses: connect(),
+    disconnect(), is_connected, services.characteristics, write_gatt_char()
+    and start_notify(). Failures to reach a device raise ConnectionError, or
+    one of the transport's ``errors``.
+    """
+
+    errors = ()
+
+    @abc.abstractmethod
+    async def discover(self, timeout):
+        """Devices seen in a scan lasting ``timeout`` seconds"""
+
+    @abc.abstractmethod
+    async def find_device_by_name(self, name):
+        """The first device seen named ``name``, or None"""
+
+    @abc.abstractmethod
+    async def find_device_by_address(self, address):
+        """The device at ``address``, or None if it isn't seen"""
+
+    @abc.abstractmethod
+    def client(self, device, disconnected_callback, services=None):
+        """Client for ``device``, only discovering ``services`` (UUIDs) if given"""
+
+
+class BleakTransport(Transport):
+    """Real devices over Bluetooth LE"""
+
+    def __init__(self):
+        # Imported here, so that runs without Bluetooth don't pay for it
+        import bleak # pylint: disable=import-outside-toplevel
+        self._bleak = bleak
+        self.errors = (bleak.exc.BleakError,)
+
+    async def discover(self, timeout):
+        return await self._bleak.BleakScanner.discover(timeout=timeout)
+
+    async def find_device_by_name(self, name):
+        return await self._bleak.BleakScanner.find_device_by_name(name)
+
+    async def find_device_by_address(self, address):
+        return await self._bleak.BleakScanner.find_device_by_address(address)
+
+    def client(self, device, disconnected_callback, services=None):
+        return self._bleak.BleakClient(device, disconnected_callback, services,
+                                       timeout=CONNECT_TIMEOUT)
+
+
+class SimulatedDevice: # pylint: disable=too-few-public-methods
+    def __init__(self, address, name="iBBQ"):
+        self.address = address
+        self.name = name
+
+    def __repr__(self):
+        return f"{self.address}: {self.name} (simulated)"
+
+
+class SimulatedCharacteristic: # pylint: disable=too-few-public-methods
+    def __init__(self, key):
+        self.handle = key
+        self.uuid = f"0000{key:04x}-0000-1000-8000-00805f9b34fb"
+
+    def __str__(self):
+        return f"{self.uuid} (Handle: {self.handle}): simulated"
+
+
+class SimulatedServices: # pylint: disable=too-few-public-methods
+    def __init__(self, keys):
+        self.characteristics = {key: SimulatedCharacteristic(key) for key in keys}
+
+
+class SimulatedClient: # pylint: disable=too-many-instance-attributes
+    """An iBBQ as seen over GATT, emitting notification frames like the real one
+
+    Once realtime data is enabled, a REALTIME_TEMP_NOTIFY frame (a little
+    endian int16 per probe, in 10^-1 Celcius, 0xfff6 for no probe) is sent
+    ``rate`` times a second. The first probe follows a smoker's pit
+    temperature, the others meat heating up towards it. Once battery data is
+    enabled, a voltage SETTINGS_NOTIFY frame is sent every
+    ``battery_interval`` seconds, and settings writes are acknowledged the
+    way the device does.
+    """
+
+    REALTIME_TEMP_NOTIFY = 0xfff4
+    SETTINGS_NOTIFY = 0xfff1
+    CHARACTERISTICS = (0xfff1, 0xfff2, 0xfff3, 0xfff4, 0xfff5)
+
+    def __init__(self, device, disconnected_callback, sim):
+        self._device = device
+        self._disconnected_callback = disconnected_callback
+        self._sim = sim
+        self._rand = random.Random(sim.seed_for(device))
+        self._connected = False
+        self._callbacks = {}
+        self._tasks = []
+        self.services = SimulatedServices(self.CHARACTERISTICS)
+
+        # Temperatures in Celcius; None when unplugged
+        self._temps = [sim.pit_temp] + [self._rand.uniform(3, 8) for _ in range(sim.probes - 1)]
+        self._voltage = 6300
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    @property
+    def address(self):
+        return self._device.address
+
+    async def connect(self):
+        await asyncio.sleep(self._sim.connect_delay)
+        self._connected = True
+        if self._sim.disconnect_interval:
+            self._tasks.append(asyncio.create_task(self._disconnect_later()))
+
+    async def disconnect(self):
+        self._stop()
+
+    def _stop(self):
+        self._connected = False
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._tasks = []
+
+    async def _disconnect_later(self):
+        await asyncio.sleep(self._rand.expovariate(1 / self._sim.disconnect_interval))
+        log.info("Simulating disconnect of %s", self.address)
+        self._stop()
+        self._disconnected_callback(self)
+
+    async def start_notify(self, char, callback):
+        self._check_connected()
+        self._callbacks[char.handle] = callback
+
+    async def write_gatt_char(self, char, data, response=False): # pylint: disable=unused-argument
+        self._check_connected()
+        await asyncio.sleep(self._sim.write_delay)
+        data = bytes(data)
+        if char.handle != 0xfff5:
+            return
+
+        if data == b"\x0B\x01\x00\x00\x00\x00":       # ENABLE_REALTIME_DATA
+            self._tasks.append(asyncio.create_task(self._realtime_loop()))
+        elif data == b"\x08\x24\x00\x00\x00\x00":     # ENABLE_BATTERY_DATA
+            self._tasks.append(asyncio.create_task(self._battery_loop()))
+        elif data == b"\x08\x23\x00\x00\x00\x00":     # GET_VERSION
+            self._notify(self.SETTINGS_NOTIFY, b"\x23\x01\x02\x03\x00\x00")
+        elif data[0] in (0x01, 0x02, 0x04):             # Target temp, unit, silence
+            self._notify(self.SETTINGS_NOTIFY, bytes((0xff, data[0], 0, 0, 0, 0)))
+
+    def _check_connected(self):
+        if not self._connected:
+            raise ConnectionError(f"Simulated device {self.address} not connected")
+
+    def _notify(self, key, data):
+        callback = self._callbacks.get(key)
+        if callback is not None:
+            callback(key, bytearray(data))
+
+    def _step(self, dt):
+        """Advance the probe temperatures by ``dt`` (real time) seconds"""
+        sim = self._sim
+        for (probe, temp) in enumerate(self._temps):
+            if sim.unplug_interval and self._rand.random() < dt / sim.unplug_interval:
+                temp = None if temp is not None else 20.0
+            elif temp is not None:
+                target = sim.pit_temp if probe == 0 else self._temps[0] or sim.pit_temp
+                temp += (target - temp) * dt * sim.speedup / sim.time_constant
+                temp += self._rand.gauss(0, sim.noise)
+            self._temps[probe] = temp
+
+    async def _realtime_loop(self):
+        period = 1 / self._sim.rate
+        deadline = time.monotonic()
+        while True:
+            self._step(period)
+            self._notify(self.REALTIME_TEMP_NOTIFY, struct.pack(
+                f"<{len(self._temps)}h",
+                *(-10 if temp is None else round(temp * 10) for temp in self._temps)
+            ))
+            deadline += period
+            await asyncio.sleep(max(0, deadline - time.monotonic()))
+
+    async def _battery_loop(self):
+        while True:
+            self._voltage = max(5580, self._voltage - self._rand.randrange(0, 3))
+            self._notify(self.SETTINGS_NOTIFY,
+                         struct.pack("<BHHB", 0x24, self._voltage, 6550, 0))
+            await asyncio.sleep(self._sim.battery_interval)
+
+
+class SimulatedTransport(Transport): # pylint: disable=too-many-instance-attributes
+    """Simulated iBBQ devices, for testing and benchmarking without Bluetooth
+
+    ``devices`` thermometers with ``probes`` probes each are found by scans,
+    at addresses 00:00:00:00:00:01 onwards. Each sends ``rate`` temperature
+    notifications a second, with the cook running ``speedup`` times faster
+    than real time. Disconnects and probe (un)plugging happen on average
+    every ``disconnect_interval`` and ``unplug_interval`` seconds (never, if
+    None).
+    """
+
+    def __init__(self, devices=1, probes=4, rate=1.0, *, # pylint: disable=too-many-arguments
+                 speedup=1.0, battery_interval=60, disconnect_interval=None,
+                 unplug_interval=None, seed=None):
+        self.probes = probes
+        self.rate = rate
+        self.speedup = speedup
+        self.battery_interval = battery_interval
+        self.disconnect_interval = disconnect_interval
+        self.unplug_interval = unplug_interval
+        self.seed = seed
+
+        self.pit_temp = 110.0
+        self.time_constant = 60 * 60    # seconds
+        self.noise = 0.05
+        self.connect_delay = 0.05       # seconds
+        self.write_delay = 0.005        # seconds
+
+        self._devices = [
+            SimulatedDevice(":".join(f"{b:02X}" for b in i.to_bytes(6, "big")))
+            for i in range(1, devices + 1)
+        ]
+
+    @property
+    def addresses(self):
+        return [device.address for device in self._devices]
+
+    def seed_for(self, device):
+        return None if self.seed is None else f"{self.seed}:{device.address}"
+
+    async def discover(self, timeout):
+        await asyncio.sleep(min(timeout, self.connect_delay))
+        return list(self._devices)
+
+    async def find_device_by_name(self, name):
+        return next((d for d in self._devices if d.name == name), None)
+
+    async def find_device_by_address(self, address):
+        return next((d for d in self._devices if d.address == address.upper()), None)
+
+    def client(self, device, disconnected_callback, services=None):
+        return SimulatedClient(device, disconnected_callback, self)
@@ -1,31 +1,48 @@
 import asyncio
 import datetime
+import functools
+import itertools
 import json
 import logging
 import os
 import os.path
 import ssl
-import cryptography.x509
 
 import aiohttp.web
 
+from lib.assets import INDEX_PATH, AssetManifest
+from lib.history import raw_to_tempc
+from lib.ibbq import TARGET_TEMP_MAX_C, TARGET_TEMP_MIN_C
+from lib.metrics import METRICS
+from lib.wshub import ENCODINGS, WebSocketHub
+
 log = logging.getLogger('ibbqweb')
 
 
 WEBROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../webroot")
 
+API_HISTORY_BATCH = 500     # runs per chunk written to the response
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60   # seconds
+
+TLS_RELOADS = METRICS.counter(
+    "ibbq_tls_reloads_total",
+    "Times the TLS certificate chain was (re)loaded").labels()
+
 
 def now_utc():
     return datetime.datetime.now(datetime.timezone.utc).timestamp()
 
 
 class WebServer:
-    def __init__(self, cfg, ibbq):
+    def __init__(self, cfg, devices):
         self._cfg = cfg
-        self._ibbq = ibbq
+        self._devices = devices
+        self._ws_hubs = {ibbq: WebSocketHub(ibbq) for ibbq in devices}
+        self._assets = AssetManifest(WEBROOT, compress=cfg.static_compression)
 
         self._webapp = aiohttp.web.Application(middlewares=[
-            WebServer.index_middleware,
+            self.asset_middleware,
             WebServer.cache_control_middleware,
         ])
 
@@ -42,27 +59,71 @@ class WebServer:
             self._webapp.cleanup_ctx.append(WebServer._background_tasks)
         elif self._cfg.tls_cert or self._cfg.tls_key:
             raise ValueError("Must specify both or neither TLS 'cert' and 'key'")
+        self._webapp.cleanup_ctx.append(self._ws_hub_task)
 
         self._webapp.add_routes([
             aiohttp.web.get('/ws', self._ws_handler_factory()),
+            aiohttp.web.get('/api/history', self._api_history),
+            aiohttp.web.get('/api/devices', self._api_devices),
+            aiohttp.web.get('/metrics', self._metrics),
             aiohttp.web.static('/', WEBROOT)
         ])
 
         self._webapp_runner = aiohttp.web.AppRunner(self._webapp)
 
     async def __aenter__(self):
+        try:
+            await asyncio.to_thread(self._assets.build)
+        except (OSError, ValueError) as ex:
+            log.warning("Failed to build the static asset manifest: %s", ex)
+            self._assets = AssetManifest(WEBROOT)
         await self._webapp_runner.setup()
         return self
 
     async def __aexit__(self, *excinfo):
         await self._webapp_runner.cleanup()
 
-    @staticmethod
     @aiohttp.web.middleware
-    async def index_middleware(request, handler):
-        if request.path == "/":
-            return aiohttp.web.FileResponse(os.path.join(WEBROOT, "index.html"))
-        return await handler(request)
+    async def asset_middleware(self, request, handler):
+        """Serve files in the asset manifest from memory
+
+        Requested with their current hash (?v=<hash>), they can be cached
+        forever; otherwise they have to be revalidated with the ETag.
+        """
+        path = INDEX_PATH if request.path == "/" else request.path
+        asset = self._assets.get(path)
+        if asset is None or request.method not in ("GET", "HEAD"):
+            if request.path == "/":
+                return aiohttp.web.FileResponse(os.path.join(WEBROOT, "index.html"))
+            return await handler(request)
+
+        accepted = set()
+        for coding in request.headers.get("Accept-Encoding", "").split(","):
+            (name, _, params) = coding.partition(";")
+            if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                accepted.add(name.strip())
+        (coding, body) = next(
+            ((coding, asset.encodings[coding]) for coding in ("br", "gzip")
+             if coding in accepted and coding in asset.encodings),
+            (None, asset.data))
+
+        # Each encoding's body is deterministic, so gets its own strong ETag
+        etag = f'"{asset.hash}"' if coding is None else f'"{asset.hash}-{coding}"'
+        headers = {
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+                             if request.query.get("v") == asset.hash else "no-cache",
+        }
+        # If-None-Match uses the weak comparison
+        if etag in (tag.strip().removeprefix("W/")
+                    for tag in request.headers.get("If-None-Match", "").split(",")):
+            return aiohttp.web.Response(status=304, headers=headers)
+        if coding is not None:
+            headers["Content-Encoding"] = coding
+        return aiohttp.web.Response(
+            body=body, headers=headers, content_type=asset.content_type,
+            charset="utf-8" if asset.content_type.startswith("text/") else None)
 
     @staticmethod
     @aiohttp.web.middleware
@@ -74,6 +135,9 @@ class WebServer:
 
     @staticmethod
     def _reload_certs(app):
+        # Only needed with TLS, and slow to import on small boards
+        import cryptography.x509 # pylint: disable=import-outside-toplevel
+
         if os.lstat(app['tls']['cert']).st_mtime > app['tls']['loaded_at']:
             app['ssl_ctx'].load_cert_chain(app['tls']['cert'], app['tls']['key'])
 
@@ -83,6 +147,7 @@ class WebServer:
             app['tls']['loaded_at'] = now_utc()
 
             log.info("Certificate chain (re)loaded, expires %s", cert_data.not_valid_after_utc)
+            TLS_RELOADS.inc()
 
     @staticmethod
     async def _reload_certs_poller(app):
@@ -101,136 +166,303 @@ class WebServer:
         app['reload_certs'].cancel()
         await app['reload_certs']
 
+    async def _ws_hub_task(self, _app):
+        tasks = [asyncio.create_task(hub.run()) for hub in self._ws_hubs.values()]
+        yield
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks)
+
+    @staticmethod
+    async def _metrics(_request):
+        """Metrics in the Prometheus text format"""
+        return aiohttp.web.Response(
+            body=METRICS.render().encode(),
+            headers={"Content-Type": METRICS.CONTENT_TYPE},
+        )
+
     def start(self):
         tcpsite = aiohttp.web.TCPSite(self._webapp_runner,
                                       port=self._cfg.http_port,
                                       ssl_context=self._webapp['ssl_ctx'])
         return tcpsite.start()
 
-    async def _ws_handle_cmd(self, data):
+    @staticmethod
+    def _api_int_param(request, name):
+        value = request.query.get(name, "")
+        if value == "":
+            return None
         try:
-            if data["cmd"] == "set_unit":
-                self._cfg.unit = data["unit"]
-                if data["unit"] == 'C':
-                    await self._ibbq.set_unit_celcius()
-                else:
-                    await self._ibbq.set_unit_farenheit()
-            elif data["cmd"] == "set_probe_target_temp":
-                await self._ibbq.set_probe_target_temp(data["probe"],
-                                                       data["preset"],
-                                                       data["min_temp"],
-                                                       data["max_temp"])
-            elif data["cmd"] == "silence_alarm":
-                await self._ibbq.silence_alarm()
-
-            elif data["cmd"] == "clear_history":
-                self._ibbq.clear_history()
-
-            elif data["cmd"] == "poweroff":
-                if self._cfg.allow_poweroff:
-                    os.system('sudo poweroff')
-                else:
-                    log.warning('Attempted to power off the server when '
-                                '"allow_poweroff" is disabled.')
-        except ConnectionError:
-            # Send an error back to the client?
-            pass
+            return int(value)
+        except ValueError as ex:
+            raise aiohttp.web.HTTPBadRequest(text=f"Invalid '{name}'") from ex
+
+    def _request_device(self, request):
+        """The device selected by the 'device' query param, or the first device"""
+        ibbq = self._devices.get(request.query.get("device"))
+        if ibbq is None:
+            raise aiohttp.web.HTTPNotFound(text="Unknown device")
+        return ibbq
+
+    async def _api_devices(self, _request):
+        """List the devices, ex: [{"id": <id>, "address": <address>, "connected": <bool>}]"""
+        return aiohttp.web.json_response([
+            {
+                "id": device_id,
+                "address": ibbq.address,
+                "connected": ibbq.connected,
+            }
+            for (device_id, ibbq) in self._devices.items()
+        ])
+
+    @staticmethod
+    def _api_history_batches(history, from_ms, to_ms, aggregate):
+        """Yield lists of (ts_ms, raw_temps, raw_min, raw_max) within [from_ms, to_ms)
+
+        Raw runs are read in batches by run id, so readings appended (or
+        dropped) while the response is streamed are handled gracefully.
+        """
+        if aggregate is not None:
+            yield [
+                (last_ts_ms, raw_last, raw_min, raw_max)
+                for (last_ts_ms, raw_min, raw_max, raw_last) in aggregate.buckets(from_ms, to_ms)
+            ]
+            return
+
+        next_id = history.first_id if from_ms is None else history.find_id(from_ms)
+        while True:
+            next_id = max(next_id, history.first_id)
+            batch = []
+            for (run_id, start_ms, end_ms, raw_temps) in itertools.islice(
+                    history.runs(next_id), API_HISTORY_BATCH):
+                next_id = run_id + 1
+                for ts_ms in (start_ms,) if end_ms == start_ms else (start_ms, end_ms):
+                    if (
+                        (from_ms is None or ts_ms >= from_ms) and
+                        (to_ms is None or ts_ms < to_ms)
+                    ):
+                        batch.append((ts_ms, raw_temps, None, None))
+                if to_ms is not None and start_ms >= to_ms:
+                    yield batch
+                    return
+            if next_id > history.last_id:
+                yield batch
+                return
+            yield batch
+
+    @staticmethod
+    def _api_history_json(rows, first):
+        lines = []
+        for (ts_ms, raw_temps, raw_min, raw_max) in rows:
+            row = {
+                "ts": ts_ms,
+                "probes": [raw_to_tempc(t) for t in raw_temps],
+            }
+            if raw_min is not None:
+                row["min"] = [raw_to_tempc(t) for t in raw_min]
+                row["max"] = [raw_to_tempc(t) for t in raw_max]
+            lines.append(json.dumps(row))
+        data = ",\n".join(lines)
+        return data if first or not data else ",\n" + data
+
+    @staticmethod
+    def _api_history_csv(rows, first):
+        def fmt(raw_temp):
+            temp = raw_to_tempc(raw_temp)
+            return "" if temp is None else str(temp)
+
+        lines = []
+        for (ts_ms, raw_temps, raw_min, raw_max) in rows:
+            if first:
+                header = ["ts"] + [f"probe{i+1}" for i in range(len(raw_temps))]
+                if raw_min is not None:
+                    header += [f"probe{i+1}_{col}" for i in range(len(raw_temps))
+                                                   for col in ("min", "max")]
+                lines.append(",".join(header))
+                first = False
+
+            line = [str(ts_ms)] + [fmt(t) for t in raw_temps]
+            if raw_min is not None:
+                line += [fmt(t) for pair in zip(raw_min, raw_max) for t in pair]
+            lines.append(",".join(line))
+        return "".join(line + "\n" for line in lines)
+
+    async def _api_history(self, request):
+        """Stream the history, ex: /api/history?from=<ms>&to=<ms>&resolution=<ms>&format=csv
+
+        'device' selects the device (the first by default).
+
+        'from'/'to' are epoch ms (to is exclusive). If 'resolution' is given,
+        the coarsest aggregate level with buckets no wider than it is used,
+        adding per-probe min/max. 'format' is 'json' (the same layout as the
+        web client's saved data) or 'csv'.
+        """
+        from_ms = self._api_int_param(request, "from")
+        to_ms = self._api_int_param(request, "to")
+        resolution = self._api_int_param(request, "resolution")
+        fmt = request.query.get("format", "json")
+        if fmt not in ("json", "csv"):
+            raise aiohttp.web.HTTPBadRequest(text=f"Unknown format '{fmt}'")
+        history = self._request_device(request).history
+
+        aggregate = None
+        for level in history.aggregates:
+            if resolution is not None and level.bucket_ms <= resolution:
+                aggregate = level
+
+        response = aiohttp.web.StreamResponse()
+        response.content_type = "application/json" if fmt == "json" else "text/csv"
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        if fmt == "json":
+            await response.write(b'{"probe_readings": [\n')
+        first = True
+        for rows in self._api_history_batches(history, from_ms, to_ms, aggregate):
+            if fmt == "json":
+                data = self._api_history_json(rows, first)
+            else:
+                data = self._api_history_csv(rows, first)
+            first = first and not rows
+            if data:
+                await response.write(data.encode())
+        if fmt == "json":
+            await response.write(b'\n]}\n')
+
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    def _ws_target_temp(data, key):
+        """Target temp ``key`` of a command: None, or Celcius the device accepts"""
+        temp = data[key]
+        if temp is None:
+            return None
+        if not isinstance(temp, (int, float)) or isinstance(temp, bool) or \
+           not TARGET_TEMP_MIN_C <= temp <= TARGET_TEMP_MAX_C:
+            raise ValueError(f"Invalid {key} {temp!r}")
+        return temp
+
+    async def _ws_handle_cmd(self, ibbq, data):
+        """Run the command in ``data``, raising an exception if it fails
+
+        Device commands go through the device's command queue, so they are
+        sent one at a time, and superseded ones are dropped.
+        """
+        if data["cmd"] == "set_unit":
+            # The display unit is shared by all devices
+            self._cfg.unit = data["unit"]
+            await asyncio.gather(*(
+                device.commands.submit(
+                    "set_unit",
+                    device.set_unit_celcius if data["unit"] == 'C' else
+                    device.set_unit_farenheit
+                )
+                for device in self._devices
+            ))
+        elif data["cmd"] == "set_probe_target_temp":
+            probe = data["probe"]
+            if not isinstance(probe, int) or isinstance(probe, bool) or \
+               probe not in range(ibbq.num_probes):
+                raise ValueError(f"Unknown probe {probe!r}")
+            await ibbq.commands.submit(
+                ("set_probe_target_temp", probe),
+                functools.partial(ibbq.set_probe_target_temp,
+                                  probe,
+                                  data["preset"],
+                                  self._ws_target_temp(data, "min_temp"),
+                                  self._ws_target_temp(data, "max_temp"))
+            )
+            self._cfg.set_target_temps(ibbq.device_id, ibbq.target_temps)
+        elif data["cmd"] == "silence_alarm":
+            await ibbq.commands.submit("silence_alarm", ibbq.silence_alarm)
+
+        elif data["cmd"] == "clear_history":
+            ibbq.clear_history()
+
+        elif data["cmd"] == "poweroff":
+            if self._cfg.allow_poweroff:
+                os.system('sudo poweroff')
+            else:
+                log.warning('Attempted to power off the server when '
+                            '"allow_poweroff" is disabled.')
+                raise PermissionError("Power off is disabled")
+        else:
+            raise ValueError(f"Unknown command '{data['cmd']}'")
+
+    async def _ws_run_cmd(self, ibbq, client, msg):
+        """Run a command (JSON text), then send its result to the client that sent it"""
+        result = {"id": None, "cmd": None, "ok": True}
+        try:
+            data = json.loads(msg)
+            if not isinstance(data, dict):
+                raise TypeError("not a JSON object")
+            result.update(id=data.get("id"), cmd=data.get("cmd"))
+            await self._ws_handle_cmd(ibbq, data)
+        except (ConnectionError, TimeoutError, PermissionError) as ex:
+            result.update(ok=False, error=str(ex) or type(ex).__name__)
+        except (KeyError, TypeError, ValueError) as ex:
+            log.warning("Invalid command %s: %s", msg, ex)
+            result.update(ok=False, error=f"Invalid command: {ex}")
+
+        # Not every command results in a device change notification
+        for device_hub in self._ws_hubs.values():
+            device_hub.publish()
+        client.send(json.dumps({"cmd_result": result}, separators=(',', ':')))
+
+    @staticmethod
+    def _ws_client_cursor(request, history):
+        """Resume cursor from the client's ``epoch`` and ``since`` query params"""
+        try:
+            since = int(request.query.get("since", ""))
+        except ValueError:
+            return None
+
+        if (
+            request.query.get("epoch") != history.epoch or
+            not history.first_id - 1 <= since <= history.last_id
+        ):
+            return None
+        return (since, None)
 
     def _ws_handler_factory(self):
         async def ws_handler(request):
             log.info("Websocket connected from %s:%d",
                      *request.transport.get_extra_info('peername'))
-            wsock = aiohttp.web.WebSocketResponse()
+            encoding = request.query.get("enc", "json")
+            if encoding not in ENCODINGS:
+                raise aiohttp.web.HTTPBadRequest(text=f"Unknown encoding '{encoding}'")
+            try:
+                points = int(request.query.get("points", 0)) or None
+            except ValueError as ex:
+                raise aiohttp.web.HTTPBadRequest(text="Invalid points") from ex
+            ibbq = self._request_device(request)
+            hub = self._ws_hubs[ibbq]
+
+            wsock = aiohttp.web.WebSocketResponse(compress=self._cfg.ws_compression)
             await wsock.prepare(request)
 
-            client_unit = self._ibbq.unit
-            payload = {
-                "cmd": "unit_update",
-                "unit": client_unit,
-            }
-            await wsock.send_json(payload)
-
-            readings_since = self._ibbq.probe_readings_since
-            full_history = True
-            while True:
-                if self._ibbq.probe_readings_since > readings_since:
-                    readings_since = self._ibbq.probe_readings_since
-                    full_history = True
-
-                if self._ibbq.unit != client_unit:
-                    client_unit = self._ibbq.unit
-                    payload = {
-                        "cmd": "unit_update",
-                        "unit": client_unit,
-                    }
-                    await wsock.send_json(payload)
-
-                reading = self._ibbq.probe_reading
-                payload = {
-                    "cmd": "state_update",
-                    "connected": self._ibbq.connected,
-                    "battery_level": self._ibbq.battery_level,
-                    "full_history": full_history,
-                    "target_temps": {
-                        probe: {
-                            "preset": tt["preset"],
-                            "min_temp": tt["min_temp_c"],
-                            "max_temp": tt["max_temp_c"],
-                        }
-                        for (probe, tt) in self._ibbq.target_temps.items()
-                    },
-                    "target_temp_alert": self._ibbq.target_temp_alert,
-                }
-
-                if reading is None:
-                    payload.update({
-                        "probe_readings": [{
-                            "ts": int(now_utc() * 1000),
-                            "probes": [],
-                        }],
-                    })
-                    await wsock.send_json(payload)
-                else:
-                    payload.update({
-                        "probe_readings": [
-                            {
-                                "ts": int(e["timestamp"].timestamp() * 1000),
-                                "probes": e["probes"],
-                            } for e in (
-                                self._ibbq.probe_readings_all if full_history
-                                                              else [reading]
-                            )
-                        ],
-                    })
-                    full_history = False
-                    await wsock.send_json(payload)
-
-                recv_task = asyncio.create_task(wsock.receive())
-                update_task = asyncio.create_task(self._ibbq.await_change())
-
-                done, pending = await asyncio.wait(
-                    [recv_task, update_task],
-                    return_when=asyncio.FIRST_COMPLETED
-                )
-
-                for task in done:
-                    if task == recv_task:
-                        msg = await task
-                        if msg.type == aiohttp.WSMsgType.CLOSE:
-                            return wsock
-
-                        if msg.type != aiohttp.WSMsgType.TEXT:
-                            raise TypeError(
-                                f"Received message {msg.type}:{msg.data} is not WSMsgType.TEXT"
-                            )
-                        await self._ws_handle_cmd(json.loads(msg.data))
-                    else:
-                        await task
-
-                for task in pending:
+            client = hub.subscribe(
+                wsock,
+                self._ws_client_cursor(request, ibbq.history),
+                encoding,
+                points,
+            )
+            # Commands run concurrently with receiving more, so that a
+            # burst of them can be coalesced by the command queue
+            cmd_tasks = set()
+            try:
+                async for msg in wsock:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        raise TypeError(
+                            f"Received message {msg.type}:{msg.data} is not WSMsgType.TEXT"
+                        )
+                    task = asyncio.create_task(self._ws_run_cmd(ibbq, client, msg.data))
+                    cmd_tasks.add(task)
+                    task.add_done_callback(cmd_tasks.discard)
+            finally:
+                for task in cmd_tasks:
                     task.cancel()
-                    try:
-                        await task
-                    except asyncio.CancelledError:
-                        pass
+                await hub.unsubscribe(client)
+            return wsock
         return ws_handler
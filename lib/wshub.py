@@ -0,0 +1,368 @@
+import asyncio
+import json
+import logging
+import time
+
+from lib.history import NO_PROBE, raw_to_tempc
+from lib.metrics import METRICS
+
+log = logging.getLogger('ibbqweb')
+
+
+MAX_QUEUED_UPDATES = 32
+SEND_TIMEOUT = 10   # seconds
+
+# A full history sync is downsampled, except for this most recent window
+FULL_RESOLUTION_WINDOW = 30 * 60 * 1000     # ms
+
+CLIENTS = METRICS.gauge(
+    "ibbq_websocket_clients",
+    "Connected websocket clients",
+    ("device",))
+MESSAGES_SENT = METRICS.counter(
+    "ibbq_websocket_messages_sent_total",
+    "Websocket messages sent",
+    ("device",))
+BYTES_SENT = METRICS.counter(
+    "ibbq_websocket_sent_bytes_total",
+    "Websocket payload bytes sent, before compression",
+    ("device",))
+SEND_SECONDS = METRICS.histogram(
+    "ibbq_websocket_send_seconds",
+    "Time taken to send a websocket message",
+    ("device",))
+RESYNCS = METRICS.counter(
+    "ibbq_websocket_resyncs_total",
+    "Websocket clients that fell behind and were resynced",
+    ("device",))
+
+
+def _encode_rows(payload):
+    """Readings as a list of {"ts": <ms>, "probes": [<celcius>, ...]}"""
+    if "probe_readings" in payload:
+        payload = dict(payload)
+        payload["probe_readings"] = [
+            {
+                "ts": ts_ms,
+                "probes": [raw_to_tempc(t) for t in raw_temps],
+            } for (ts_ms, raw_temps) in payload["probe_readings"]
+        ]
+    return json.dumps(payload)
+
+
+def _encode_columnar(payload):
+    """Readings as delta encoded columns
+
+    {"ts": [<ms>, <delta ms>, ...], "probes": [[<raw>, <delta raw>, ...], ...]}
+
+    Temperatures are in 10^-1 Celcius, with null for a disconnected probe.
+    Each delta is relative to the previous non-null value in its column.
+    """
+    if "probe_readings" in payload:
+        readings = payload["probe_readings"]
+        nprobes = len(readings[0][1]) if readings else 0
+
+        ts_col = []
+        prev_ts = 0
+        probe_cols = [[] for _ in range(nprobes)]
+        prev_temps = [0] * nprobes
+        for (ts_ms, raw_temps) in readings:
+            ts_col.append(ts_ms - prev_ts)
+            prev_ts = ts_ms
+            for (probe, raw_temp) in enumerate(raw_temps):
+                if raw_temp == NO_PROBE:
+                    probe_cols[probe].append(None)
+                else:
+                    probe_cols[probe].append(raw_temp - prev_temps[probe])
+                    prev_temps[probe] = raw_temp
+
+        payload = dict(payload)
+        del payload["probe_readings"]
+        payload["readings"] = {
+            "ts": ts_col,
+            "probes": probe_cols,
+        }
+    return json.dumps(payload, separators=(',', ':'))
+
+
+ENCODINGS = {
+    "json": _encode_rows,
+    "columnar": _encode_columnar,
+}
+
+
+class WebSocketClient: # pylint: disable=too-many-instance-attributes
+    """A websocket subscribed to a WebSocketHub
+
+    Updates are queued by the hub and sent by a per-client writer task, so a
+    slow client never delays the others. If the queue overflows, pending
+    updates are dropped and the client is resynced from the last update it
+    was sent.
+    """
+
+    def __init__(self, wsock, sync, encoding="json", maxqueue=MAX_QUEUED_UPDATES, device_id="", # pylint: disable=too-many-arguments
+                 *, points=None):
+        self.wsock = wsock
+        self.encoding = encoding
+        # What the client has been sent: unit, history epoch/cursor and
+        # state. Never changed in place, as it may be shared with the hub and
+        # other clients.
+        self.sync = sync
+        # Readings to downsample a full history to, see WebSocketHub.subscribe()
+        self.points = points
+        self.synced = False
+        self._queue = asyncio.Queue(maxqueue)
+        self._messages_sent = MESSAGES_SENT.labels(device_id)
+        self._bytes_sent = BYTES_SENT.labels(device_id)
+        self._send_seconds = SEND_SECONDS.labels(device_id)
+        self._resyncs = RESYNCS.labels(device_id)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def send(self, msg):
+        """Queue ``msg`` (encoded) after any pending updates"""
+        self.enqueue([msg], None)
+
+    def enqueue(self, msgs, sync):
+        try:
+            self._queue.put_nowait((msgs, sync))
+        except asyncio.QueueFull:
+            log.info("Websocket client fell behind, resyncing")
+            self._resyncs.inc()
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self.synced = False
+
+    async def close(self):
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+
+    async def _write_loop(self):
+        while True:
+            (msgs, sync) = await self._queue.get()
+            # Anything still queued after this builds on ``sync``, so it is
+            # where a resync starts from if the queue overflows
+            if sync is not None:
+                self.sync = sync
+            try:
+                for msg in msgs:
+                    start_ns = time.perf_counter_ns()
+                    await asyncio.wait_for(self.wsock.send_str(msg), SEND_TIMEOUT)
+                    self._send_seconds.observe((time.perf_counter_ns() - start_ns) * 1e-9)
+                    self._messages_sent.inc()
+                    self._bytes_sent.inc(len(msg))
+            except (ConnectionError, asyncio.TimeoutError):
+                log.info("Websocket send failed, closing")
+                await self.wsock.close()
+                return
+
+
+class WebSocketHub:
+    """Fan out device updates to every connected websocket
+
+    Each update is built once, relative to the previous update, and encoded
+    once per wire encoding in use; the same message is queued to every
+    client using that encoding. Clients that
+    just connected (or fell behind) instead get an update built from what
+    they were last sent, after which they receive the shared updates.
+    """
+
+    def __init__(self, ibbq):
+        self._ibbq = ibbq
+        self._clients = set()
+        CLIENTS.labels(ibbq.device_id).set_function(lambda: len(self._clients))
+        self._sync = {
+            "unit": None,
+            "epoch": ibbq.history.epoch,
+            "cursor": None,
+            "state": {},
+        }
+
+    @property
+    def clients(self):
+        return self._clients
+
+    def subscribe(self, wsock, cursor, encoding="json", points=None):
+        """Add a client, resuming from ``cursor``
+
+        If the client needs a full history, it is downsampled to roughly
+        ``points`` readings (if given).
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown websocket encoding '{encoding}'")
+
+        client = WebSocketClient(wsock, {
+            "unit": None,
+            "epoch": self._ibbq.history.epoch,
+            "cursor": cursor,
+            "state": {},
+        }, encoding, device_id=self._ibbq.device_id, points=points)
+        self._clients.add(client)
+        self.publish()
+        return client
+
+    async def unsubscribe(self, client):
+        self._clients.discard(client)
+        await client.close()
+
+    async def run(self):
+        try:
+            version = self._ibbq.change_version
+            while True:
+                version = await self._ibbq.await_change(version)
+                self.publish()
+        except asyncio.CancelledError:
+            pass
+
+    def publish(self):
+        """Queue an update for all clients"""
+        (updates, self._sync) = self._updates(self._sync)
+
+        encoded = {}
+        for client in self._clients:
+            if client.synced:
+                if updates:
+                    if client.encoding not in encoded:
+                        encode = ENCODINGS[client.encoding]
+                        encoded[client.encoding] = [encode(payload) for payload in updates]
+                    client.enqueue(encoded[client.encoding], self._sync)
+            else:
+                encode = ENCODINGS[client.encoding]
+                (client_updates, client_sync) = self._updates(client.sync, client.points)
+                client.synced = True
+                client.enqueue([encode(payload) for payload in client_updates], client_sync)
+
+    def _state(self):
+        return {
+            "connected": self._ibbq.connected,
+            "battery_level": self._ibbq.battery_level,
+            "target_temps": {
+                probe: {
+                    "preset": tt["preset"],
+                    "min_temp": tt["min_temp_c"],
+                    "max_temp": tt["max_temp_c"],
+                }
+                for (probe, tt) in self._ibbq.target_temps.items()
+            },
+            "target_temp_alert": self._ibbq.target_temp_alert,
+            "probe_alerts": self._ibbq.probe_alerts,
+            "predictions": self._ibbq.predictions,
+            "history_start": self._ibbq.history.start_ms,
+        }
+
+    @staticmethod
+    def _readings(history, cursor):
+        """(ts_ms, raw_temps) readings newer than ``cursor``, and the updated cursor
+
+        ``cursor`` is the (run_id, end_ms) of the newest run the client has
+        received. Runs are sent as their first and last reading; for the
+        client's newest run only the (moved) last reading is resent.
+        """
+        (cursor_id, cursor_end_ms) = cursor
+        readings = []
+        for (run_id, start_ms, end_ms, raw_temps) in history.runs(cursor_id):
+            if run_id == cursor_id:
+                if end_ms != cursor_end_ms:
+                    readings.append((end_ms, raw_temps))
+            else:
+                readings.append((start_ms, raw_temps))
+                if end_ms != start_ms:
+                    readings.append((end_ms, raw_temps))
+            cursor = (run_id, end_ms)
+        return (readings, cursor)
+
+    @staticmethod
+    def _downsampled(history, points):
+        """Downsampled (ts_ms, raw_temps) readings, and the cursor that follows
+
+        Readings older than FULL_RESOLUTION_WINDOW come from the coarsest
+        aggregate level that still gives about ``points`` readings over the
+        whole history. The returned cursor is where full resolution runs
+        pick up.
+        """
+        cursor = (history.first_id - 1, None)
+        if not history or not points:
+            return ([], cursor)
+
+        boundary_ms = history.end_ms - FULL_RESOLUTION_WINDOW
+        ms_per_point = (history.end_ms - history.start_ms) / points
+        aggregates = [
+            aggregate for aggregate in history.aggregates
+            if aggregate.bucket_ms <= ms_per_point
+        ]
+        if boundary_ms <= history.start_ms or not aggregates:
+            return ([], cursor)
+
+        run_id = history.find_id(boundary_ms)
+        if run_id == history.first_id:
+            return ([], cursor)
+
+        # Hand over to full resolution at the end of the run before the
+        # boundary, so timestamps keep increasing
+        cursor = (run_id - 1, history.run_end_ms(run_id - 1))
+        readings = [
+            (last_ts_ms, raw_last)
+            for (last_ts_ms, _, _, raw_last) in aggregates[-1].buckets(
+                history.start_ms, cursor[1])
+        ]
+        return (readings, cursor)
+
+    def _updates(self, sync, points=None):
+        """Messages bringing ``sync`` up to date, and the updated sync
+
+        ``sync`` itself is left as it is. A full history is downsampled to
+        about ``points`` readings.
+        """
+        sync = dict(sync)
+        updates = []
+
+        if sync["unit"] != self._ibbq.unit:
+            sync["unit"] = self._ibbq.unit
+            updates.append({
+                "cmd": "unit_update",
+                "unit": sync["unit"],
+            })
+
+        history = self._ibbq.history
+        payload = {
+            "cmd": "state_update",
+        }
+
+        # Resend everything if the history was cleared, or the client fell so
+        # far behind that runs it hasn't seen were dropped
+        if (
+            sync["cursor"] is None or
+            sync["epoch"] != history.epoch or
+            sync["cursor"][0] < history.first_id - 1
+        ):
+            sync["epoch"] = history.epoch
+            sync["cursor"] = (history.first_id - 1, None)
+            payload.update({
+                "full_history": True,
+                "epoch": sync["epoch"],
+            })
+
+        readings = []
+        if payload.get("full_history"):
+            (readings, sync["cursor"]) = self._downsampled(history, points)
+        (new_readings, sync["cursor"]) = self._readings(history, sync["cursor"])
+        readings += new_readings
+        if readings or payload.get("full_history"):
+            payload.update({
+                "probe_readings": readings,
+                "seq": sync["cursor"][0],
+            })
+
+        # Only send the state that changed since the last update
+        state = self._state()
+        payload.update({
+            key: value for (key, value) in state.items()
+            if key not in sync["state"] or sync["state"][key] != value
+        })
+        sync["state"] = state
+
+        if len(payload) > 1:
+            updates.append(payload)
+        return (updates, sync)
@@ -0,0 +1,38 @@
+import asyncio
+import gc
+
+from lib.commands import CommandQueue
+
+
+def test_coalesces_pending_commands():
+    async def run():
+        queue = CommandQueue()
+        sent = []
+
+        async def command(value):
+            sent.append(value)
+            return value
+
+        futures = [queue.submit("key", lambda value=value: command(value)) for value in range(5)]
+        assert await asyncio.gather(*futures) == [4] * 5
+        assert sent == [4]
+
+    asyncio.run(run())
+
+
+def test_abandoned_failures_are_retrieved():
+    async def run():
+        loop = asyncio.get_running_loop()
+        unretrieved = []
+        loop.set_exception_handler(lambda _loop, context: unretrieved.append(context))
+
+        async def fail():
+            raise ConnectionError("not connected")
+
+        queue = CommandQueue()
+        queue.submit("key", fail)
+        await asyncio.sleep(0.01)
+        gc.collect()
+        assert not unretrieved
+
+    asyncio.run(run())
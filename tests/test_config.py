@@ -0,0 +1,72 @@
+import asyncio
+import json
+import os
+
+import lib.config
+from lib.config import IbbqWebConfig
+
+TARGET_TEMPS = {
+    0: {"preset": None, "min_temp_c": None, "max_temp_c": 63.0},
+    2: {"preset": "beef", "min_temp_c": 50.0, "max_temp_c": 57.5},
+}
+
+
+def loaded_config(tmp_path, monkeypatch):
+    """A loaded config, counting the writes made after loading"""
+    cfg_file = tmp_path / "ibbqweb.json"
+    cfg_file.write_text("{}")
+    cfg = IbbqWebConfig(str(cfg_file))
+    cfg.load()
+
+    writes = []
+    write_file = cfg._write_file # pylint: disable=protected-access
+    def counting_write_file(data):
+        writes.append(data)
+        write_file(data)
+    monkeypatch.setattr(cfg, "_write_file", counting_write_file)
+    return (cfg, writes)
+
+
+def test_changes_are_written_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(lib.config, "WRITE_DELAY", 0.05)
+    (cfg, writes) = loaded_config(tmp_path, monkeypatch)
+
+    async def run():
+        cfg.unit = 'C'
+        cfg.set_target_temps("AA:BB", {0: TARGET_TEMPS[0]})
+        cfg.set_target_temps("AA:BB", TARGET_TEMPS)
+        assert not writes
+        await asyncio.sleep(0.2)
+        assert len(writes) == 1
+
+        # Nothing pending
+        await cfg.flush()
+        assert len(writes) == 1
+
+    asyncio.run(run())
+
+
+def test_flush_writes_atomically_and_reloads(tmp_path, monkeypatch):
+    (cfg, writes) = loaded_config(tmp_path, monkeypatch)
+
+    async def run():
+        cfg.unit = 'C'
+        cfg.set_target_temps("AA:BB", TARGET_TEMPS)
+        cfg.set_target_temps("CC:DD", {1: TARGET_TEMPS[0]})
+        cfg.set_target_temps("CC:DD", {})
+        # Flushed well before WRITE_DELAY
+        await cfg.flush()
+        assert len(writes) == 1
+
+    asyncio.run(run())
+
+    assert os.listdir(tmp_path) == ["ibbqweb.json"]
+    with open(tmp_path / "ibbqweb.json", encoding="utf-8") as f_obj:
+        assert json.load(f_obj)["unit"] == 'C'
+
+    reloaded = IbbqWebConfig(str(tmp_path / "ibbqweb.json"))
+    reloaded.load()
+    assert reloaded.unit == 'C'
+    assert reloaded.target_temps("AA:BB") == TARGET_TEMPS
+    assert not reloaded.target_temps("CC:DD")
+    assert os.listdir(tmp_path) == ["ibbqweb.json"]
@@ -0,0 +1,40 @@
+import asyncio
+
+import aiohttp.test_utils
+
+from lib.config import IbbqWebConfig
+from lib.devices import DEFAULT_DEVICE_NAME, DeviceRegistry
+from lib.transport import SimulatedTransport
+from lib.webserver import WebServer
+
+
+def registry(addresses=None):
+    return DeviceRegistry(addresses, transport=SimulatedTransport(devices=2))
+
+
+def test_get_is_case_insensitive():
+    devices = registry(["00:00:00:00:00:01", "00:00:00:00:aa:02"])
+    first = devices.get()
+    assert devices.get("00:00:00:00:00:01") is first
+    assert devices.get("00:00:00:00:AA:02") is devices.get("00:00:00:00:aa:02")
+    assert devices.get("00:00:00:00:00:03") is None
+
+    devices = registry()
+    assert devices.get(DEFAULT_DEVICE_NAME) is devices.get()
+    assert devices.get(DEFAULT_DEVICE_NAME.upper()) is devices.get()
+
+
+def test_api_devices_ids_resolve():
+    async def run():
+        for addresses in (None, ["00:00:00:00:00:01", "00:00:00:00:aa:02"]):
+            webserver = WebServer(IbbqWebConfig(), registry(addresses))
+            app = webserver._webapp # pylint: disable=protected-access
+            async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app)) as client:
+                resp = await client.get("/api/devices")
+                ids = [device["id"] for device in await resp.json()]
+                assert len(ids) == len(addresses or [None])
+                for device_id in ids:
+                    resp = await client.get("/api/history", params={"device": device_id})
+                    assert resp.status == 200, device_id
+
+    asyncio.run(run())
@@ -0,0 +1,195 @@
+import asyncio
+import time
+
+from lib.history import NO_PROBE, HistoryLog, ProbeHistory
+
+RETENTION_MS = 60 * 60 * 1000
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def replayed(path, maxlen=1000):
+    history = ProbeHistory(maxlen)
+    HistoryLog(path, RETENTION_MS).replay(history)
+    return [
+        (start_ms, end_ms, list(raw_temps))
+        for (_, start_ms, end_ms, raw_temps) in history.runs()
+    ]
+
+
+def test_log_compacts_and_appends(tmp_path):
+    async def run():
+        path = str(tmp_path / "ibbq.hist")
+        history = ProbeHistory(1000)
+        history_log = HistoryLog(path, RETENTION_MS)
+        start_ms = now_ms()
+        for i in range(10):
+            history.append(start_ms + i, [i // 2, 200])
+            history_log.append(start_ms + i, [i // 2, 200])
+        await history_log.flush(history)    # first flush rewrites from the history
+        for i in range(10, 15):
+            history.append(start_ms + i, [i // 2, 200])
+            history_log.append(start_ms + i, [i // 2, 200])
+        await history_log.flush(history)    # then appends
+        await history_log.flush(history)
+
+        assert replayed(path) == [
+            (run_start_ms, end_ms, list(raw_temps))
+            for (_, run_start_ms, end_ms, raw_temps) in history.runs()
+        ]
+
+    asyncio.run(run())
+
+
+def test_log_cancelled_flush_keeps_readings(tmp_path):
+    async def run():
+        path = str(tmp_path / "ibbq.hist")
+        history = ProbeHistory(1000)
+        history_log = HistoryLog(path, RETENTION_MS)
+        start_ms = now_ms()
+        for i in range(5):
+            history.append(start_ms + i, [i])
+            history_log.append(start_ms + i, [i])
+        await history_log.flush(history)
+
+        for i in range(5, 10):
+            history.append(start_ms + i, [i])
+            history_log.append(start_ms + i, [i])
+        flush = asyncio.create_task(history_log.flush(history))
+        await asyncio.sleep(0)
+        flush.cancel()
+        for i in range(10, 12):
+            history.append(start_ms + i, [i])
+            history_log.append(start_ms + i, [i])
+        await history_log.flush(history)
+
+        # Each reading once, whether or not the cancelled write went through
+        assert replayed(path) == [(start_ms + i, start_ms + i, [i]) for i in range(12)]
+
+    asyncio.run(run())
+
+
+def runs(history, since_id=None):
+    return [
+        (run_id, start_ms, end_ms, list(raw_temps))
+        for (run_id, start_ms, end_ms, raw_temps) in history.runs(since_id)
+    ]
+
+
+def test_wraparound_drops_oldest_runs():
+    history = ProbeHistory(4)
+    for i in range(10):
+        history.append(i * 1000, [i])
+    assert len(history) == 4
+    assert [(start_ms, end_ms, temps) for (_, start_ms, end_ms, temps) in runs(history)] == [
+        (t * 1000, t * 1000, [t]) for t in range(6, 10)
+    ]
+    assert (history.start_ms, history.end_ms) == (6000, 9000)
+    assert history.last_reading()['probes'] == [0.9]
+
+    # Extending the newest run after wrapping around
+    history.append(9500, [9])
+    assert runs(history)[-1][1:] == (9000, 9500, [9])
+    assert history.end_ms == 9500
+
+
+def test_identical_readings_extend_a_run():
+    history = ProbeHistory(10)
+    assert history.append(1000, [200, NO_PROBE])
+    assert not history.append(2000, [200, NO_PROBE])
+    assert history.append(3000, [201, NO_PROBE])
+    assert runs(history) == [
+        (1, 1000, 2000, [200, NO_PROBE]),
+        (2, 3000, 3000, [201, NO_PROBE]),
+    ]
+    assert (history.start_ms, history.end_ms) == (1000, 3000)
+    assert list(history.last_raw_temps) == [201, NO_PROBE]
+
+
+def test_cursor_resume_and_expiry():
+    history = ProbeHistory(4)
+    for i in range(3):
+        history.append(i * 1000, [i])
+    cursor = history.last_id
+    epoch = history.epoch
+
+    history.append(3000, [3])
+    assert [run_id for (run_id, *_) in runs(history, cursor + 1)] == [4]
+
+    # Once the runs after a cursor are dropped, it can't be resumed from
+    for i in range(4, 8):
+        history.append(i * 1000, [i])
+    assert (history.first_id, history.last_id) == (5, 8)
+    assert history.epoch == epoch
+    assert cursor < history.first_id - 1
+    # runs() from a stale id starts at the oldest run still held
+    assert runs(history, cursor + 1)[0][0] == history.first_id
+
+
+def test_epoch_changes_when_cleared():
+    history = ProbeHistory(4)
+    history.append(1000, [1])
+    epoch = history.epoch
+    last_id = history.last_id
+
+    history.clear()
+    assert history.epoch != epoch
+    assert len(history) == 0
+    assert (history.start_ms, history.end_ms) == (None, None)
+    assert history.last_reading() is None
+
+    # Ids carry on, but only mean anything within the new epoch
+    history.append(2000, [2])
+    assert history.first_id == last_id + 1
+
+    # A different probe count starts a new history too
+    epoch = history.epoch
+    history.append(3000, [3, 4])
+    assert history.epoch != epoch
+    assert runs(history) == [(history.last_id, 3000, 3000, [3, 4])]
+
+
+def test_snapshot_is_oldest_first():
+    for count in (3, 4, 7):
+        history = ProbeHistory(4)
+        for i in range(count):
+            history.append(i * 1000, [i, -i])
+        (nprobes, starts, ends, temps) = history.snapshot()
+        assert nprobes == 2
+        assert list(starts) == [start_ms for (_, start_ms, _, _) in runs(history)]
+        assert list(ends) == [end_ms for (_, _, end_ms, _) in runs(history)]
+        assert list(temps) == [t for (_, _, _, raw_temps) in runs(history) for t in raw_temps]
+
+
+def test_find_id_after_wraparound():
+    history = ProbeHistory(4)
+    for i in range(10):
+        history.append(i * 1000, [i])
+    history.append(9500, [9])
+    assert history.find_id(7500) == 9
+    assert history.find_id(9200) == 10
+    assert history.run_end_ms(9) == 8000
+    assert history.run_end_ms(10) == 9500
+
+
+def test_aggregates_outlive_evicted_runs():
+    history = ProbeHistory(8)
+    (tens, _) = history.aggregates
+    # Readings 1s apart, so the first 10s bucket sees runs long since
+    # dropped from the ring buffer
+    for (i, temp) in enumerate([100, 50, 300, 200, 150, 120, 130, 110, 140, 125, 500]):
+        history.append(i * 1000, [temp, NO_PROBE])
+    assert history.start_ms == 3000
+
+    buckets = [
+        (last_ts_ms, list(raw_min), list(raw_max), list(raw_last))
+        for (last_ts_ms, raw_min, raw_max, raw_last) in tens.buckets()
+    ]
+    assert buckets == [
+        (9000, [50, NO_PROBE], [300, NO_PROBE], [125, NO_PROBE]),
+        (10000, [500, NO_PROBE], [500, NO_PROBE], [500, NO_PROBE]),
+    ]
+    assert [b[0] for b in tens.buckets(from_ms=9500)] == [10000]
+    assert [b[0] for b in tens.buckets(to_ms=10000)] == [9000]
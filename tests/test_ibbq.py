@@ -0,0 +1,98 @@
+import struct
+
+import lib.ibbq
+from lib.ibbq import IBBQ
+from lib.transport import SimulatedTransport
+
+NOT_CONNECTED = -10     # 0xfff6
+
+
+def thermometer(max_temp_c=None, min_temp_c=None):
+    ibbq = IBBQ(transport=SimulatedTransport())
+    ibbq.restore_target_temps({0: {"min_temp_c": min_temp_c, "max_temp_c": max_temp_c}})
+    return ibbq
+
+
+def notify(ibbq, *raw_temps):
+    """Feed a temperature notification, returning the probe 0 alert state"""
+    data = struct.pack(f"<{len(raw_temps)}h", *raw_temps)
+    ibbq._cb_realtime_temp_notify(None, data) # pylint: disable=protected-access
+    alert = ibbq.probe_alerts.get(0)
+    return alert["state"] if alert is not None else None
+
+
+def test_high_alert_hysteresis():
+    ibbq = thermometer(max_temp_c=60.0)
+    assert [notify(ibbq, temp, 200) for temp in (590, 599, 600, 605)] == \
+        [None, None, "high", "high"]
+    since = ibbq.probe_alerts[0]["since"]
+
+    # Dipping back under the target doesn't end the alert, until the
+    # probe is the hysteresis (1.0C) below it
+    assert [notify(ibbq, temp, 200) for temp in (599, 595, 591)] == ["high"] * 3
+    assert ibbq.probe_alerts[0]["since"] == since
+    assert notify(ibbq, 590, 200) is None
+    assert not ibbq.target_temp_alert
+
+    # Once ended, it only starts again at the target itself
+    assert [notify(ibbq, temp, 200) for temp in (595, 599, 600)] == [None, None, "high"]
+
+
+def test_low_alert_hysteresis():
+    ibbq = thermometer(min_temp_c=50.0)
+    assert [notify(ibbq, temp) for temp in (510, 501, 500, 495)] == [None, None, "low", "low"]
+    assert [notify(ibbq, temp) for temp in (501, 505, 509)] == ["low"] * 3
+    assert notify(ibbq, 510) is None
+    assert [notify(ibbq, temp) for temp in (505, 500)] == [None, "low"]
+
+
+def test_alert_changes_direction():
+    ibbq = thermometer(min_temp_c=50.0, max_temp_c=60.0)
+    assert notify(ibbq, 600) == "high"
+    assert notify(ibbq, 500) == "low"
+    assert notify(ibbq, 600) == "high"
+    assert notify(ibbq, 550) is None
+
+
+def test_alert_ends_when_probe_unplugged():
+    ibbq = thermometer(max_temp_c=60.0)
+    assert notify(ibbq, 650, 200) == "high"
+    assert notify(ibbq, NOT_CONNECTED, 200) is None
+    assert notify(ibbq, 650, 200) == "high"
+
+
+def test_alerts_only_replaced_on_transitions():
+    ibbq = thermometer(max_temp_c=60.0)
+    notify(ibbq, 600)
+    alerts = ibbq.probe_alerts
+    notify(ibbq, 610)
+    notify(ibbq, 595)
+    assert ibbq.probe_alerts is alerts
+    notify(ibbq, 500)
+    assert ibbq.probe_alerts == {}
+    assert alerts[0]["state"] == "high"
+
+
+def test_alarm_rearms_after_silence(monkeypatch):
+    ibbq = thermometer(max_temp_c=60.0)
+    assert notify(ibbq, 600) == "high"
+    assert ibbq.target_temp_alert
+
+    ibbq._silence_client_alarm() # pylint: disable=protected-access
+    assert not ibbq.target_temp_alert
+    # The probe is still alerting, the alarm is only silenced
+    assert notify(ibbq, 610) == "high"
+    assert not ibbq.target_temp_alert
+
+    # The alarm sounds again once the silence runs out
+    monkeypatch.setattr(lib.ibbq, "ALARM_SILENCE_TIMEOUT", -1)
+    ibbq._silence_client_alarm() # pylint: disable=protected-access
+    assert ibbq.target_temp_alert
+
+    # Setting a new target re-evaluates the probe from scratch, unsilenced
+    monkeypatch.setattr(lib.ibbq, "ALARM_SILENCE_TIMEOUT", 5 * 60)
+    ibbq._silence_client_alarm() # pylint: disable=protected-access
+    ibbq.restore_target_temps({0: {"min_temp_c": None, "max_temp_c": 61.5}})
+    assert not ibbq.probe_alerts
+    assert notify(ibbq, 615) == "high"
+    assert ibbq.target_temp_alert
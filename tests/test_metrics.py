@@ -0,0 +1,77 @@
+import asyncio
+import struct
+
+import aiohttp.test_utils
+
+from lib.config import IbbqWebConfig
+from lib.devices import DeviceRegistry
+from lib.metrics import MetricsRegistry
+from lib.transport import SimulatedTransport
+from lib.webserver import WebServer
+
+
+def test_render_exposition_text():
+    registry = MetricsRegistry()
+    sent = registry.counter("test_sent_total", "Messages sent", ("device",))
+    temps = registry.gauge("test_temperature_celsius", "Probe temperature", ("device", "probe"))
+    latency = registry.histogram("test_seconds", "Send latency", buckets=(0.1, 1.0))
+
+    sent.labels('AA:BB "x"\\y\nz').inc()
+    sent.labels('AA:BB "x"\\y\nz').inc(2)
+    probe_temps = [63.5, None, 20]
+    for probe in range(len(probe_temps)):
+        temps.labels("AA:BB", probe).set_function(lambda probe=probe: probe_temps[probe])
+    latency.labels().observe(0.05)
+    latency.labels().observe(0.5)
+    latency.labels().observe(5)
+
+    assert registry.render() == "\n".join([
+        '# HELP test_sent_total Messages sent',
+        '# TYPE test_sent_total counter',
+        'test_sent_total{device="AA:BB \\"x\\"\\\\y\\nz"} 3',
+        '# HELP test_temperature_celsius Probe temperature',
+        '# TYPE test_temperature_celsius gauge',
+        'test_temperature_celsius{device="AA:BB",probe="0"} 63.5',
+        'test_temperature_celsius{device="AA:BB",probe="2"} 20',
+        '# HELP test_seconds Send latency',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1.0"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        'test_seconds_sum 5.55',
+        'test_seconds_count 3',
+    ]) + "\n"
+
+    # The probe is plugged back in
+    probe_temps[1] = 21.5
+    assert 'test_temperature_celsius{device="AA:BB",probe="1"} 21.5\n' in registry.render()
+
+
+def test_metrics_endpoint():
+    async def run():
+        devices = DeviceRegistry(["00:00:00:00:4D:01"], transport=SimulatedTransport())
+        ibbq = devices.get()
+        # Probe 1 unplugged (0xfff6)
+        data = struct.pack("<3h", 215, -10, 630)
+        ibbq._cb_realtime_temp_notify(None, data) # pylint: disable=protected-access
+        ibbq._cb_realtime_temp_notify(None, data) # pylint: disable=protected-access
+
+        app = WebServer(IbbqWebConfig(), devices)._webapp # pylint: disable=protected-access
+        async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app)) as client:
+            resp = await client.get("/metrics")
+            assert resp.status == 200
+            assert resp.headers["Content-Type"] == MetricsRegistry.CONTENT_TYPE
+            lines = (await resp.text()).splitlines()
+
+        device = 'device="00:00:00:00:4D:01"'
+        assert f'ibbq_notifications_total{{{device}}} 2' in lines
+        assert f'ibbq_notifications_deduplicated_total{{{device}}} 1' in lines
+        assert f'ibbq_notify_seconds_count{{{device}}} 2' in lines
+        assert '# TYPE ibbq_probe_temperature_celsius gauge' in lines
+        probe_temps = f"ibbq_probe_temperature_celsius{{{device}"
+        assert [line for line in lines if line.startswith(probe_temps)] == [
+            f'ibbq_probe_temperature_celsius{{{device},probe="0"}} 21.5',
+            f'ibbq_probe_temperature_celsius{{{device},probe="2"}} 63',
+        ]
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+import random
+
+from lib.history import NO_PROBE
+from lib.predict import ETA_RESOLUTION_MS, CookPredictor, TrendEstimator
+
+WINDOW_MS = 10 * 60 * 1000
+
+
+def least_squares(samples):
+    """(slope, intercept) of the least squares line through (t, value) samples"""
+    n = len(samples)
+    mean_t = sum(t for (t, _) in samples) / n
+    mean_x = sum(x for (_, x) in samples) / n
+    slope = (
+        sum((t - mean_t) * (x - mean_x) for (t, x) in samples) /
+        sum((t - mean_t) ** 2 for (t, _) in samples)
+    )
+    return (slope, mean_x - slope * mean_t)
+
+
+def test_trend_matches_least_squares_as_window_slides():
+    rand = random.Random(1)
+    trend = TrendEstimator(WINDOW_MS)
+    start_ms = 1_700_000_000_000
+    samples = []
+    # A reading every 5s, rising 1C a minute, with noise, for 3 windows
+    for i in range(3 * WINDOW_MS // 5000):
+        ts_ms = start_ms + i * 5000
+        value = 200 + i * 5000 // 6000 + rand.randint(-3, 3)
+        trend.add(ts_ms, value)
+        samples.append((ts_ms, value))
+        window = [(t, x) for (t, x) in samples if t >= ts_ms - WINDOW_MS]
+
+        if i == 0:
+            assert trend.slope() is None
+            continue
+        (slope, intercept) = least_squares(window)
+        assert abs(trend.slope() - slope) < 1e-12
+        assert abs(trend.value_at(ts_ms) - (intercept + slope * ts_ms)) < 1e-6
+        assert trend.span_ms == min(ts_ms - start_ms, WINDOW_MS)
+
+
+def test_trend_of_exact_line():
+    trend = TrendEstimator(WINDOW_MS)
+    for i in range(500):
+        trend.add(i * 1000, 300 + 2 * i)
+    # 2 raw per second, over the last 10 minutes
+    assert trend.slope() == 2 / 1000
+    assert trend.value_at(499 * 1000) == 300 + 2 * 499
+    assert trend.value_at(600 * 1000) == 300 + 2 * 600
+
+
+def rising(predictor, start_ms, minutes, raw_per_minute, raw_start=200):
+    """Readings every 10s for ``minutes``, returning them as (ts_ms, raw)"""
+    samples = []
+    for i in range(minutes * 6 + 1):
+        ts_ms = start_ms + i * 10 * 1000
+        raw = raw_start + raw_per_minute * i // 6
+        predictor.add(ts_ms, [raw, NO_PROBE])
+        samples.append((ts_ms, raw))
+    return samples
+
+
+def test_eta_for_rising_probe():
+    predictor = CookPredictor()
+    # 1C (10 raw) a minute from 20C, for 15 minutes: the window has slid
+    samples = rising(predictor, 0, 15, 10)
+    now_ms = samples[-1][0]
+    (slope, intercept) = least_squares([(t, x) for (t, x) in samples if t >= now_ms - WINDOW_MS])
+    eta_ms = now_ms + (600 - (intercept + slope * now_ms)) / slope
+
+    predictions = predictor.predictions({0: (None, 600)})
+    assert predictions[0]["rate"] == round(slope * 60 * 1000 / 10, 1) == 1.0
+    assert predictions[0]["eta"] == round(eta_ms / ETA_RESOLUTION_MS) * ETA_RESOLUTION_MS
+    # From 35C now to 60C at 1C a minute is about another 25 minutes
+    assert abs(predictions[0]["eta"] - (now_ms + 25 * 60 * 1000)) <= 60 * 1000
+    assert 1 not in predictions
+
+    # No target, or already past it
+    assert predictor.predictions({})[0]["eta"] is None
+    assert predictor.predictions({0: (None, 300)})[0]["eta"] is None
+
+
+def test_no_eta_for_flat_or_falling_probe():
+    for raw_per_minute in (0, -10):
+        predictor = CookPredictor()
+        rising(predictor, 0, 15, raw_per_minute, raw_start=400)
+        predictions = predictor.predictions({0: (None, 600)})
+        assert predictions[0] == {"rate": raw_per_minute / 10, "eta": None}
+
+
+def test_no_prediction_until_min_span():
+    predictor = CookPredictor()
+    rising(predictor, 0, 1, 10)
+    assert not predictor.predictions({0: (None, 600)})
+
+    # An unplugged probe starts over
+    predictor = CookPredictor()
+    now_ms = rising(predictor, 0, 5, 10)[-1][0]
+    assert 0 in predictor.predictions({0: (None, 600)})
+    predictor.add(now_ms + 10 * 1000, [NO_PROBE, NO_PROBE])
+    predictor.add(now_ms + 20 * 1000, [300, NO_PROBE])
+    assert not predictor.predictions({0: (None, 600)})
@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import aiohttp.test_utils
+
+from lib.config import IbbqWebConfig
+from lib.devices import DeviceRegistry
+from lib.transport import SimulatedTransport
+from lib.webserver import WebServer
+
+
+def test_asset_etags(tmp_path):
+    cfg_file = tmp_path / "ibbqweb.json"
+    cfg_file.write_text(json.dumps({"compression": {"static": True}}))
+    cfg = IbbqWebConfig(str(cfg_file))
+    cfg.load()
+
+    async def run():
+        webserver = WebServer(cfg, DeviceRegistry(transport=SimulatedTransport()))
+        webserver._assets.build() # pylint: disable=protected-access
+        app = webserver._webapp # pylint: disable=protected-access
+        async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app)) as client:
+            etags = set()
+            for coding in ("identity", "gzip"):
+                headers = {"Accept-Encoding": coding}
+                resp = await client.get("/assets/js/app.js", headers=headers, auto_decompress=False)
+                assert resp.status == 200
+                assert resp.headers["Cache-Control"] == "no-cache"
+                expected_coding = None if coding == "identity" else coding
+                assert resp.headers.get("Content-Encoding") == expected_coding
+                etag = resp.headers["ETag"]
+                assert not etag.startswith("W/")
+                etags.add(etag)
+
+                resp = await client.get("/assets/js/app.js", headers={
+                    **headers, "If-None-Match": etag,
+                })
+                assert resp.status == 304
+            assert len(etags) == 2
+
+            resp = await client.get("/")
+            html = await resp.text()
+            url = html.split('src="/assets/js/app.js')[1].split('"')[0]
+            resp = await client.get("/assets/js/app.js" + url)
+            assert "immutable" in resp.headers["Cache-Control"]
+
+    asyncio.run(run())
+
+
+async def cmd_result(wsock):
+    """The next command result sent to ``wsock``, skipping state updates"""
+    while True:
+        reply = json.loads(await wsock.receive_str())
+        if "cmd_result" in reply:
+            return reply["cmd_result"]
+
+
+def test_ws_invalid_commands_get_results():
+    async def run():
+        devices = DeviceRegistry(transport=SimulatedTransport())
+        # A reading, so the device has 4 probes
+        devices.get().history.append(1000, [200, 210, 220, 230])
+        webserver = WebServer(IbbqWebConfig(), devices)
+        app = webserver._webapp # pylint: disable=protected-access
+        target = {"cmd": "set_probe_target_temp", "probe": 0, "preset": None,
+                  "min_temp": None, "max_temp": 60}
+        msgs = ['[1, 2]', '"poweroff"', '{"cmd": "nope", "id": 7}', '{'] + [
+            json.dumps({**target, **bad}) for bad in (
+                {"probe": 4},
+                {"probe": 300},
+                {"probe": "0"},
+                {"probe": True},
+                {"min_temp": "60"},
+                {"max_temp": "60"},
+                {"max_temp": 1000},
+                {"min_temp": -500},
+                {"max_temp": [60]},
+            )
+        ]
+        async with aiohttp.test_utils.TestClient(aiohttp.test_utils.TestServer(app)) as client:
+            async with client.ws_connect("/ws") as wsock:
+                for msg in msgs:
+                    await wsock.send_str(msg)
+                    result = await cmd_result(wsock)
+                    assert result["ok"] is False
+                    assert result["error"].startswith("Invalid command")
+
+                # Nothing reaches a disconnected device
+                await wsock.send_str(json.dumps({"cmd": "set_unit", "unit": "F", "id": 8}))
+                assert await cmd_result(wsock) == {
+                    "id": 8, "cmd": "set_unit", "ok": False, "error": "Device not connected",
+                }
+
+    asyncio.run(run())
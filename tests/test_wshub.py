@@ -0,0 +1,203 @@
+import asyncio
+import itertools
+import json
+
+from lib.history import NO_PROBE, ProbeHistory
+from lib.wshub import ENCODINGS, MAX_QUEUED_UPDATES, WebSocketHub
+
+
+class FakeIBBQ: # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, maxlen=1000):
+        self.device_id = "test"
+        self.history = ProbeHistory(maxlen)
+        self.unit = "C"
+        self.connected = True
+        self.battery_level = 100
+        self.target_temps = {}
+        self.target_temp_alert = False
+        self.probe_alerts = {}
+        self.predictions = {}
+
+
+class FakeWebSocket:
+    """Records the readings sent to it; sends block while ``stalled`` is clear"""
+
+    def __init__(self):
+        self.stalled = asyncio.Event()
+        self.stalled.set()
+        self.readings = []
+        self.full_histories = 0
+
+    async def send_str(self, msg):
+        await self.stalled.wait()
+        payload = json.loads(msg)
+        if payload.get("full_history"):
+            self.full_histories += 1
+            self.readings = []
+        self.readings += [reading["ts"] for reading in payload.get("probe_readings", [])]
+
+    async def close(self):
+        pass
+
+
+def append(ibbq, hub, ts_ms):
+    # A new run for every reading
+    ibbq.history.append(ts_ms, [ts_ms % 1000])
+    hub.publish()
+
+
+async def drain():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_resume_from_cursor():
+    async def run():
+        ibbq = FakeIBBQ()
+        hub = WebSocketHub(ibbq)
+        for ts_ms in range(1, 11):
+            append(ibbq, hub, ts_ms)
+
+        wsock = FakeWebSocket()
+        client = hub.subscribe(wsock, (5, None))
+        await drain()
+        assert wsock.full_histories == 0
+        # The client's newest run is resent, in case it was extended
+        assert wsock.readings == list(range(5, 11))
+        await hub.unsubscribe(client)
+
+    asyncio.run(run())
+
+
+def test_expired_cursor_gets_full_history():
+    async def run():
+        ibbq = FakeIBBQ(maxlen=10)
+        hub = WebSocketHub(ibbq)
+        for ts_ms in range(1, 21):
+            append(ibbq, hub, ts_ms)
+
+        wsock = FakeWebSocket()
+        client = hub.subscribe(wsock, (5, None))
+        await drain()
+        assert wsock.full_histories == 1
+        assert wsock.readings == list(range(11, 21))
+        await hub.unsubscribe(client)
+
+    asyncio.run(run())
+
+
+def test_stalled_clients_resync_independently():
+    async def run():
+        ibbq = FakeIBBQ()
+        hub = WebSocketHub(ibbq)
+        append(ibbq, hub, 1)
+        wsocks = [FakeWebSocket(), FakeWebSocket()]
+        clients = [hub.subscribe(wsock, None) for wsock in wsocks]
+        await drain()
+
+        # Both block sending the same update, then one more update than
+        # fits in their queues overflows them
+        for wsock in wsocks:
+            wsock.stalled.clear()
+        append(ibbq, hub, 2)
+        await drain()
+        stalled = MAX_QUEUED_UPDATES + 3
+        for ts_ms in range(3, stalled + 1):
+            append(ibbq, hub, ts_ms)
+        assert not any(client.synced for client in clients)
+
+        # Unstalled one at a time, so each resyncs after the other has
+        for wsock in wsocks:
+            wsock.stalled.set()
+            await drain()
+            stalled += 1
+            append(ibbq, hub, stalled)
+            await drain()
+
+        for wsock in wsocks:
+            assert wsock.full_histories == 1
+            assert wsock.readings == list(range(1, stalled + 1))
+        for client in clients:
+            await hub.unsubscribe(client)
+
+    asyncio.run(run())
+
+
+def test_resync_keeps_points():
+    async def run():
+        ibbq = FakeIBBQ()
+        hub = WebSocketHub(ibbq)
+        wsock = FakeWebSocket()
+        client = hub.subscribe(wsock, None, points=100)
+        await drain()
+
+        wsock.stalled.clear()
+        for ts_ms in range(1, MAX_QUEUED_UPDATES + 2):
+            append(ibbq, hub, ts_ms)
+        assert not client.synced
+        assert "points" not in client.sync
+        assert client.points == 100
+        await hub.unsubscribe(client)
+
+    asyncio.run(run())
+
+
+def decode_columnar(readings):
+    """Readings as [(ts_ms, [raw or None, ...]), ...], like websocket.js decodeReadings()"""
+    ts_col = list(itertools.accumulate(readings["ts"]))
+    probe_cols = []
+    for column in readings["probes"]:
+        (temp, decoded) = (0, [])
+        for delta in column:
+            if delta is not None:
+                temp += delta
+            decoded.append(None if delta is None else temp)
+        probe_cols.append(decoded)
+    return [
+        (ts_ms, [column[i] for column in probe_cols])
+        for (i, ts_ms) in enumerate(ts_col)
+    ]
+
+
+def test_columnar_encoding_round_trips():
+    history = ProbeHistory(100)
+    start_ms = 1_700_000_000_000
+    # Probe 1 is unplugged for a while, then comes back hotter; probe 2
+    # is never plugged in
+    for (i, temps) in enumerate([
+            [200, 210, NO_PROBE],
+            [200, 210, NO_PROBE],
+            [205, 180, NO_PROBE],
+            [207, NO_PROBE, NO_PROBE],
+            [209, NO_PROBE, NO_PROBE],
+            [-15, 450, NO_PROBE],
+            [-12, 440, NO_PROBE]]):
+        history.append(start_ms + i * 1000 + i % 3, temps)
+
+    # pylint: disable-next=protected-access
+    (readings, cursor) = WebSocketHub._readings(history, (history.first_id - 1, None))
+    payload = {
+        "cmd": "state_update",
+        "probe_readings": readings,
+        "seq": cursor[0],
+        "battery_level": 90,
+    }
+    rows = json.loads(ENCODINGS["json"](payload))
+    columnar = json.loads(ENCODINGS["columnar"](payload))
+    decoded = decode_columnar(columnar["readings"])
+
+    # Only the readings are encoded differently
+    assert columnar.pop("readings") is not None
+    assert columnar == {key: value for (key, value) in rows.items() if key != "probe_readings"}
+    assert decoded == [
+        (row["ts"], [None if temp is None else round(temp * 10) for temp in row["probes"]])
+        for row in rows["probe_readings"]
+    ]
+    assert [raw_temps for (_, raw_temps) in decoded] == [
+        [None if t == NO_PROBE else t for t in raw_temps] for (_, raw_temps) in readings
+    ]
+    assert len(decoded) == 7
+
+    # No readings
+    payload = {"cmd": "state_update", "probe_readings": [], "seq": 0}
+    assert json.loads(ENCODINGS["columnar"](payload))["readings"] == {"ts": [], "probes": []}
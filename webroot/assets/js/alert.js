@@ -2,6 +2,7 @@ import * as Utils from './utils.js';
 import * as WS from './websocket.js';
 
 let alertModal = null;
+let alertMessageEl = null;
 let inStopHandler = false;
 
 const alertAudio = new Audio('/assets/audio/AlertTone.mp3');
@@ -82,6 +83,7 @@ const initAlertModal = () => {
 
    const obj = Utils.renderModal(html);
    alertModal = obj.modal;
+   alertMessageEl = obj.element.querySelector('.modal-body');
 
    obj.element.addEventListener('hide.bs.modal', (e) => {
       alertAudio.pause();
@@ -104,6 +106,18 @@ const start = () => {
    }
 };
 
+// Lines describing which probes are alerting, or null for the generic message
+const setMessage = (lines) => {
+   if (alertMessageEl != null) {
+      alertMessageEl.replaceChildren();
+      for (const line of lines || ['Target temperature alert!']) {
+         const div = document.createElement('div');
+         div.textContent = line;
+         alertMessageEl.append(div);
+      }
+   }
+};
+
 const stop = () => {
    if (alertModal != null) {
       inStopHandler = true;
@@ -116,4 +130,5 @@ export {
    init,
    start,
    stop,
+   setMessage,
 };
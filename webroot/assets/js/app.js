@@ -1,15 +1,23 @@
 import * as Alert from './alert.js';
 import * as Bootstrap from 'bootstrap';
 import CanvasJS from 'canvasjs';
+import * as ChartData from './chartdata.js';
 import * as Chromecast from './chromecast.js';
+import * as HistoryCache from './historycache.js';
 import * as PWA from './pwa.js';
 import * as Utils from './utils.js';
 import * as WS from './websocket.js';
 
 let chart;
 
-let chartRenderTimeoutId = -1;
-let chartRenderMs = Date.now()
+let chartRenderRequested = false
+// Zoomed in range [min, max] of the chart, or null when zoomed out
+let chartViewport = null
+
+// Server only sends state that changed, so keep the latest copy around
+let targetTemps = {};
+let predictions = {};
+let historyEpoch = null;
 
 // Match .probe-container:nth-child(...) .probe-idx .dot
 const probeColors = [
@@ -245,6 +253,9 @@ const renderProbe = (idx) => {
             <div class="row row-cols-1">
               <div class="col probe-temp-target">&nbsp;</div>
             </div>
+            <div class="row row-cols-1">
+              <div class="col probe-eta">&nbsp;</div>
+            </div>
           </div>
           <div class="col-2 probe-settings">
             <a href="#" class="text-dark" data-bs-toggle="modal" data-bs-target="#probeSettingsModal">
@@ -261,76 +272,71 @@ const renderProbe = (idx) => {
    return el;
 }
 
-const appendChartData = (probeReading) => {
-   // When the temp remains the same, we just need the first/last timestamps
-   // of those values to draw a straight line.
-   //
-   // Because the tooltip is shared across all data sets, we need to add a
-   // datapoint to all data sets any time one temp changes so the toolip
-   // shows all temps
-   const lastReadings = chart.options.data.map(d => d.dataPoints.slice(-2))
-   const duplicateReading =
-      lastReadings.length == probeReading.probes.length &&
-      lastReadings.every(dp => dp.length == 2) &&
-      lastReadings.every((dp, i) =>
-         probeReading['probes'][i] == dp[1].tempC && dp[1].tempC == dp[0].tempC
-      );
-
-   for (const [i, tempC] of probeReading.probes.entries()) {
-      const probeEl = document.querySelector(`.probe-container[data-ibbq-probe-idx="${i}"]`) ||
-                      renderProbe(i);
+const addProbes = (numProbes) => {
+   for (let i = chart.options.data.length; i < numProbes; i++) {
+      if (!document.querySelector(`.probe-container[data-ibbq-probe-idx="${i}"]`)) {
+         renderProbe(i);
+      }
 
-      probeEl.getElementsByClassName('probe-temp-current')[0].innerHTML =
-         tempC === null ? '--' : tempFromC(tempC) + "&deg;"
+      const probeColor = i <= probeColors.length ? probeColors[i] : "#000"
+      chart.options.data.push({
+         type: "line",
+         markerSize: 0,
+         name: "Probe " + (i+1),
+         showInLegend: true,
+         legendText: "N/A",
+         color: probeColor,
+         xValueType: "dateTime",
+         dataPoints: [],
+      })
 
-      if (chart.options.data.length < i + 1) {
-         const probeColor = i <= probeColors.length ? probeColors[i] : "#000"
-         chart.options.data.push({
-            type: "line",
-            markerSize: 0,
-            name: "Probe " + (i+1),
-            showInLegend: true,
-            legendText: "N/A",
-            color: probeColor,
-            xValueType: "dateTime",
-            dataPoints: [],
-         })
-
-         chart.options.axisY.stripLines.push({
-            value: null,
-            opacity: 0,
-            color: probeColor,
-            labelFontColor: probeColor,
-            label: "Probe " + (i+1) + " Target",
-            labelBackgroundColor: 'transparent',
-            labelFormatter: (e) => {
-               const sl = e.stripLine
-               if (sl.startValue !== null && sl.endValue !== null) {
-                  return sl.startValue + '° ~ ' + sl.endValue + '°'
-               } else if (sl.value !== null) {
-                  return sl.value + '°'
-               } else {
-                  return ''
-               }
-            },
-         })
-      }
+      chart.options.axisY.stripLines.push({
+         value: null,
+         opacity: 0,
+         color: probeColor,
+         labelFontColor: probeColor,
+         label: "Probe " + (i+1) + " Target",
+         labelBackgroundColor: 'transparent',
+         labelFormatter: (e) => {
+            const sl = e.stripLine
+            if (sl.startValue !== null && sl.endValue !== null) {
+               return sl.startValue + '° ~ ' + sl.endValue + '°'
+            } else if (sl.value !== null) {
+               return sl.value + '°'
+            } else {
+               return ''
+            }
+         },
+      })
+   }
+}
 
+const renderCurrentTemps = () => {
+   for (const [i, tempC] of (ChartData.lastTemps() || []).entries()) {
+      const probeEl = document.querySelector(`.probe-container[data-ibbq-probe-idx="${i}"]`)
+      probeEl.getElementsByClassName('probe-temp-current')[0].innerHTML =
+         tempC === null ? '--' : tempFromC(tempC) + "&deg;"
       chart.options.data[i].legendText =
          tempC != null ? tempFromC(tempC) + "°" : "N/A"
+   }
+}
 
-      if (duplicateReading) {
-         lastReadings[i][1].x = probeReading.ts;
-      } else {
-         chart.options.data[i].dataPoints.push({
-            x: probeReading.ts,
-            y: tempFromC(tempC),
-            tempC: tempC,
-         })
-      }
+/*
+ * Add readings, as columns (see WS.decodeReadings()), to the chart. They are
+ * stored all at once, and the probe temps are updated from the latest only;
+ * the chart itself is updated by the next renderChart().
+ */
+const appendChartData = (readings) => {
+   if (!readings.ts.length) {
+      return
    }
 
-   if (probeReading.ts >= chart.options.axisX.maximum) {
+   ChartData.append(readings)
+   addProbes(ChartData.numProbes())
+   renderCurrentTemps()
+
+   const lastTs = readings.ts[readings.ts.length - 1]
+   while (lastTs >= chart.options.axisX.maximum) {
       // Increase by 25%
       const min = chart.options.axisX.minimum
       const max = chart.options.axisX.maximum
@@ -338,40 +344,39 @@ const appendChartData = (probeReading) => {
    }
 }
 
-const renderChart = (minRenderIntervalMs=50) => {
-   if (document.visibilityState != "visible") {
-      // No reason to re-render the graph if the browser/tab is hidden
+// Render the chart with any changes, once per animation frame at most
+const renderChart = () => {
+   if (chartRenderRequested) {
       return
    }
+   chartRenderRequested = true
+   requestAnimationFrame(() => {
+      chartRenderRequested = false
 
-   if (!document.querySelector('button[aria-controls="graph"]').classList.contains("active")) {
-      // No reason to re-render the graph if a different navigation tab is
-      // selected
-      return
-   }
+      if (document.visibilityState != "visible") {
+         // No reason to re-render the graph if the browser/tab is hidden
+         return
+      }
 
-   // Don't re-render too often. Ex: if browser has been sleeping, when it
-   // awakens it might process 10s+ update messages from the websocket all
-   // at once... wait for them all to be processed before rendering the final
-   // result.
-   const msSinceLastRender = Date.now() - chartRenderMs;
-   chartRenderMs = Date.now();
-   if (msSinceLastRender < minRenderIntervalMs) {
-      clearTimeout(chartRenderTimeoutId)
-      chartRenderTimeoutId = setTimeout(renderChart, 50)
-      return
-   }
+      if (!document.querySelector('button[aria-controls="graph"]').classList.contains("active")) {
+         // No reason to re-render the graph if a different navigation tab is
+         // selected
+         return
+      }
 
-   chart.render()
+      ChartData.updateDataPoints(chart.options.data, tempFromC, chartViewport)
+      chart.render()
+   })
 }
 
-const resetChartData = (probe_readings) => {
+const resetChartData = (readings) => {
+   ChartData.reset()
    chart.options.data = []
    chart.options.axisY.stripLines = []
    let xMin = new Date().getTime()
-   for (const reading of probe_readings) {
-      if (reading.probes.some(temp => temp != null)) {
-         xMin = reading.ts
+   for (const [i, ts] of readings.ts.entries()) {
+      if (readings.probes.some(column => column[i] != null && column[i] != ChartData.NO_PROBE)) {
+         xMin = ts
          break
       }
    }
@@ -390,69 +395,165 @@ const wsOnClose = (e) => {
    }
 };
 
+const trimChartData = (minTs) => {
+   ChartData.trim(minTs)
+}
+
+/*
+ * Draw the chart from the readings cached by the last visit, and have the
+ * websocket resume from where they end
+ */
+const loadCachedChartData = async () => {
+   const cached = await HistoryCache.load(WS.deviceId())
+   if (!cached) {
+      return
+   }
+
+   historyEpoch = cached.epoch
+   resetChartData(cached.readings)
+   appendChartData(cached.readings)
+   renderChart()
+   WS.setHistoryCursor(cached.epoch, cached.seq)
+}
+
+const renderTargetTemps = () => {
+   for (const i of chart.options.data.keys()) {
+      const probeContainer = document.querySelector(`.probe-container[data-ibbq-probe-idx="${i}"]`)
+      const targetTemp = targetTemps[i]
+
+      if (targetTemp !== undefined) {
+         if (targetTemp.preset == null) {
+            delete probeContainer.dataset.ibbqPreset;
+         } else {
+            probeContainer.dataset.ibbqPreset = targetTemp.preset;
+         }
+
+         if (targetTemp.min_temp == null) {
+            delete probeContainer.dataset.ibbqTempMin;
+         } else {
+            probeContainer.dataset.ibbqTempMin = tempFromC(targetTemp.min_temp);
+         }
+
+         if (targetTemp.max_temp == null) {
+            delete probeContainer.dataset.ibbqTempMax;
+         } else {
+            probeContainer.dataset.ibbqTempMax = tempFromC(targetTemp.max_temp);
+         }
+      } else {
+         delete probeContainer.dataset.ibbqPreset;
+         delete probeContainer.dataset.ibbqTempMin;
+         delete probeContainer.dataset.ibbqTempMax;
+      }
+
+      updateProbeTempTarget(i)
+   }
+}
+
+const renderPredictions = () => {
+   for (const probeEl of document.querySelectorAll('.probe-container')) {
+      const prediction = predictions[probeEl.dataset.ibbqProbeIdx]
+      const etaEl = probeEl.getElementsByClassName('probe-eta')[0]
+      if (!prediction) {
+         etaEl.innerHTML = '&nbsp;'
+         continue
+      }
+
+      // Rate is a difference, so scale but don't offset it for F
+      const rate = isUnitF() ? prediction.rate * 9 / 5 : prediction.rate
+      let text = `${rate > 0 ? '+' : ''}${rate.toFixed(1)}&deg;/min`
+      if (prediction.eta) {
+         const eta = new Date(prediction.eta).toLocaleTimeString([], {hour: 'numeric', minute: '2-digit'})
+         text = `ETA ${eta} &middot; ${text}`
+      }
+      etaEl.innerHTML = text
+   }
+}
+
+const renderProbeAlerts = (probeAlerts) => {
+   const lines = []
+   for (const probeEl of document.querySelectorAll('.probe-container')) {
+      const alert = probeAlerts[probeEl.dataset.ibbqProbeIdx]
+      if (alert) {
+         probeEl.dataset.ibbqAlert = alert.state
+         const since = new Date(alert.since).toLocaleTimeString([], {hour: 'numeric', minute: '2-digit'})
+         lines.push(`Probe ${parseInt(probeEl.dataset.ibbqProbeIdx) + 1} is ` +
+                    `${alert.state == 'high' ? 'above' : 'below'} its target since ${since}`)
+      } else {
+         delete probeEl.dataset.ibbqAlert
+      }
+   }
+   Alert.setMessage(lines.length ? lines : null)
+}
+
 const wsOnMessage = (e) => {
    const data = JSON.parse(e.data)
+   if (data.readings !== undefined) {
+      data.probe_readings = WS.decodeReadings(data.readings)
+   }
 
+   // state_update only includes the fields that changed since the last one
    if (data.cmd == "state_update") {
       /*
        * Update connection status
        */
-      renderConnectionState(data.connected ?
-                             ConnectionState.CONNECTED: ConnectionState.DISCONNECTED);
+      if (data.connected !== undefined) {
+         renderConnectionState(data.connected ?
+                                ConnectionState.CONNECTED: ConnectionState.DISCONNECTED);
+      }
 
       /*
        * Update battery status
        */
-      renderBatteryLevel(data.battery_level);
+      if (data.battery_level !== undefined) {
+         renderBatteryLevel(data.battery_level);
+      }
 
       /*
        * Update probe data (probe and chart tabs)
        */
       if (data.full_history) {
+         historyEpoch = data.epoch
          resetChartData(data.probe_readings)
+         HistoryCache.reset(data.epoch)
+      } else if (data.history_start != null) {
+         // Oldest readings were dropped from the server's history
+         trimChartData(data.history_start)
+         HistoryCache.trim(data.history_start)
       }
 
-      if (data.full_history || data.connected) {
-         for (const reading of data.probe_readings) {
-            appendChartData(reading);
-         }
-
-         for (const i of data.probe_readings[0].probes.keys()) {
-            const probeContainer = document.querySelector(`.probe-container[data-ibbq-probe-idx="${i}"]`)
-            const targetTemp = data.target_temps[i]
-
-            if (targetTemp !== undefined) {
-               if (targetTemp.preset == null) {
-                  delete probeContainer.dataset.ibbqPreset;
-               } else {
-                  probeContainer.dataset.ibbqPreset = targetTemp.preset;
-               }
+      const numProbes = chart.options.data.length
+      if (data.probe_readings) {
+         appendChartData(data.probe_readings);
+      }
 
-               if (targetTemp.min_temp == null) {
-                  delete probeContainer.dataset.ibbqTempMin;
-               } else {
-                  probeContainer.dataset.ibbqTempMin = tempFromC(targetTemp.min_temp);
-               }
+      if (data.seq !== undefined) {
+         WS.setHistoryCursor(historyEpoch, data.seq)
+         HistoryCache.append(data.probe_readings, data.seq)
+      }
 
-               if (targetTemp.max_temp == null) {
-                  delete probeContainer.dataset.ibbqTempMax;
-               } else {
-                  probeContainer.dataset.ibbqTempMax = tempFromC(targetTemp.max_temp);
-               }
-            } else {
-               delete probeContainer.dataset.ibbqPreset;
-               delete probeContainer.dataset.ibbqTempMin;
-               delete probeContainer.dataset.ibbqTempMax;
-            }
+      if (data.target_temps !== undefined) {
+         targetTemps = data.target_temps
+      }
+      if (data.target_temps !== undefined || chart.options.data.length != numProbes) {
+         renderTargetTemps()
+      }
 
-            updateProbeTempTarget(i)
-         }
+      if (data.predictions !== undefined) {
+         predictions = data.predictions
+      }
+      if (data.predictions !== undefined || chart.options.data.length != numProbes) {
+         renderPredictions()
+      }
 
-         renderChart()
+      renderChart()
 
-         /*
-          * Update target temp alert
-          */
+      /*
+       * Update target temp alert
+       */
+      if (data.probe_alerts !== undefined) {
+         renderProbeAlerts(data.probe_alerts)
+      }
+      if (data.target_temp_alert !== undefined) {
          if (data.target_temp_alert) {
             Alert.start();
          } else {
@@ -461,15 +562,67 @@ const wsOnMessage = (e) => {
       }
    } else if (data.cmd == "unit_update") {
       setUnit(data.unit == "C");
+      renderTargetTemps()
+      renderPredictions()
 
       // Update chart
-      for (const dataSeries of chart.options.data) {
-         for (const dataPoint of dataSeries.dataPoints) {
-            dataPoint.y = tempFromC(dataPoint.tempC)
+      renderCurrentTemps()
+      ChartData.invalidate()
+      renderChart()
+   }
+}
+
+let importWorker = null
+
+/*
+ * Show a saved data file (see importworker.js for the formats) in place of
+ * the live readings. The file is parsed by a worker, which hands over the
+ * readings in batches, so even multi-day files don't block the page.
+ */
+const importSavedData = (file) => {
+   importWorker && importWorker.terminate()
+   const worker = new Worker(import.meta.resolve('./importworker.js'))
+   importWorker = worker
+   const progress = renderToastImportProgress(file.name)
+   let first = true
+
+   const finish = () => {
+      worker.terminate()
+      if (importWorker === worker) {
+         importWorker = null
+      }
+      progress.toast.hide()
+   }
+
+   worker.onmessage = (e) => {
+      const msg = e.data
+      if (msg.progress !== undefined) {
+         progress.setProgress(msg.progress)
+      } else if (msg.readings) {
+         if (first) {
+            // Disconnect from server
+            WS.disconnect();
+            WS.clearHistoryCursor();
+            resetChartData(msg.readings)
+            first = false
          }
+         appendChartData(msg.readings)
+         renderChart()
+      } else if (msg.done !== undefined) {
+         console.log(`Loaded ${msg.done} readings from "${file.name}"`)
+         finish()
+      } else if (msg.error !== undefined) {
+         console.log(`Error parsing saved data file "${file.name}": ${msg.error}`)
+         finish()
+         renderToastInvalidData();
       }
-      renderChart(0)
    }
+   worker.onerror = (e) => {
+      console.log(`Error parsing saved data file "${file.name}": ${e.message}`)
+      finish()
+      renderToastInvalidData();
+   }
+   worker.postMessage(file)
 }
 
 const requestWakeLock = async () => {
@@ -486,6 +639,32 @@ const requestWakeLock = async () => {
    }
 };
 
+const renderToastImportProgress = (filename) => {
+   const html = `
+      <div class="toast align-items-center" role="status" aria-live="polite" aria-atomic="true" data-bs-autohide="false">
+        <div class="toast-header">
+          <i class="bi bi-upload me-1"></i>
+          <strong class="me-auto">Loading saved data</strong>
+        </div>
+        <div class="toast-body">
+          <div class="text-truncate mb-1"></div>
+          <div class="progress" role="progressbar" aria-label="Loading saved data" aria-valuemin="0" aria-valuemax="100" aria-valuenow="0">
+            <div class="progress-bar" style="width: 0%"></div>
+          </div>
+        </div>
+      </div>
+   `;
+
+   const obj = Utils.renderToast(html);
+   obj.element.querySelector('.text-truncate').textContent = filename;
+   obj.setProgress = (fraction) => {
+      const percent = Math.round(fraction * 100);
+      obj.element.querySelector('.progress').setAttribute('aria-valuenow', percent);
+      obj.element.querySelector('.progress-bar').style.width = `${percent}%`;
+   };
+   return obj;
+}
+
 const renderToastInvalidData = () => {
    const html = `
       <div class="toast align-items-center" role="alert" aria-live="assertive" aria-atomic="true">
@@ -567,9 +746,16 @@ const initChart = () => {
          itemclick: (e) => {
             e.dataSeries.visible = e.dataSeries.visible !== undefined &&
                                    !e.dataSeries.visible
-            renderChart(0)
+            renderChart()
          }
       },
+      rangeChanged: (e) => {
+         // Show the zoomed in range at full resolution
+         chartViewport = e.trigger == "reset" ? null :
+                         [e.axisX[0].viewportMinimum, e.axisX[0].viewportMaximum]
+         ChartData.invalidate()
+         renderChart()
+      },
       toolTip: {
          shared: true,
          contentFormatter: (e) => {
@@ -619,11 +805,33 @@ const initChart = () => {
 
    // Workaround graph not rendering correct size initially
    document.querySelector('button[aria-controls="graph"]').addEventListener(
-      'shown.bs.tab', (e) => renderChart(0)
+      'shown.bs.tab', (e) => renderChart()
    );
 }
 
 const initFormFields = () => {
+   /*
+    * Thermometer, only shown when the server has more than one
+    */
+   const deviceEl = document.getElementById("ibbq-device");
+   fetch('/api/devices').then((response) => response.json()).then((devices) => {
+      if (devices.length < 2) {
+         return;
+      }
+      const selected = WS.deviceId() || devices[0].id;
+      for (const device of devices) {
+         deviceEl.add(new Option(device.id, device.id, false, device.id == selected));
+      }
+      document.getElementById("ibbq-device-row").classList.remove('d-none');
+   }).catch((error) => {
+      console.warn(`Failed to list devices: ${error}`);
+   });
+   deviceEl.addEventListener('change', (e) => {
+      const url = new URL(window.location);
+      url.searchParams.set('device', e.target.value);
+      window.location.assign(url);
+   });
+
    /*
     * Temperature Unit
     */
@@ -641,31 +849,15 @@ const initFormFields = () => {
     */
    document.getElementById("chart-min-y").addEventListener('change', (e) => {
       chart.options.axisY.minimum = parseInt(e.target.value);
-      renderChart(0);
+      renderChart();
    });
 
    /*
     * Save Chart Data
     */
    document.getElementById('ibbq-download').addEventListener('click', (e) => {
-      const probe_readings = new Map()
-      for (const [i, dataSeries] of chart.options.data.entries()) {
-         for (const dataPoint of dataSeries.dataPoints) {
-            if (probe_readings.get(dataPoint.x) == undefined) {
-               probe_readings.set(dataPoint.x, [])
-            }
-            probe_readings.get(dataPoint.x)[i] = dataPoint.tempC
-         }
-      }
-
       const data = {
-         'probe_readings': Array.from(probe_readings.keys()).reduce((result, ts) => {
-            result.push({
-               'ts': ts,
-               'probes': probe_readings.get(ts)
-            })
-            return result
-          }, []),
+         'probe_readings': ChartData.rows(),
       }
 
       const blob = new Blob([JSON.stringify(data)], {type: 'application/json'}) // text/plain
@@ -677,28 +869,11 @@ const initFormFields = () => {
     * View Saved Data
     */
    document.getElementById('ibbq-upload').addEventListener('change', (e) => {
-      new Blob(e.target.files).text().then((text) => {
-         const data = JSON.parse(text)
-
-         const isValidProbeReading = (r) => {
-            return Number.isInteger(r.ts) && Array.isArray(r.probes) && r.probes.every((p) => p == null || Number.isInteger(p))
-         }
-
-         if (!data.probe_readings || !data.probe_readings.every(isValidProbeReading)) {
-            throw new Error('Invalid data structure')
-         }
-
-         // Disconnect from server
-         WS.disconnect();
-
-         resetChartData(data.probe_readings)
-         for (const reading of data.probe_readings) {
-            appendChartData(reading);
-         }
-      }).catch((ex) => {
-         console.log('Error parsing saved data file "' + e.target.files[0].name + '": ' + ex.message)
-         renderToastInvalidData();
-      })
+      if (e.target.files.length) {
+         importSavedData(e.target.files[0])
+      }
+      // Allow the same file to be picked again
+      e.target.value = ''
    });
 
    /*
@@ -798,10 +973,14 @@ document.addEventListener('readystatechange', (e) => {
       requestWakeLock();
       document.addEventListener("visibilitychange", requestWakeLock);
 
-      WS.init({
-         onopen: wsOnOpen,
-         onclose: wsOnClose,
-         onmessage: wsOnMessage,
+      loadCachedChartData().finally(() => {
+         WS.init({
+            onopen: wsOnOpen,
+            onclose: wsOnClose,
+            onmessage: wsOnMessage,
+            // About one reading per pixel of chart width is plenty
+            historyPoints: () => Math.round(window.innerWidth * (window.devicePixelRatio || 1)),
+         });
       });
    }
 });
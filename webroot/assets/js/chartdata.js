@@ -0,0 +1,224 @@
+/*
+ * Probe readings shown on the chart
+ *
+ * Readings are stored at full resolution in typed arrays, one column per
+ * probe, in 10^-1 Celcius. The chart is given CanvasJS dataPoints built from
+ * them: all of them while there are few enough, otherwise min/max buckets of
+ * about VIEW_POINTS points over the zoomed range, and a coarse outline of
+ * the rest.
+ */
+
+const VIEW_POINTS = 2000;
+const OUTLINE_POINTS = 200;
+const INITIAL_CAPACITY = 4096;
+
+const NO_PROBE = -0x8000;
+
+let ts = new Float64Array(INITIAL_CAPACITY);
+let temps = [];
+let length = 0;
+
+// Rows [0, viewRows) are in the dataPoints as they are in the store, unless
+// viewStale (ex. unit changed, history trimmed) or the view is decimated
+let viewRows = 0;
+let viewStale = true;
+let viewDecimated = false;
+
+const grow = (minCapacity) => {
+   let capacity = ts.length;
+   while (capacity < minCapacity) {
+      capacity *= 2;
+   }
+   if (capacity == ts.length) {
+      return;
+   }
+
+   const newTs = new Float64Array(capacity);
+   newTs.set(ts.subarray(0, length));
+   ts = newTs;
+   temps = temps.map((column) => {
+      const newColumn = new Int16Array(capacity);
+      newColumn.set(column.subarray(0, length));
+      return newColumn;
+   });
+};
+
+const addProbes = (numProbes) => {
+   if (temps.length < numProbes && length) {
+      // The new probes' series start from scratch
+      viewStale = true;
+   }
+   while (temps.length < numProbes) {
+      temps.push(new Int16Array(ts.length).fill(NO_PROBE));
+   }
+};
+
+const rowEquals = (a, b) => temps.every((column) => column[a] == column[b]);
+
+const reset = () => {
+   ts = new Float64Array(INITIAL_CAPACITY);
+   temps = [];
+   length = 0;
+   viewStale = true;
+};
+
+/*
+ * Append readings given as columns: {ts: [<ms>, ...], probes: [[<raw>, ...], ...]}
+ * with raw temperatures in 10^-1 Celcius, or null (or NO_PROBE) for no probe
+ */
+const append = (readings) => {
+   addProbes(readings.probes.length);
+   grow(length + readings.ts.length);
+
+   for (let i = 0; i < readings.ts.length; i++) {
+      ts[length] = readings.ts[i];
+      for (const [probe, column] of temps.entries()) {
+         const raw = readings.probes[probe]?.[i];
+         column[length] = raw == null ? NO_PROBE : raw;
+      }
+
+      // When the temps remain the same, only the first and last timestamps
+      // are needed to draw a straight line
+      if (length >= 2 && rowEquals(length, length - 1) && rowEquals(length - 1, length - 2)) {
+         ts[length - 1] = ts[length];
+      } else {
+         length++;
+      }
+   }
+};
+
+const rawToC = (raw) => raw == NO_PROBE ? null : raw / 10;
+
+const findRow = (value) => {
+   let lo = 0;
+   let hi = length;
+   while (lo < hi) {
+      const mid = (lo + hi) >> 1;
+      if (ts[mid] < value) {
+         lo = mid + 1;
+      } else {
+         hi = mid;
+      }
+   }
+   return lo;
+};
+
+// Drop readings before minTs
+const trim = (minTs) => {
+   const first = findRow(minTs);
+   if (first == 0) {
+      return;
+   }
+
+   ts.copyWithin(0, first, length);
+   for (const column of temps) {
+      column.copyWithin(0, first, length);
+   }
+   length -= first;
+   viewStale = true;
+};
+
+const numProbes = () => temps.length;
+
+const lastTemps = () => length ? temps.map((column) => rawToC(column[length - 1])) : null;
+
+// All readings as rows, in Celcius: [{ts: <ms>, probes: [<celcius>, ...]}, ...]
+const rows = () => Array.from({length: length}, (_, i) => ({
+   ts: ts[i],
+   probes: temps.map((column) => rawToC(column[i])),
+}));
+
+// Rebuild the dataPoints from scratch next time, ex. after a unit change
+const invalidate = () => {
+   viewStale = true;
+};
+
+/*
+ * Append points for rows [from, to) to pointsPerSeries, in min/max buckets
+ * of rows when there are more than maxPoints rows. Every series gets points
+ * at the same timestamps, so the shared tooltip shows all probes.
+ */
+const pushPoints = (pointsPerSeries, from, to, maxPoints, yFromC) => {
+   const bucketSize = Math.max(1, Math.ceil((to - from) * 2 / maxPoints));
+   for (let start = from; start < to; start += bucketSize) {
+      const end = Math.min(start + bucketSize, to);
+      if (end - start <= 2) {
+         for (let i = start; i < end; i++) {
+            for (const [probe, column] of temps.entries()) {
+               pointsPerSeries[probe].push({x: ts[i], y: yFromC(rawToC(column[i]))});
+            }
+         }
+         continue;
+      }
+
+      for (const [probe, column] of temps.entries()) {
+         let minIdx = -1;
+         let maxIdx = -1;
+         for (let i = start; i < end; i++) {
+            const raw = column[i];
+            if (raw == NO_PROBE) {
+               continue;
+            }
+            if (minIdx < 0 || raw < column[minIdx]) {
+               minIdx = i;
+            }
+            if (maxIdx < 0 || raw > column[maxIdx]) {
+               maxIdx = i;
+            }
+         }
+         const [first, last] = minIdx <= maxIdx ? [minIdx, maxIdx] : [maxIdx, minIdx];
+         const points = pointsPerSeries[probe];
+         points.push({x: ts[start], y: first < 0 ? null : yFromC(rawToC(column[first]))});
+         points.push({x: ts[end - 1], y: last < 0 ? null : yFromC(rawToC(column[last]))});
+      }
+   }
+};
+
+/*
+ * Update the dataPoints of dataSeries (one per probe) for the readings
+ * between viewport [min, max] (null for all of them), with temperatures
+ * converted by yFromC
+ */
+const updateDataPoints = (dataSeries, yFromC, viewport) => {
+   if (!viewStale && !viewDecimated && length <= VIEW_POINTS) {
+      // Only new readings (and the last one, its timestamp may have moved)
+      for (const [probe, column] of temps.entries()) {
+         const points = dataSeries[probe].dataPoints;
+         points.length = Math.max(0, viewRows - 1);
+         for (let i = points.length; i < length; i++) {
+            points.push({x: ts[i], y: yFromC(rawToC(column[i]))});
+         }
+      }
+      viewRows = length;
+      return;
+   }
+
+   const pointsPerSeries = temps.map(() => []);
+   viewDecimated = length > VIEW_POINTS;
+   if (viewDecimated) {
+      const from = viewport ? findRow(viewport[0]) : 0;
+      const to = viewport ? Math.min(length, findRow(viewport[1]) + 1) : length;
+      pushPoints(pointsPerSeries, 0, from, OUTLINE_POINTS, yFromC);
+      pushPoints(pointsPerSeries, from, to, VIEW_POINTS, yFromC);
+      pushPoints(pointsPerSeries, to, length, OUTLINE_POINTS, yFromC);
+   } else {
+      pushPoints(pointsPerSeries, 0, length, VIEW_POINTS, yFromC);
+   }
+   for (const [probe, points] of pointsPerSeries.entries()) {
+      dataSeries[probe].dataPoints = points;
+   }
+   viewRows = length;
+   viewStale = false;
+};
+
+export {
+   NO_PROBE,
+   reset,
+   append,
+   trim,
+   numProbes,
+   lastTemps,
+   rows,
+   invalidate,
+   updateDataPoints,
+};
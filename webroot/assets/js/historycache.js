@@ -0,0 +1,253 @@
+/*
+ * Readings received from the server, kept in IndexedDB
+ *
+ * On load the chart is drawn from the cache straight away, and the websocket
+ * resumes from the cached history epoch/seq, so only readings newer than the
+ * cache are sent (or the full history, if the server's history changed).
+ *
+ * Readings are stored per device in chunks of up to CHUNK_ROWS rows: a
+ * Float64Array of timestamps and an Int16Array per probe, in 10^-1 Celcius
+ * (NO_PROBE for no probe). Only the chunks that changed are written, at most
+ * every FLUSH_DELAY ms, in one transaction with the epoch/seq they bring the
+ * cache up to. When the page is open in several tabs, only the first to open
+ * a device's cache writes to it.
+ */
+
+const DB_NAME = 'ibbqweb';
+const DB_VERSION = 1;
+const CHUNK_ROWS = 1024;
+const FLUSH_DELAY = 2000; // ms
+
+const NO_PROBE = -0x8000;
+
+let db = null;
+let device = '';
+let writable = false;
+
+// Stored chunks before the tail, as {id, lastTs}
+let chunks = [];
+// Chunk being appended to: {id, length, ts: Float64Array, probes: [Int16Array]}
+let tail = null;
+let epoch = null;
+let seq = null;
+
+// What the next flush writes
+let cleared = false;
+const deletedIds = new Set();
+const dirtyChunks = new Map();
+let flushTimer = null;
+
+const request = (req) => new Promise((resolve, reject) => {
+   req.onsuccess = () => resolve(req.result);
+   req.onerror = () => reject(req.error);
+});
+
+const open = () => new Promise((resolve, reject) => {
+   const req = indexedDB.open(DB_NAME, DB_VERSION);
+   req.onupgradeneeded = () => {
+      req.result.createObjectStore('meta', {keyPath: 'device'});
+      req.result.createObjectStore('chunks', {keyPath: ['device', 'id']});
+   };
+   req.onblocked = () => reject(new Error('database upgrade blocked by another tab'));
+   req.onsuccess = () => {
+      // Let a newer version of the page in another tab upgrade it
+      req.result.onversionchange = () => {
+         req.result.close();
+         db = null;
+      };
+      resolve(req.result);
+   };
+   req.onerror = () => reject(req.error);
+});
+
+// Whether this page holds the device's write lock, which it keeps until closed
+const acquireWriteLock = () => new Promise((resolve) => {
+   if (!navigator.locks) {
+      resolve(true);
+      return;
+   }
+   navigator.locks.request(`${DB_NAME}:${device}`, {ifAvailable: true}, (lock) => {
+      resolve(lock !== null);
+      return lock && new Promise(() => {});
+   });
+});
+
+const deviceRange = () => IDBKeyRange.bound([device, -Infinity], [device, Infinity]);
+
+const newChunk = (id, numProbes) => ({
+   id: id,
+   length: 0,
+   ts: new Float64Array(CHUNK_ROWS),
+   probes: Array.from({length: numProbes}, () => new Int16Array(CHUNK_ROWS)),
+});
+
+// The chunk as stored, trimmed to its rows
+const storedChunk = (chunk) => ({
+   device: device,
+   id: chunk.id,
+   ts: chunk.ts.slice(0, chunk.length),
+   probes: chunk.probes.map((column) => column.slice(0, chunk.length)),
+});
+
+const rowEquals = (chunk, a, b) => chunk.probes.every((column) => column[a] == column[b]);
+
+const scheduleFlush = () => {
+   if (flushTimer === null && db && writable) {
+      flushTimer = setTimeout(flush, FLUSH_DELAY);
+   }
+};
+
+/*
+ * Open the cache for device (the page's ?device=, or null for the server's
+ * default), and read it as {epoch, seq, readings}, with readings as columns
+ * (see WS.decodeReadings()). Resolves to null when nothing is cached, or
+ * IndexedDB isn't available.
+ */
+const load = async (deviceId) => {
+   device = deviceId || '';
+   try {
+      db = await open();
+      writable = await acquireWriteLock();
+      const tx = db.transaction(['meta', 'chunks'], 'readonly');
+      const [meta, stored] = await Promise.all([
+         request(tx.objectStore('meta').get(device)),
+         request(tx.objectStore('chunks').getAll(deviceRange())),
+      ]);
+      if (!meta || !stored.length) {
+         return null;
+      }
+
+      epoch = meta.epoch;
+      seq = meta.seq;
+      chunks = stored.slice(0, -1).map((chunk) => ({
+         id: chunk.id,
+         lastTs: chunk.ts[chunk.ts.length - 1],
+      }));
+      const last = stored[stored.length - 1];
+      tail = newChunk(last.id, last.probes.length);
+      tail.length = last.ts.length;
+      tail.ts.set(last.ts);
+      last.probes.forEach((column, probe) => tail.probes[probe].set(column));
+
+      const numProbes = Math.max(...stored.map((chunk) => chunk.probes.length));
+      return {
+         epoch: epoch,
+         seq: seq,
+         readings: {
+            ts: stored.flatMap((chunk) => Array.from(chunk.ts)),
+            probes: Array.from({length: numProbes}, (_, probe) => stored.flatMap((chunk) =>
+               Array.from(chunk.probes[probe] || new Int16Array(chunk.ts.length).fill(NO_PROBE),
+                          (raw) => raw == NO_PROBE ? null : raw)
+            )),
+         },
+      };
+   } catch (ex) {
+      console.warn(`History cache unavailable: ${ex.message}`);
+      return null;
+   }
+};
+
+// Start over for a new history epoch, ex. the server's history was cleared
+const reset = (newEpoch) => {
+   chunks = [];
+   tail = null;
+   epoch = newEpoch;
+   seq = null;
+   cleared = true;
+   deletedIds.clear();
+   dirtyChunks.clear();
+   scheduleFlush();
+};
+
+/*
+ * Append readings, as columns (see WS.decodeReadings()), which bring the
+ * cache up to history seq
+ */
+const append = (readings, newSeq) => {
+   for (let i = 0; i < readings.ts.length; i++) {
+      if (!tail || tail.length == CHUNK_ROWS || tail.probes.length < readings.probes.length) {
+         if (tail) {
+            chunks.push({id: tail.id, lastTs: tail.ts[tail.length - 1]});
+         }
+         tail = newChunk(tail ? tail.id + 1 : 0, readings.probes.length);
+      }
+
+      const row = tail.length;
+      tail.ts[row] = readings.ts[i];
+      for (const [probe, column] of tail.probes.entries()) {
+         const raw = readings.probes[probe]?.[i];
+         column[row] = raw == null ? NO_PROBE : raw;
+      }
+
+      // Like ChartData, only keep the first and last of identical readings
+      if (row >= 2 && rowEquals(tail, row, row - 1) && rowEquals(tail, row - 1, row - 2)) {
+         tail.ts[row - 1] = tail.ts[row];
+      } else {
+         tail.length++;
+      }
+      dirtyChunks.set(tail.id, tail);
+   }
+
+   seq = newSeq;
+   scheduleFlush();
+};
+
+// Drop whole chunks of readings before minTs
+const trim = (minTs) => {
+   while (chunks.length && chunks[0].lastTs < minTs) {
+      deletedIds.add(chunks.shift().id);
+   }
+   scheduleFlush();
+};
+
+const flush = async () => {
+   clearTimeout(flushTimer);
+   flushTimer = null;
+   if (!db || !writable || epoch === null || seq === null) {
+      return;
+   }
+
+   try {
+      const tx = db.transaction(['meta', 'chunks'], 'readwrite');
+      const store = tx.objectStore('chunks');
+      if (cleared) {
+         store.delete(deviceRange());
+      }
+      for (const id of deletedIds) {
+         store.delete([device, id]);
+      }
+      for (const chunk of dirtyChunks.values()) {
+         store.put(storedChunk(chunk));
+      }
+      tx.objectStore('meta').put({device: device, epoch: epoch, seq: seq});
+      cleared = false;
+      deletedIds.clear();
+      dirtyChunks.clear();
+
+      await new Promise((resolve, reject) => {
+         tx.oncomplete = resolve;
+         tx.onerror = () => reject(tx.error);
+         tx.onabort = () => reject(tx.error);
+      });
+   } catch (ex) {
+      // What was pending is lost, so the cache can't be trusted any more
+      console.warn(`Failed to save the history cache: ${ex?.message}`);
+      writable = false;
+      db?.transaction('meta', 'readwrite').objectStore('meta').delete(device);
+   }
+};
+
+// Save what's pending before the page goes away
+document.addEventListener('visibilitychange', () => {
+   if (document.visibilityState == 'hidden' && flushTimer !== null) {
+      flush();
+   }
+});
+
+export {
+   load,
+   reset,
+   append,
+   trim,
+   flush,
+};
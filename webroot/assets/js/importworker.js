@@ -0,0 +1,286 @@
+/*
+ * Reads a saved history file off the main thread
+ *
+ * Posted a File, the worker reads it in chunks and posts back:
+ *  - {progress: <0..1>} as it goes
+ *  - {readings: {ts: Float64Array, probes: [Int16Array, ...]}} every
+ *    BATCH_ROWS readings, temperatures in 10^-1 Celcius (NO_PROBE for no
+ *    probe), with the buffers transferred
+ *  - {done: <readings>} at the end, or {error: <message>}
+ *
+ * Files can be the web interface's saved data or /api/history?format=json
+ * ({"probe_readings": [{"ts": <ms>, "probes": [<celcius>, ...]}, ...]}, parsed
+ * a reading at a time), the compact columnar layout of websocket updates
+ * ({"readings": {"ts": [...], "probes": [[...], ...]}}, see
+ * lib/wshub.py:_encode_columnar()), or /api/history?format=csv.
+ */
+
+const BATCH_ROWS = 8192;
+const NO_PROBE = -0x8000;
+// Sanity limits for readings, in Celcius
+const MIN_TEMP = -100;
+const MAX_TEMP = 1000;
+const MAX_PROBES = 16;
+
+class Batches {
+   constructor() {
+      this.count = 0;
+      this.start();
+   }
+
+   start() {
+      this.length = 0;
+      this.ts = new Float64Array(BATCH_ROWS);
+      this.probes = [];
+   }
+
+   // Add a reading, with raw temps (10^-1 Celcius, or null)
+   add(ts, rawTemps) {
+      if (!Number.isFinite(ts)) {
+         throw new Error(`Invalid timestamp '${ts}' in reading ${this.count + 1}`);
+      }
+      if (rawTemps.length > MAX_PROBES) {
+         throw new Error(`Too many probes in reading ${this.count + 1}`);
+      }
+      while (this.probes.length < rawTemps.length) {
+         this.probes.push(new Int16Array(BATCH_ROWS).fill(NO_PROBE));
+      }
+
+      this.ts[this.length] = ts;
+      for (const [probe, raw] of rawTemps.entries()) {
+         if (raw == null) {
+            continue;
+         }
+         if (!Number.isFinite(raw) || raw < MIN_TEMP * 10 || raw > MAX_TEMP * 10) {
+            throw new Error(`Invalid temperature '${raw / 10}' in reading ${this.count + 1}`);
+         }
+         this.probes[probe][this.length] = Math.round(raw);
+      }
+      this.length++;
+      this.count++;
+      if (this.length == BATCH_ROWS) {
+         this.post();
+      }
+   }
+
+   addCelcius(ts, temps) {
+      if (!Array.isArray(temps)) {
+         throw new Error(`Invalid probes in reading ${this.count + 1}`);
+      }
+      this.add(ts, temps.map((temp) => temp == null ? null :
+                                        typeof temp == 'number' ? temp * 10 : NaN));
+   }
+
+   post() {
+      if (!this.length) {
+         return;
+      }
+      const readings = {
+         ts: this.ts.slice(0, this.length),
+         probes: this.probes.map((column) => column.slice(0, this.length)),
+      };
+      postMessage({readings: readings},
+                  [readings.ts.buffer, ...readings.probes.map((column) => column.buffer)]);
+      this.start();
+   }
+}
+
+/*
+ * {"probe_readings": [...]}, handing each reading to the batches as soon as
+ * its closing brace arrives
+ */
+class RowsParser {
+   constructor(batches) {
+      this.batches = batches;
+      this.buf = '';
+      this.inArray = false;
+      this.ended = false;
+   }
+
+   push(text) {
+      this.buf += text;
+      if (!this.inArray) {
+         const match = /^\s*\{\s*"probe_readings"\s*:\s*\[/.exec(this.buf);
+         if (!match) {
+            return;
+         }
+         this.buf = this.buf.slice(match[0].length);
+         this.inArray = true;
+      }
+
+      let depth = 0;
+      let inString = false;
+      let start = -1;
+      let consumed = 0;
+      for (let i = 0; i < this.buf.length && !this.ended; i++) {
+         const c = this.buf[i];
+         if (inString) {
+            if (c == '\\') {
+               i++;
+            } else if (c == '"') {
+               inString = false;
+            }
+         } else if (c == '"') {
+            inString = true;
+         } else if (c == '{' || c == '[') {
+            if (depth++ == 0) {
+               start = i;
+            }
+         } else if (c == '}' || c == ']') {
+            if (depth == 0) {
+               // End of the probe_readings array
+               this.ended = true;
+            } else if (--depth == 0) {
+               const row = JSON.parse(this.buf.slice(start, i + 1));
+               this.batches.addCelcius(row.ts, row.probes);
+               consumed = i + 1;
+            }
+         }
+      }
+      this.buf = this.buf.slice(consumed);
+   }
+
+   end() {
+      if (!this.inArray) {
+         throw new Error('Unknown file format');
+      }
+      if (!this.ended) {
+         throw new Error('Unexpected end of file');
+      }
+   }
+}
+
+// {"readings": {...}}, delta encoded columns, parsed whole
+class CompactParser {
+   constructor(batches) {
+      this.batches = batches;
+      this.parts = [];
+   }
+
+   push(text) {
+      this.parts.push(text);
+   }
+
+   end() {
+      const readings = JSON.parse(this.parts.join('')).readings;
+      this.parts = [];
+      if (!Array.isArray(readings?.ts) || !Array.isArray(readings.probes) ||
+          !readings.probes.every((column) => Array.isArray(column))) {
+         throw new Error('Invalid readings');
+      }
+
+      let ts = 0;
+      const temps = readings.probes.map(() => 0);
+      for (const [i, delta] of readings.ts.entries()) {
+         ts += delta;
+         this.batches.add(ts, readings.probes.map((column, probe) => {
+            if (column[i] == null) {
+               return null;
+            }
+            temps[probe] += column[i];
+            return temps[probe];
+         }));
+      }
+   }
+}
+
+// /api/history?format=csv: ts,probe1,...,probeN[,probe1_min,probe1_max,...]
+class CsvParser {
+   constructor(batches) {
+      this.batches = batches;
+      this.buf = '';
+      this.columns = null;
+   }
+
+   push(text) {
+      this.buf += text;
+      const lines = this.buf.split('\n');
+      this.buf = lines.pop();
+      for (const line of lines) {
+         this.line(line.trim());
+      }
+   }
+
+   line(line) {
+      if (!line) {
+         return;
+      }
+      const fields = line.split(',');
+      if (this.columns === null) {
+         if (fields[0] != 'ts') {
+            throw new Error('Unknown file format');
+         }
+         this.columns = fields.flatMap((name, i) => /^probe\d+$/.test(name) ? [i] : []);
+         return;
+      }
+
+      this.batches.addCelcius(Number(fields[0]), this.columns.map((i) =>
+         fields[i] == null || fields[i] === '' ? null : Number(fields[i])
+      ));
+   }
+
+   end() {
+      this.line(this.buf.trim());
+      if (this.columns === null) {
+         throw new Error('Unexpected end of file');
+      }
+   }
+}
+
+// The parser for a file starting with text, or null if more is needed to tell
+const sniff = (text, batches) => {
+   const start = text.trimStart();
+   if (!start) {
+      return null;
+   }
+   if (!start.startsWith('{')) {
+      return new CsvParser(batches);
+   }
+
+   const key = /^\{\s*"([^"]*)"/.exec(start);
+   if (!key) {
+      return start.length < 64 ? null : new RowsParser(batches);
+   }
+   return key[1] == 'readings' ? new CompactParser(batches) : new RowsParser(batches);
+};
+
+const read = async (file) => {
+   const batches = new Batches();
+   const decoder = new TextDecoder();
+   const reader = file.stream().getReader();
+   let parser = null;
+   let pending = '';
+   let loaded = 0;
+
+   for (;;) {
+      const {done, value} = await reader.read();
+      const text = done ? decoder.decode() : decoder.decode(value, {stream: true});
+      if (parser === null) {
+         pending += text;
+         parser = sniff(pending, batches) || (done ? new RowsParser(batches) : null);
+         if (parser !== null) {
+            parser.push(pending);
+         }
+      } else {
+         parser.push(text);
+      }
+      if (done) {
+         break;
+      }
+
+      loaded += value.length;
+      postMessage({progress: file.size ? loaded / file.size : 1});
+   }
+
+   parser.end();
+   batches.post();
+   return batches.count;
+};
+
+onmessage = (e) => {
+   read(e.data).then((count) => {
+      postMessage({done: count});
+   }).catch((ex) => {
+      postMessage({error: ex.message});
+   });
+};
@@ -5,10 +5,27 @@ let ws = null;
 let opts = {};
 let offlineMode = true;
 
+// Newest history entry received, so a reconnect only fetches what was missed
+let historyCursor = null;
+
 let serverDisconnectedToast = null;
 let offlineModeToast = null;
 
+// Commands sent and waiting for their result, by id
+let nextCommandId = 1;
+const pendingCommands = new Map();
+
+const commandDescriptions = {
+   set_probe_target_temp: 'Setting the probe target temperature',
+   silence_alarm: 'Silencing the alarm',
+   set_unit: 'Setting the unit',
+   clear_history: 'Clearing the history',
+   poweroff: 'Powering off',
+};
+
 const isConnected = () => ws?.readyState == 1;
+// The thermometer to show, from the page's ?device= (the server's first by default)
+const deviceId = () => new URLSearchParams(window.location.search).get('device');
 const protocol = window.location.protocol == "https:" ? "wss://" : "ws://";
 
 const renderToastServerDisconnected = () => {
@@ -51,12 +68,54 @@ const renderToastOfflineMode = () => {
    return obj;
 }
 
+const renderToastCommandFailed = (cmd, error) => {
+   const html = `
+      <div class="toast align-items-center" role="alert" aria-live="assertive" aria-atomic="true">
+        <div class="toast-header">
+          <i class="bi bi-exclamation-circle-fill me-1 text-danger"></i>
+          <strong class="me-auto"></strong>
+          <button type="button" class="btn-close" data-bs-dismiss="toast" aria-label="Close"></button>
+        </div>
+        <div class="toast-body">
+        </div>
+      </div>
+   `;
+
+   const obj = Utils.renderToast(html);
+   obj.element.querySelector('strong').textContent =
+      `${commandDescriptions[cmd] || 'Command'} failed`;
+   obj.element.querySelector('.toast-body').textContent = error;
+   return obj;
+}
+
+// Result of a command sent by this page, see lib/webserver.py:_ws_run_cmd()
+const handleCommandResult = (result) => {
+   const cmd = pendingCommands.get(result.id);
+   pendingCommands.delete(result.id);
+   if (!result.ok) {
+      console.warn(`${cmd || result.cmd} failed: ${result.error}`);
+      renderToastCommandFailed(cmd || result.cmd, result.error);
+   }
+};
+
 const _connect = () => {
    if (offlineMode) {
       return;
    }
 
-   ws = new WebSocket(protocol + window.location.host + "/ws");
+   const params = new URLSearchParams({
+      enc: 'columnar',
+      ...historyCursor,
+   });
+   if (deviceId()) {
+      params.set('device', deviceId());
+   }
+   if (typeof opts.historyPoints === 'function') {
+      // Downsample a full history to fit the chart; also needed with a
+      // cursor, as a stale one gets the full history too
+      params.set('points', opts.historyPoints());
+   }
+   ws = new WebSocket(protocol + window.location.host + "/ws?" + params.toString());
 
    ws.onopen = (e) => {
       if (serverDisconnectedToast || offlineModeToast) {
@@ -89,12 +148,19 @@ const _connect = () => {
          setTimeout(_connect, 1000)
       }
 
+      // Results for commands sent over this connection won't arrive
+      pendingCommands.clear();
+
       if (typeof opts.onclose === 'function') {
           opts.onclose(e);
       }
    };
 
    ws.onmessage = (e) => {
+      if (e.data.startsWith('{"cmd_result":')) {
+         handleCommandResult(JSON.parse(e.data).cmd_result);
+         return;
+      }
       if (typeof opts.onmessage === 'function') {
          opts.onmessage(e);
       }
@@ -116,12 +182,55 @@ const disconnect = () => {
    ws.close();
 };
 
+/*
+ * Decode 'columnar' readings, see lib/wshub.py:_encode_columnar(), to
+ * {ts: [<ms>, ...], probes: [[<raw>, ...], ...]} with absolute timestamps
+ * and temperatures (10^-1 Celcius, null for no probe)
+ */
+const decodeReadings = (readings) => {
+   const ts = new Float64Array(readings.ts.length);
+   let prevTs = 0;
+   for (const [i, delta] of readings.ts.entries()) {
+      prevTs += delta;
+      ts[i] = prevTs;
+   }
+
+   const probes = readings.probes.map((column) => {
+      let temp = 0;
+      return column.map((delta) => {
+         if (delta === null) {
+            return null;
+         }
+         temp += delta;
+         return temp;
+      });
+   });
+
+   return {
+      ts: ts,
+      probes: probes,
+   };
+};
+
+const setHistoryCursor = (epoch, seq) => {
+   historyCursor = {
+      epoch: epoch,
+      since: seq,
+   };
+};
+
+const clearHistoryCursor = () => {
+   historyCursor = null;
+};
+
 const send = (payload) => {
    if (!isConnected()) {
       return false;
    }
 
-   ws.send(JSON.stringify(payload));
+   const id = nextCommandId++;
+   pendingCommands.set(id, payload.cmd);
+   ws.send(JSON.stringify({...payload, id: id}));
    return true;
 }
 
@@ -166,9 +275,13 @@ const powerOff = () => {
 
 export {
    isConnected,
+   deviceId,
    init,
    connect,
    disconnect,
+   decodeReadings,
+   setHistoryCursor,
+   clearHistoryCursor,
    silenceAlarm,
    setProbeTargetTemp,
    clearProbeTargetTemp,
@@ -1,5 +1,12 @@
 const NETWORK_TIMEOUT = 1000; // 1 Sec
 
+// The page and its content hashed assets, added to this script by the server
+// (see lib/assets.py). A new version of any asset changes this script, which
+// installs a new service worker that precaches the new versions.
+const precache = self.PRECACHE || {version: 'none', urls: []};
+const precacheUrls = new Set(precache.urls);
+const precacheName = `site-precache-${precache.version}`;
+
 const dynamicCacheName = 'site-dynamic-v1';
 const staticCacheName = 'site-static-v1';
 const staticCacheAssets = [
@@ -8,9 +15,12 @@ const staticCacheAssets = [
 
 self.addEventListener('install', (e) => {
    e.waitUntil(
-      caches.open(staticCacheName).then((cache) => {
-         cache.addAll(staticCacheAssets);
-      })
+      Promise.all([
+         caches.open(staticCacheName).then((cache) => {
+            cache.addAll(staticCacheAssets);
+         }),
+         caches.open(precacheName).then((cache) => cache.addAll(precache.urls)),
+      ]).then(() => self.skipWaiting())
    );
 });
 
@@ -18,15 +28,46 @@ self.addEventListener('activate', (e) => {
    e.waitUntil(
       caches.keys().then((keys) => {
          return Promise.all(
-            keys.filter(key => ![dynamicCacheName, staticCacheName].includes(key))
+            keys.filter(key => ![dynamicCacheName, staticCacheName, precacheName].includes(key))
             .map(key => caches.delete(key))
          );
-      })
+      }).then(() => self.clients.claim())
    );
 });
 
-// Dummy fetch handler
 self.addEventListener('fetch', (e) => {
+   const url = new URL(e.request.url);
+   if (url.origin == self.location.origin && e.request.method == 'GET') {
+      // Hashed assets never change, so are served from the cache without
+      // asking the server
+      if (precacheUrls.has(url.pathname + url.search)) {
+         e.respondWith(
+            caches.match(e.request, {cacheName: precacheName}).then((cacheResp) => {
+               return cacheResp || fetch(e.request);
+            })
+         );
+         return;
+      }
+
+      // The page is served from the cache too, while fetching the latest
+      // version for next time
+      if (e.request.mode == 'navigate' && url.pathname == '/') {
+         const fetchPromise = fetch(e.request);
+         e.waitUntil(fetchPromise.then((fetchResp) => {
+            if (fetchResp.ok) {
+               const copy = fetchResp.clone();
+               return caches.open(precacheName).then((cache) => cache.put('/', copy));
+            }
+         }).catch(() => null));
+         e.respondWith(
+            caches.match('/', {cacheName: precacheName}).then((cacheResp) => {
+               return cacheResp || fetchPromise;
+            })
+         );
+         return;
+      }
+   }
+
    if (e.request.mode != 'websocket') {
       // Can't cache partial responses, so either serve the whole thing if it's
       // int he cache, or forward on the request as-is